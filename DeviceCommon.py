@@ -0,0 +1,1101 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Code shared by IoTHubClient.py and IoTCentralClient.py. Copy this file next to the scripts.
+
+import time
+import os
+import sys
+import asyncio
+import random
+import struct
+import json
+import logging
+import logging.handlers
+import queue
+
+# Log messages go through a queue to a thread that writes them, so a slow console or serial line
+# doesn't block the event loop. Each message type (the format string of the message) is rate
+# limited on its own, and the number of dropped messages is added to the next one that goes out.
+logger = logging.getLogger("device")
+
+class Rate_Limit_Filter(logging.Filter):
+    def __init__(self, rate=2.0, burst=10):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def filter(self, record):
+        key = record.msg
+        now = time.monotonic()
+        tokens, last, suppressed = self.buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now, suppressed + 1)
+            return False
+        self.buckets[key] = (tokens - 1, now, 0)
+        # The queue handler formats the message before it is queued, keep the type for the JSON log
+        record.event = str(key)
+        if suppressed:
+            record.msg = str(key) + " (%d similar messages suppressed)" % suppressed
+        return True
+
+class Json_Log_Formatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "event": getattr(record, "event", str(record.msg)),
+            "message": record.getMessage()
+            }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def setup_logging(stream=None):
+    # Returns the listener writing the log, to stop when the script ends
+    handler = logging.StreamHandler(stream)
+    if os.getenv("LOG_FORMAT", "text") == "json":
+        handler.setFormatter(Json_Log_Formatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(Rate_Limit_Filter(float(os.getenv("LOG_RATE", "2")), int(os.getenv("LOG_BURST", "10"))))
+    logger.handlers = [queue_handler]
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+# Led backend: the Blinkt! hat, or simulated leds to run on a PC without it when LED_BACKEND=sim.
+# set_pixels() takes 3 bytes (r, g, b) per pixel.
+if os.getenv("LED_BACKEND", "blinkt") == "sim":
+    # show() takes about as long as pushing the pixels to the Blinkt! on a Pi Zero
+    sim_pixels = [(0, 0, 0)] * int(os.getenv("LED_COUNT", "8"))
+    sim_show_delay = float(os.getenv("LED_SIM_SHOW_DELAY", "0.002"))
+    def set_pixel(i, r, g, b):
+        sim_pixels[i] = (r, g, b)
+    def set_pixels(rgb):
+        # rgb holds 3 bytes per pixel
+        sim_pixels[:len(rgb) // 3] = zip(rgb[0::3], rgb[1::3], rgb[2::3])
+    def set_brightness(b):
+        pass
+    def show():
+        time.sleep(sim_show_delay)
+    def clear():
+        for i in range(len(sim_pixels)):
+            sim_pixels[i] = (0, 0, 0)
+else:
+    from blinkt import set_pixel, set_brightness, show, clear
+    def set_pixels(rgb):
+        # The Blinkt! library sets one pixel at a time
+        for i in range(len(rgb) // 3):
+            set_pixel(i, rgb[i * 3], rgb[i * 3 + 1], rgb[i * 3 + 2])
+
+class Led:
+    status=False
+    blink=False
+    r=255
+    g=255
+    b=255
+
+    def __init__(self, r=255, g=255, b=255):
+        self.status = False
+        self.blink = False
+        self.r = r
+        self.g = g
+        self.b = b
+
+    def set_color(self, r,g,b):
+        self.r = r
+        self.g = g
+        self.b = b
+
+    def set_status(self, status):
+        self.status = status
+
+    def set_blink(self, yesno):
+        self.blink = yesno
+
+# Led strip held as N x 3 color and N status/blink arrays, so that whole frames are computed with
+# NumPy operations instead of a Python loop over Led objects. Frames go through a gamma and
+# brightness lookup table, so the leds and the twin keep the requested colors.
+class Led_Effects:
+    def __init__(self, led_count=8, gamma=1.0, brightness=1.0):
+        # Only needed with this engine
+        import numpy
+        self.np = numpy
+        self.led_count = led_count
+        self.colors = numpy.full((led_count, 3), 255, dtype=numpy.uint8)
+        self.status = numpy.zeros(led_count, dtype=bool)
+        self.blink = numpy.zeros(led_count, dtype=bool)
+        self.set_curve(gamma, brightness)
+
+    def set_curve(self, gamma=1.0, brightness=1.0):
+        levels = self.np.arange(256) / 255.0
+        self.lut = self.np.clip(self.np.round(levels ** gamma * brightness * 255), 0, 255).astype(self.np.uint8)
+
+    def masked(self, mask, colors=None):
+        colors = self.colors if colors is None else colors
+        return self.lut[self.np.where(mask[:, None], colors, 0)]
+
+    def frame(self, blink_on):
+        # Blinking leds are lit on every other frame
+        return self.masked(self.status if blink_on else self.status & ~self.blink)
+
+    def scroll_frame(self, position, width=1):
+        # A window of lit leds, moved along the strip by rolling its mask
+        mask = self.np.zeros(self.led_count, dtype=bool)
+        mask[:width] = True
+        return self.masked(self.np.roll(mask, position))
+
+    def blend(self, colors, t):
+        # Colors from t=0 (current colors) to t=1 (the given colors), for fades
+        blended = self.colors * (1.0 - t) + self.np.asarray(colors, dtype=float) * t
+        return self.np.round(blended).astype(self.np.uint8)
+
+    def gradient(self, start, end):
+        return self.np.round(self.np.linspace(start, end, self.led_count)).astype(self.np.uint8)
+
+    def set_colors(self, colors):
+        self.colors[:] = colors
+
+# Led whose state lives in the arrays of a Led_Effects engine, so that twin patches and direct
+# methods keep working on Led objects. Values that are not numbers leave the color unchanged.
+def effects_color(channel):
+    def get(self):
+        return int(self.effects.colors[self.i, channel])
+    def set(self, value):
+        try:
+            self.effects.colors[self.i, channel] = min(max(int(value), 0), 255)
+        except (TypeError, ValueError):
+            pass
+    return property(get, set)
+
+def effects_flag(name):
+    def get(self):
+        return bool(getattr(self.effects, name)[self.i])
+    def set(self, value):
+        getattr(self.effects, name)[self.i] = bool(value)
+    return property(get, set)
+
+class Effects_Led(Led):
+    r = effects_color(0)
+    g = effects_color(1)
+    b = effects_color(2)
+    status = effects_flag("status")
+    blink = effects_flag("blink")
+
+    def __init__(self, effects, i):
+        self.effects = effects
+        self.i = i
+
+# Paces animations at a target frame rate on the monotonic clock.
+# Frame deadlines are fixed multiples of the frame period, so time spent rendering does not add up,
+# and when the loop falls behind by more than a frame the late frames are dropped instead of replayed.
+class Frame_Clock:
+    def __init__(self, fps=20):
+        self.period = 1.0 / fps
+        self.frames = 0
+        self.dropped_frames = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.running_time = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+        self.next_frame = self.started
+
+    def stop(self):
+        if self.started is not None:
+            self.running_time = self.running_time + time.monotonic() - self.started
+            self.started = None
+
+    async def wait_next_frame(self):
+        # Returns the number of frames the animation should advance, more than 1 when frames were dropped
+        self.next_frame = self.next_frame + self.period
+        late = time.monotonic() - self.next_frame
+        skipped = 0
+        if late > self.period:
+            skipped = int(late / self.period)
+            self.next_frame = self.next_frame + skipped * self.period
+            self.dropped_frames = self.dropped_frames + skipped
+        await asyncio.sleep(max(self.next_frame - time.monotonic(), 0))
+        jitter = abs(time.monotonic() - self.next_frame)
+        self.jitter_total = self.jitter_total + jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.frames = self.frames + 1
+        return 1 + skipped
+
+    def stats(self):
+        running_time = self.running_time
+        if self.started is not None:
+            running_time = running_time + time.monotonic() - self.started
+        return {
+            "target_fps": 1.0 / self.period,
+            "achieved_fps": self.frames / running_time if running_time > 0 else 0.0,
+            "frames": self.frames,
+            "dropped_frames": self.dropped_frames,
+            "avg_jitter_ms": self.jitter_total / self.frames * 1000 if self.frames else 0.0,
+            "max_jitter_ms": self.jitter_max * 1000
+            }
+
+# Optional renderer running in its own process so that slow GPIO writes don't block the event loop.
+# Led_Manager writes frames into a shared memory framebuffer guarded by a sequence counter
+# (odd while a frame is being written) and the renderer process pushes each new frame to the leds.
+class Led_Render_Process:
+    def __init__(self, led_count=8):
+        # Only needed in this render mode
+        import multiprocessing
+        from multiprocessing import shared_memory
+        self.led_count = led_count
+        self.shm = shared_memory.SharedMemory(create=True, size=4 + led_count * 3)
+        self.shm.buf[:] = bytes(len(self.shm.buf))
+        self.sequence = 0
+        self.frame_ready = multiprocessing.Event()
+        self.stopping = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=run_led_render_process,
+            args=(self.shm, led_count, self.frame_ready, self.stopping),
+            daemon=True
+            )
+
+    def start(self):
+        self.process.start()
+
+    def push(self, frame):
+        buf = self.shm.buf
+        self.sequence = self.sequence + 1
+        struct.pack_into("<I", buf, 0, self.sequence)
+        if hasattr(frame, "tobytes"):
+            # Led_Effects frames are already uint8 rgb rows
+            pixels = frame.tobytes()
+        else:
+            pixels = bytearray()
+            for pixel in frame:
+                pixels.extend(min(max(int(c), 0), 255) for c in pixel)
+        buf[4:4 + len(pixels)] = pixels
+        self.sequence = self.sequence + 1
+        struct.pack_into("<I", buf, 0, self.sequence)
+        self.frame_ready.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.frame_ready.set()
+        self.process.join(2)
+        self.shm.close()
+        self.shm.unlink()
+
+def read_shared_frame(buf, led_count):
+    while True:
+        sequence = struct.unpack_from("<I", buf, 0)[0]
+        if sequence % 2:
+            continue
+        pixels = bytes(buf[4:4 + led_count * 3])
+        if struct.unpack_from("<I", buf, 0)[0] == sequence:
+            return [tuple(pixels[i * 3:i * 3 + 3]) for i in range(led_count)]
+
+def run_led_render_process(shm, led_count, frame_ready, stopping):
+    set_brightness(0.1)
+    last_frame = None
+    while not stopping.is_set():
+        if not frame_ready.wait(1):
+            continue
+        frame_ready.clear()
+        frame = read_shared_frame(shm.buf, led_count)
+        if frame == last_frame:
+            continue
+        for i in range(led_count):
+            if last_frame is None or frame[i] != last_frame[i]:
+                set_pixel(i, frame[i][0], frame[i][1], frame[i][2])
+        show()
+        last_frame = frame
+    shm.close()
+
+# list of leds
+# The last frame pushed to the Blinkt is kept so that only changed pixels are written,
+# and show() is skipped entirely when nothing changed.
+# With a renderer set, frames are handed to the renderer process instead of the Blinkt.
+# With a Led_Effects engine, the leds are views on its arrays and frames are computed by the engine.
+class Led_Manager:
+    scroll_leds = False
+
+    def __init__(self, fps=20, led_count=8, effects=None):
+        self.effects = effects
+        self.leds = []
+        if effects is not None:
+            led_count = effects.led_count
+        for i in range(led_count):
+            self.leds.append(Led() if effects is None else Effects_Led(effects, i))
+        self.frame_clock = Frame_Clock(fps)
+        self.scroll_event = None
+        self.renderer = None
+        self.frame = None
+        self.frames_computed = 0
+        self.frames_pushed = 0
+        self.pixels_written = 0
+        self.render_latency = None
+        set_brightness(0.1)
+
+
+    def set_all_leds_color(self, r, g, b):
+        if (self.effects is not None):
+            self.effects.set_colors((r, g, b))
+            return
+        for i in range(len(self.leds)):
+            self.leds[i].set_color(r, g, b)
+
+    def show_booting(self):
+        # Shown while the Azure IoT SDK loads, before the animation tasks run
+        self.set_all_leds_color(255, 128, 0)
+        self.start_scrolling()
+        self.render(self.scroll_frame(0))
+
+    def set_led(self, i, status, r, g, b, blk=False):
+        self.leds[i].set_color(r, g, b)
+        self.leds[i].set_status(status)
+        self.leds[i].blink=blk
+
+    def set_all_leds_off(self):
+        self.stop_scrolling()
+        if (self.effects is not None):
+            self.effects.status[:] = False
+            return
+        for i in range(len(self.leds)):
+            self.leds[i].set_status(False)
+
+    def start_scrolling(self):
+        self.scroll_leds = True
+        if (self.scroll_event is not None):
+            self.scroll_event.set()
+
+    def stop_scrolling(self):
+        self.scroll_leds = False
+        if (self.scroll_event is not None):
+            self.scroll_event.clear()
+
+    def compute_frame(self, blink_on):
+        if (self.effects is not None):
+            return self.effects.frame(blink_on)
+        frame = []
+        for i in range(len(self.leds)):
+            if (self.leds[i].status and (blink_on or not self.leds[i].blink)):
+                frame.append((self.leds[i].r, self.leds[i].g, self.leds[i].b))
+            else:
+                frame.append((0, 0, 0))
+        return frame
+
+    def scroll_frame(self, i):
+        # Only led i is lit, with its own color
+        if (self.effects is not None):
+            return self.effects.scroll_frame(i)
+        frame = [(0, 0, 0)] * len(self.leds)
+        frame[i] = (self.leds[i].r, self.leds[i].g, self.leds[i].b)
+        return frame
+
+    def start_render_process(self):
+        self.renderer = Led_Render_Process(len(self.leds))
+        self.renderer.start()
+
+    def stop_render_process(self):
+        if (self.renderer is not None):
+            self.renderer.stop()
+            self.renderer = None
+
+    def render(self, frame):
+        # Time spent pushing frames, when a Latency_Histogram is attached
+        if (self.render_latency is None):
+            self.push_frame(frame)
+            return
+        start = time.perf_counter()
+        self.push_frame(frame)
+        self.render_latency.record(time.perf_counter() - start)
+
+    def push_frame(self, frame):
+        self.frames_computed = self.frames_computed + 1
+        if (self.effects is not None):
+            self.push_array_frame(frame)
+            return
+        if (self.renderer is not None):
+            if (frame != self.frame):
+                self.renderer.push(frame)
+                self.frames_pushed = self.frames_pushed + 1
+            self.frame = frame
+            return
+        changed = False
+        for i in range(len(self.leds)):
+            if (self.frame is None or frame[i] != self.frame[i]):
+                set_pixel(i, frame[i][0], frame[i][1], frame[i][2])
+                self.pixels_written = self.pixels_written + 1
+                changed = True
+        if (changed):
+            show()
+            self.frames_pushed = self.frames_pushed + 1
+        self.frame = frame
+
+    def push_array_frame(self, frame):
+        # Frames of the Led_Effects engine are compared and pushed in one call
+        np = self.effects.np
+        if (self.frame is None):
+            changed = len(frame)
+        else:
+            changed = int(np.count_nonzero((frame != self.frame).any(axis=1)))
+        if (changed == 0):
+            return
+        if (self.renderer is not None):
+            self.renderer.push(frame)
+        else:
+            set_pixels(frame.tobytes())
+            show()
+            self.pixels_written = self.pixels_written + changed
+        self.frames_pushed = self.frames_pushed + 1
+        self.frame = frame
+
+    def render_stats(self):
+        return {
+            "frames_computed": self.frames_computed,
+            "frames_pushed": self.frames_pushed,
+            "pixels_written": self.pixels_written
+            }
+
+    async def scroll_leds_task(self):
+        # The event is created here so that it belongs to the running loop
+        self.scroll_event = asyncio.Event()
+        if (self.scroll_leds):
+            self.scroll_event.set()
+        while True:
+            # Wake up as soon as scrolling starts instead of polling
+            await self.scroll_event.wait()
+            logger.debug("Scrolling leds")
+            self.frame_clock.start()
+            i = 0
+            while (self.scroll_leds):
+                self.render(self.scroll_frame(i))
+                i = (i + await self.frame_clock.wait_next_frame()) % len(self.leds)
+            self.frame_clock.stop()
+
+    async def update_leds_task(self):
+        blink_on = True
+        while True:
+            if (not self.scroll_leds):
+                # Blinking leds are lit on every other pass
+                blink_on = not blink_on
+                self.render(self.compute_frame(blink_on))
+            await asyncio.sleep(.5)
+
+# Led_Manager for LED_COUNT leds, with the NumPy engine when LED_ENGINE=numpy
+def create_led_manager():
+    led_count = int(os.getenv("LED_COUNT", "8"))
+    effects = None
+    if os.getenv("LED_ENGINE", "loop") == "numpy":
+        effects = Led_Effects(led_count, float(os.getenv("LED_GAMMA", "1")), float(os.getenv("LED_BRIGHTNESS", "1")))
+    return Led_Manager(led_count=led_count, effects=effects)
+
+# The Azure IoT SDK takes seconds to import on a Pi Zero W, so the scripts only import it from
+# main(), while the leds already show the device is booting. The SDK classes are set in namespace,
+# the globals() of the script, so that benchmarks can replace them with fakes.
+def import_sdk(namespace):
+    if namespace.get("IoTHubDeviceClient") is None:
+        from azure.iot.device import Message
+        from azure.iot.device.aio import IoTHubDeviceClient, ProvisioningDeviceClient
+        namespace.update(
+            IoTHubDeviceClient=IoTHubDeviceClient,
+            ProvisioningDeviceClient=ProvisioningDeviceClient,
+            Message=Message
+            )
+
+# Records how long each phase of the startup takes, from the time the script started
+class Boot_Timeline:
+    def __init__(self, started):
+        self.started = started
+        self.last = self.started
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        print("Boot timeline:")
+        for phase, duration in self.phases:
+            print("   %-18s %6.2f s" % (phase, duration))
+        print("   %-18s %6.2f s" % ("total", self.last - self.started))
+
+# Seconds to wait before retry number attempt + 1: exponential, capped at max_backoff, and
+# jittered so that a fleet coming back from an outage doesn't retry in lockstep
+def backoff_delay(attempt, initial_backoff=1.0, max_backoff=60.0):
+    return min(max_backoff, initial_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+# Keeps the device connected: connects with jittered exponential backoff, watches for dropped
+# connections and reconnects, then calls on_resume so listeners can be restarted and the changes
+# made while offline sent. Tracks reconnect counts and time to recover.
+class Connection_Supervisor:
+    def __init__(self, device_client, on_resume=None, initial_backoff=1.0, max_backoff=60.0, check_interval=5.0):
+        self.device_client = device_client
+        self.on_resume = on_resume
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        self.state = "disconnected"
+        self.state_changed = None
+        self.disconnects = 0
+        self.reconnects = 0
+        self.connect_attempts = 0
+        self.recover_times = []
+
+    def connected(self):
+        return getattr(self.device_client, "connected", self.state == "connected")
+
+    def watch(self):
+        # Get notified by the client as soon as the connection state changes, on top of polling
+        self.state_changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def connection_state_changed():
+            loop.call_soon_threadsafe(self.state_changed.set)
+
+        try:
+            self.device_client.on_connection_state_change = connection_state_changed
+        except Exception:
+            pass
+
+    async def connect(self, max_attempts=None, retry_if=None):
+        # Returns once connected, retrying with jittered exponential backoff.
+        # Raises the last error after max_attempts failed attempts, when given, and right away for
+        # errors that retry_if(error) returns False for.
+        if self.state_changed is None:
+            self.watch()
+        attempt = 0
+        while True:
+            self.state = "connecting"
+            self.connect_attempts = self.connect_attempts + 1
+            try:
+                await self.device_client.connect()
+                self.state = "connected"
+                return
+            except Exception as e:
+                if (max_attempts is not None and attempt + 1 >= max_attempts) or (retry_if is not None and not retry_if(e)):
+                    self.state = "disconnected"
+                    raise
+                backoff = backoff_delay(attempt, self.initial_backoff, self.max_backoff)
+                logger.warning("Connection failed (%s), retrying in %.1f s", e, backoff)
+                self.state = "waiting"
+                attempt = attempt + 1
+                await asyncio.sleep(backoff)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.state_changed.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.state_changed.clear()
+            if self.connected():
+                continue
+            self.disconnects = self.disconnects + 1
+            logger.warning("Connection to Azure IoT lost, reconnecting...")
+            dropped = time.monotonic()
+            await self.connect()
+            self.reconnects = self.reconnects + 1
+            self.recover_times.append(time.monotonic() - dropped)
+            logger.info("Reconnected to Azure IoT after %.1f s", self.recover_times[-1])
+            if self.on_resume is not None:
+                await self.on_resume()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "disconnects": self.disconnects,
+            "reconnects": self.reconnects,
+            "connect_attempts": self.connect_attempts,
+            "avg_time_to_recover_s": sum(self.recover_times) / len(self.recover_times) if self.recover_times else 0.0,
+            "max_time_to_recover_s": max(self.recover_times) if self.recover_times else 0.0
+            }
+
+# Local control API on a Unix domain socket, served from the main event loop.
+# Each line is a command, either as words ("send 100 20") or as a JSON object
+# ({"command": "send", "count": 100, "rate": 20}), and gets a one line JSON reply.
+# Several clients can be connected at the same time.
+class Control_Server:
+    def __init__(self, path):
+        self.path = path
+        self.commands = {}
+        self.server = None
+        self.clients = {}
+        self.handled_commands = 0
+        self.register("help", self.help)
+
+    def register(self, name, handler, params=()):
+        # params is a list of (name, type) used to read the positional words of a line command
+        self.commands[name] = (handler, params)
+
+    async def help(self):
+        return {name: [param for param, _ in params] for name, (_, params) in self.commands.items()}
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_client, self.path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            # Close the connections first, then cancel the client tasks, so that a client waiting
+            # on a long command (a send of many messages) doesn't hold up the shutdown
+            tasks = list(self.clients)
+            for writer in self.clients.values():
+                writer.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def parse(self, line):
+        if line.startswith("{"):
+            args = json.loads(line)
+            name = args.pop("command")
+        else:
+            words = line.split()
+            name = words[0].lower()
+            args = {}
+            if name in self.commands:
+                params = self.commands[name][1]
+                if len(words) - 1 > len(params):
+                    raise ValueError(name + " takes at most " + str(len(params)) + " arguments")
+                for (param, _), word in zip(params, words[1:]):
+                    args[param] = word
+        if name not in self.commands:
+            raise ValueError("unknown command " + name)
+        handler, params = self.commands[name]
+        types = dict(params)
+        for param in args:
+            if param not in types:
+                raise ValueError("unknown argument " + param + " for " + name)
+            args[param] = types[param](args[param])
+        return handler, args
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.clients[task] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode("utf-8").strip()
+                if not line:
+                    continue
+                try:
+                    handler, args = self.parse(line)
+                    reply = {"ok": True, "result": await handler(**args)}
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                self.handled_commands = self.handled_commands + 1
+                writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # stop() cancels the clients; ending normally keeps asyncio from logging the cancelled task
+            pass
+        finally:
+            del self.clients[task]
+            writer.close()
+
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "on", "yes")
+    return bool(value)
+
+# Local console commands, read on the event loop rather than from a thread blocked in input(), so
+# that quitting from the control socket doesn't leave a thread in the middle of reading stdin.
+# handle(line) is awaited for each line, and returns True to stop reading (the quit command).
+# A console that can't be polled (a regular file or /dev/null) is read line by line instead.
+class Console_Reader:
+    def __init__(self, prompt, handle, stream=None):
+        self.prompt = prompt
+        self.handle = handle
+        self.stream = stream if stream is not None else sys.stdin
+        self.lines = asyncio.Queue()
+        self.buffer = b""
+        self.fd = None
+        self.polled = False
+        self.task = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            fd = self.stream.fileno()
+            loop.add_reader(fd, self.on_readable)
+            self.fd = fd
+            self.polled = True
+        except (AttributeError, OSError, ValueError, NotImplementedError):
+            self.polled = False
+        self.task = asyncio.create_task(self.run())
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            # End of input, e.g. when running as a service: use the control socket instead
+            self.remove_reader()
+            if self.buffer:
+                self.lines.put_nowait(self.buffer.decode("utf-8", "replace"))
+            self.lines.put_nowait(None)
+            return
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            self.lines.put_nowait(line.decode("utf-8", "replace"))
+
+    def remove_reader(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            self.fd = None
+
+    async def readline(self):
+        if not self.polled:
+            line = self.stream.readline()
+            return line if line else None
+        return await self.lines.get()
+
+    async def run(self):
+        try:
+            while True:
+                print(self.prompt, end="", flush=True)
+                line = await self.readline()
+                if line is None or await self.handle(line.strip()):
+                    break
+        finally:
+            self.remove_reader()
+
+    async def stop(self):
+        self.remove_reader()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+# Runs each direct method request in its own task using handlers registered by method name.
+# Every method has its own timeout and limit of concurrent calls, unknown methods get a 404,
+# handlers raise a ValueError for an invalid payload, which gets a 400, and request to response
+# latency is recorded per method.
+class Method_Router:
+    def __init__(self, device_client):
+        # The SDK is slow to import, it is only imported once there is a device client, see import_sdk()
+        from azure.iot.device import MethodResponse
+        self.method_response = MethodResponse
+        self.device_client = device_client
+        self.handlers = {}
+        self.latencies = {}
+        self.tasks = set()
+
+    def register(self, name, handler, timeout=10.0, max_concurrent=1):
+        # handler is an async function taking the request payload and returning the response payload
+        self.handlers[name] = (handler, timeout, asyncio.Semaphore(max_concurrent))
+
+    async def run_handler(self, method_request):
+        handler, timeout, semaphore = self.handlers[method_request.name]
+
+        async def run():
+            async with semaphore:
+                return await handler(method_request.payload)
+
+        try:
+            response_payload = await asyncio.wait_for(run(), timeout)
+            logger.info("Executed method %s", method_request.name)
+            return 200, response_payload
+        except asyncio.TimeoutError:
+            logger.warning("Method %s timed out", method_request.name)
+            return 504, {"result": False, "data": "method timed out"}
+        except ValueError as e:
+            logger.warning("Method %s got an invalid payload: %s", method_request.name, e)
+            return 400, {"result": False, "data": str(e)}
+        except Exception as e:
+            logger.error("Method %s failed: %s", method_request.name, e)
+            return 500, {"result": False, "data": str(e)}
+
+    async def dispatch(self, method_request):
+        start = time.monotonic()
+        if method_request.name in self.handlers:
+            response_status, response_payload = await self.run_handler(method_request)
+        else:
+            logger.warning("Received unknown method: %s", method_request.name)
+            response_status, response_payload = 404, {"result": False, "data": "unknown method"}
+        method_response = self.method_response.create_from_method_request(
+            method_request, response_status, response_payload
+        )
+        try:
+            await self.device_client.send_method_response(method_response)  # send response
+        except Exception as e:
+            logger.warning("Sending the response of method %s failed: %s", method_request.name, e)
+            return
+        self.record_latency(method_request.name if method_request.name in self.handlers else "unknown", time.monotonic() - start)
+
+    def record_latency(self, name, latency):
+        stats = self.latencies.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stats["count"] = stats["count"] + 1
+        stats["total_ms"] = stats["total_ms"] + latency * 1000
+        stats["max_ms"] = max(stats["max_ms"], latency * 1000)
+
+    def stats(self):
+        return {
+            name: {"count": stats["count"], "avg_ms": stats["total_ms"] / stats["count"], "max_ms": stats["max_ms"]}
+            for name, stats in self.latencies.items()
+            }
+
+    async def listen(self):
+        try:
+            while True:
+                method_request = await self.device_client.receive_method_request()
+                task = asyncio.ensure_future(self.dispatch(method_request))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+
+def printjson(obj):
+    # Pretty printing a whole twin is expensive, so it is only done when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", json.dumps(obj, indent=2, sort_keys=True))
+
+# Sends reported properties as deltas against the last state acknowledged by the hub.
+# Calls to report() within window seconds are merged into a single patch_twin_reported_properties call.
+# state is a function returning the whole reported properties of the device.
+class Twin_Reporter:
+    def __init__(self, device_client, state, window=0.5):
+        self.device_client = device_client
+        self.state = state
+        self.window = window
+        self.acknowledged = {}
+        self.timer = None
+        self.lock = asyncio.Lock()
+        self.requests = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.full_bytes = 0
+
+    def current_state(self):
+        return self.state()
+
+    def report(self):
+        # Schedule a report, merged with any other report requested within the window
+        self.requests = self.requests + 1
+        if self.timer is None or self.timer.done():
+            self.timer = asyncio.ensure_future(self.report_after_window())
+
+    def acknowledge(self, reported_properties):
+        # Reported properties the hub already has, e.g. from get_twin(), don't need to be sent again
+        self.acknowledged.update({key: value for key, value in reported_properties.items() if not key.startswith("$")})
+
+    async def report_after_window(self):
+        await asyncio.sleep(self.window)
+        self.timer = None
+        await self.send_changes()
+
+    async def flush(self):
+        # Send pending changes right away, e.g. at startup or before disconnecting
+        self.requests = self.requests + 1
+        if self.timer is not None and not self.timer.done():
+            self.timer.cancel()
+        self.timer = None
+        await self.send_changes()
+
+    async def send_changes(self):
+        async with self.lock:
+            state = self.current_state()
+            reported_properties = {key: value for key, value in state.items() if self.acknowledged.get(key, self) != value}
+            if not reported_properties:
+                return
+            try:
+                await self.device_client.patch_twin_reported_properties(reported_properties)
+            except Exception as e:
+                # Changes stay pending and go out with the next report
+                logger.warning("Failed to update Device Twin's reported properties: %s", e)
+                return
+            self.acknowledged.update(reported_properties)
+            self.round_trips = self.round_trips + 1
+            self.bytes_sent = self.bytes_sent + len(json.dumps(reported_properties))
+            self.full_bytes = self.full_bytes + len(json.dumps(state))
+            logger.info("Updated %d Device Twin's reported properties", len(reported_properties))
+            printjson(reported_properties)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "round_trips": self.round_trips,
+            "round_trips_saved": self.requests - self.round_trips,
+            "bytes_sent": self.bytes_sent,
+            "bytes_saved": self.full_bytes - self.bytes_sent
+            }
+
+# Last applied desired properties and their $version, kept on disk so that the leds show the
+# desired state at boot before the network is up, and only what changed while the device was
+# offline has to be applied after connecting.
+class Desired_State_Snapshot:
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.desired = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+            self.version = snapshot["version"]
+            self.desired = dict(snapshot["desired"])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.version = None
+            self.desired = {}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "desired": self.desired}, f)
+        os.replace(tmp_path, self.path)
+
+    def update(self, patch, version=None):
+        # Merges a desired properties patch, a None value removes the property
+        for key, value in patch.items():
+            if key.startswith("$"):
+                continue
+            if value is None:
+                self.desired.pop(key, None)
+            else:
+                self.desired[key] = value
+        if version is not None:
+            self.version = version
+        self.save()
+
+    def replace(self, desired, version=None):
+        # Takes the desired properties of a full twin, which drops the ones removed from the twin
+        self.desired = {key: value for key, value in desired.items() if not key.startswith("$") and value is not None}
+        if version is not None:
+            self.version = version
+        self.save()
+
+    def changes(self, desired):
+        # Desired properties of a full twin that differ from the snapshot
+        return {
+            key: value for key, value in desired.items()
+            if not key.startswith("$") and value is not None and self.desired.get(key) != value
+            }
+
+def restore_desired_state(led_manager, desired_snapshot, apply):
+    # Sets the leds from the snapshot, starting from default leds. apply(desired) applies desired
+    # properties to the leds. Returns False if there is nothing to restore.
+    if desired_snapshot is None or not desired_snapshot.desired:
+        return False
+    led_manager.set_all_leds_off()
+    for led in led_manager.leds:
+        led.set_color(255, 255, 255)
+        led.set_blink(False)
+    apply(desired_snapshot.desired)
+    return True
+
+# One get_twin call after connecting: applies the desired properties that changed while the device
+# was offline and saves the twin's desired properties as the snapshot. apply(changes) applies desired properties and returns
+# (version, unknown, rejected). The twin listeners are started before, so a patch received while
+# get_twin runs is not lost, and a twin older than the snapshot is not applied over it.
+# Returns the reported properties the hub already has, or None when get_twin failed.
+async def reconcile_desired_state(device_client, desired_snapshot, apply):
+    try:
+        twin = await device_client.get_twin()
+    except Exception as e:
+        logger.warning("Could not get the Device Twin, keeping the local state: %s", e)
+        return None
+    desired = twin.get("desired", {})
+    version = desired.get("$version")
+    newer = desired_snapshot is None or version is None or desired_snapshot.version is None or version > desired_snapshot.version
+    if desired_snapshot is None:
+        changes = {key: value for key, value in desired.items() if not key.startswith("$") and value is not None}
+    elif not newer:
+        changes = {}
+    else:
+        changes = desired_snapshot.changes(desired)
+    if changes:
+        _, unknown, rejected = apply(changes)
+        if unknown:
+            logger.warning("Ignored unknown desired properties: %s", ", ".join(unknown))
+        if rejected:
+            logger.warning("Rejected invalid desired properties: %s", ", ".join(rejected))
+    logger.info("Reconciled desired properties version %s, %d changed", version, len(changes))
+    if desired_snapshot is not None and newer:
+        desired_snapshot.replace(desired, version)
+    return twin.get("reported", {})
+
+# Converts a desired led property value to the type of its field, or returns None when it isn't valid.
+# Flags (status, blink) must be True or False, colors integers from 0 to 255 and other integers fit
+# in 32 bits. JSON numbers like 2.0 are accepted as 2.
+def coerce_led_value(field, value, kind=None):
+    if kind is None:
+        kind = bool if field in ("status", "blink") else int
+    if kind is bool:
+        return value if value is True or value is False else None
+    if value.__class__ is float and value.is_integer():
+        value = int(value)
+    if value.__class__ is not int:
+        return None
+    low, high = (0, 255) if field in ("r", "g", "b") else (-2**31, 2**31 - 1)
+    return value if low <= value <= high else None
+
+# Compact twin form of the whole strip, in three properties whatever the number of leds:
+# leds_rgb packs the colors as 6 hex digits per led, leds_on and leds_blink are hex bitmasks
+# where bit i is led i+1. With a Led_Effects engine (effects), the values are packed from and
+# unpacked into its arrays instead of going through the Led objects.
+compact_led_fields = {"leds_rgb": None, "leds_on": "status", "leds_blink": "blink"}
+
+def pack_compact_leds(leds, name, effects=None):
+    field = compact_led_fields[name]
+    if effects is not None:
+        if field is None:
+            return effects.colors.tobytes().hex()
+        packed = effects.np.packbits(getattr(effects, field), bitorder="little").tobytes()
+        return format(int.from_bytes(packed, "little"), "x")
+    if field is None:
+        return "".join("%02x%02x%02x" % (led.r, led.g, led.b) for led in leds)
+    return format(sum(1 << i for i, led in enumerate(leds) if getattr(led, field)), "x")
+
+def set_compact_leds(leds, name, value, effects=None):
+    # Returns False when the value can't be decoded
+    field = compact_led_fields[name]
+    try:
+        if field is None:
+            rgb = bytes.fromhex(value)
+        else:
+            mask = int(value, 16)
+    except (TypeError, ValueError):
+        return False
+    if field is None:
+        count = min(len(rgb) // 3, len(leds))
+        if effects is not None:
+            effects.colors[:count] = effects.np.frombuffer(rgb, dtype=effects.np.uint8, count=count * 3).reshape(count, 3)
+            return True
+        for i in range(count):
+            leds[i].set_color(rgb[i * 3], rgb[i * 3 + 1], rgb[i * 3 + 2])
+        return True
+    if mask < 0:
+        return False
+    if effects is not None:
+        np = effects.np
+        count = len(leds)
+        packed = np.frombuffer((mask & ((1 << count) - 1)).to_bytes((count + 7) // 8, "little"), dtype=np.uint8)
+        getattr(effects, field)[:] = np.unpackbits(packed, count=count, bitorder="little").astype(bool)
+        return True
+    for i, led in enumerate(leds):
+        setattr(led, field, bool(mask >> i & 1))
+    return True
@@ -0,0 +1,118 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Device key derivation for DPS group enrollments with symmetric keys.
+# Used by IoTCentralClient.py for a single device, and as a command line tool to derive the keys
+# of many registration IDs at once:
+#   python DeviceKeys.py registration_ids.txt --output device_keys.csv
+#   cat registration_ids.txt | python DeviceKeys.py --format jsonl
+
+import os
+import sys
+import argparse
+import base64
+import collections
+import hmac
+import hashlib
+import json
+import multiprocessing
+
+def derive_device_key(device_id, group_symmetric_key):
+    """
+    The unique device ID and the group master key should be encoded into "utf-8"
+    After this the encoded group master key must be used to compute an HMAC-SHA256 of the encoded registration ID.
+    Finally the result must be converted into Base64 format.
+    The device key is the "utf-8" decoding of the above result.
+    """
+    message = device_id.encode("utf-8")
+    signing_key = base64.b64decode(group_symmetric_key.encode("utf-8"))
+    signed_hmac = hmac.HMAC(signing_key, message, hashlib.sha256)
+    device_key_encoded = base64.b64encode(signed_hmac.digest())
+    return device_key_encoded.decode("utf-8")
+
+# HMAC keyed with the decoded group key, set once in each worker process and copied for every device
+worker_hmac = None
+
+def init_worker(group_symmetric_key):
+    global worker_hmac
+    signing_key = base64.b64decode(group_symmetric_key.encode("utf-8"))
+    worker_hmac = hmac.HMAC(signing_key, None, hashlib.sha256)
+
+def derive_chunk(registration_ids):
+    """
+    Same result as derive_device_key for each registration ID, without decoding the group key
+    and setting up the HMAC key again for every device.
+    """
+    device_keys = []
+    for registration_id in registration_ids:
+        signed_hmac = worker_hmac.copy()
+        signed_hmac.update(registration_id.encode("utf-8"))
+        device_keys.append(base64.b64encode(signed_hmac.digest()).decode("utf-8"))
+    return registration_ids, device_keys
+
+def read_chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        registration_id = line.strip()
+        if registration_id:
+            chunk.append(registration_id)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def derive_device_keys(lines, group_symmetric_key, workers=None, chunk_size=1000):
+    """
+    Yields (registration_id, device_key) for each non empty line, in input order.
+    Chunks of registration IDs are spread over a pool of worker processes, with a bounded number of
+    chunks in flight so that the input is streamed instead of being read in memory all at once.
+    """
+    workers = workers or os.cpu_count() or 1
+    with multiprocessing.Pool(workers, init_worker, (group_symmetric_key,)) as pool:
+        in_flight = collections.deque()
+        for chunk in read_chunks(lines, chunk_size):
+            in_flight.append(pool.apply_async(derive_chunk, (chunk,)))
+            if len(in_flight) >= workers * 2:
+                registration_ids, device_keys = in_flight.popleft().get()
+                yield from zip(registration_ids, device_keys)
+        while in_flight:
+            registration_ids, device_keys = in_flight.popleft().get()
+            yield from zip(registration_ids, device_keys)
+
+def write_device_keys(output, device_keys, output_format="csv"):
+    count = 0
+    for registration_id, device_key in device_keys:
+        if output_format == "jsonl":
+            output.write(json.dumps({"registrationId": registration_id, "deviceKey": device_key}) + "\n")
+        else:
+            output.write(registration_id + "," + device_key + "\n")
+        count = count + 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Derive DPS device keys from a group enrollment key")
+    parser.add_argument("input", nargs="?", default="-", help="file with one registration ID per line, - for stdin")
+    parser.add_argument("--output", default="-", help="output file, - for stdout")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="output format")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="registration IDs per work item")
+    args = parser.parse_args()
+
+    group_symmetric_key = os.getenv("PROVISIONING_MASTER_SYMMETRIC_KEY")
+    if not group_symmetric_key:
+        print("Set PROVISIONING_MASTER_SYMMETRIC_KEY to the group enrollment key", file=sys.stderr)
+        sys.exit(1)
+
+    input_file = sys.stdin if args.input == "-" else open(args.input)
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    with input_file, output_file:
+        count = write_device_keys(
+            output_file,
+            derive_device_keys(input_file, group_symmetric_key, args.workers, args.chunk_size),
+            args.format
+        )
+    print("Derived %d device keys" % count, file=sys.stderr)
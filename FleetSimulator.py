@@ -0,0 +1,216 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Runs many virtual devices in one process to load test the device code without hardware.
+# Each virtual device is a Device_App from IoTHubClient.py with its own leds, twin and method
+# handlers, connected to an in-process fake hub instead of Azure IoT Hub.
+
+import os
+import asyncio
+import argparse
+import contextlib
+import random
+import time
+import tracemalloc
+
+os.environ.setdefault("LED_BACKEND", "sim")
+from DeviceCommon import Led_Manager
+from IoTHubClient import Device_App
+from azure.iot.device import MethodRequest
+
+# In-process stand-in for IoT Hub: counts telemetry and measures twin and method round trips.
+# failure_rate is the share of calls that fail with a ConnectionError after the round trip.
+class Fake_Hub:
+    def __init__(self, latency=0.05, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failures = 0
+        self.clients = {}
+        self.messages = 0
+        self.pending_desired = {}
+        self.reported_state = {}
+        self.twin_latencies = []
+        self.pending_methods = {}
+        self.method_latencies = []
+        self.next_request_id = 1
+
+    def create_client(self, device_id):
+        client = FakeIoTHubDeviceClient(self, device_id)
+        self.clients[device_id] = client
+        return client
+
+    async def network(self):
+        # Simulated round trip, jittered by +/- 20%
+        await asyncio.sleep(self.latency * random.uniform(0.8, 1.2))
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failures = self.failures + 1
+            raise ConnectionError("simulated network failure")
+
+    def update_desired(self, device_id, patch):
+        pending = self.pending_desired.setdefault(device_id, {})
+        reported_state = self.reported_state.get(device_id, {})
+        now = time.monotonic()
+        for key, value in patch.items():
+            # Values the device already reports won't show up in its next delta report
+            if key != "$version" and reported_state.get(key) != value:
+                pending[key] = (value, now)
+        self.clients[device_id].desired_patches.put_nowait(patch)
+
+    def reported(self, device_id, reported_properties):
+        self.reported_state.setdefault(device_id, {}).update(reported_properties)
+        pending = self.pending_desired.get(device_id, {})
+        now = time.monotonic()
+        for key, value in reported_properties.items():
+            if key in pending and pending[key][0] == value:
+                self.twin_latencies.append(now - pending.pop(key)[1])
+
+    def invoke_method(self, device_id, name, payload=None):
+        request_id = str(self.next_request_id)
+        self.next_request_id = self.next_request_id + 1
+        self.pending_methods[request_id] = time.monotonic()
+        self.clients[device_id].method_requests.put_nowait(MethodRequest(request_id, name, payload))
+
+    def method_response(self, method_response):
+        start = self.pending_methods.pop(method_response.request_id, None)
+        if start is not None:
+            self.method_latencies.append(time.monotonic() - start)
+
+# Fake IoTHubDeviceClient with the subset of the API used by Device_App
+class FakeIoTHubDeviceClient:
+    def __init__(self, hub, device_id):
+        self.hub = hub
+        self.device_id = device_id
+        self.connected = False
+        self.failing_connects = 0
+        self.on_connection_state_change = None
+        self.desired_patches = asyncio.Queue()
+        self.method_requests = asyncio.Queue()
+
+    async def connect(self):
+        await self.hub.network()
+        if self.failing_connects > 0:
+            self.failing_connects = self.failing_connects - 1
+            raise ConnectionError("simulated connection failure")
+        self.connected = True
+
+    def drop(self, failing_connects=0):
+        # Simulates a network outage: the connection is lost and the next connects fail
+        self.connected = False
+        self.failing_connects = failing_connects
+        if self.on_connection_state_change is not None:
+            self.on_connection_state_change()
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def send_message(self, msg):
+        await self.hub.network()
+        if not self.connected:
+            raise ConnectionError("not connected")
+        self.hub.messages = self.hub.messages + 1
+
+    async def patch_twin_reported_properties(self, reported_properties):
+        await self.hub.network()
+        if not self.connected:
+            raise ConnectionError("not connected")
+        self.hub.reported(self.device_id, reported_properties)
+
+    async def receive_twin_desired_properties_patch(self):
+        return await self.desired_patches.get()
+
+    async def receive_method_request(self):
+        return await self.method_requests.get()
+
+    async def get_twin(self):
+        await self.hub.network()
+        return {"desired": {"$version": 1}, "reported": dict(self.hub.reported_state.get(self.device_id, {}))}
+
+    async def shutdown(self):
+        self.connected = False
+
+    async def send_method_response(self, method_response):
+        await self.hub.network()
+        self.hub.method_response(method_response)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+async def send_telemetry(device_app, rate, end):
+    # Spread the first message of each device over one period
+    await asyncio.sleep(random.uniform(0, 1 / rate))
+    i = 0
+    while time.monotonic() < end:
+        await device_app.send_test_message(i % 8)
+        i = i + 1
+        await asyncio.sleep(1 / rate)
+
+async def drive_twins_and_methods(hub, device_ids, interval, end):
+    version = 1
+    while time.monotonic() < end:
+        await asyncio.sleep(interval)
+        version = version + 1
+        for device_id in device_ids:
+            led = random.randrange(1, 9)
+            hub.update_desired(device_id, {
+                "led" + str(led) + "_status": True,
+                "led" + str(led) + "_r": random.randrange(0, 256),
+                "$version": version
+                })
+            hub.invoke_method(device_id, random.choice(["TurnLedsOff", "ScrollLeds"]))
+
+async def run_fleet(devices, duration, rate, latency, patch_interval):
+    hub = Fake_Hub(latency)
+    device_ids = ["sim-%05d" % i for i in range(devices)]
+
+    # Memory used per device, including its connected listeners and queues
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    device_apps = [Device_App(hub.create_client(device_id), device_id, Led_Manager()) for device_id in device_ids]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        await asyncio.gather(*[device_app.start() for device_app in device_apps])
+    per_device = (tracemalloc.get_traced_memory()[0] - before) / devices
+    tracemalloc.stop()
+
+    start = time.monotonic()
+    end = start + duration
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        await asyncio.gather(
+            drive_twins_and_methods(hub, device_ids, patch_interval, end),
+            *[send_telemetry(device_app, rate, end) for device_app in device_apps]
+            )
+        elapsed = time.monotonic() - start
+        await asyncio.gather(*[device_app.stop() for device_app in device_apps])
+
+    return {
+        "devices": devices,
+        "duration_s": elapsed,
+        "messages": hub.messages,
+        "messages_per_s": hub.messages / elapsed,
+        "twin_round_trips": len(hub.twin_latencies),
+        "twin_rtt_avg_ms": sum(hub.twin_latencies) / len(hub.twin_latencies) * 1000 if hub.twin_latencies else 0.0,
+        "twin_rtt_p95_ms": percentile(hub.twin_latencies, 0.95) * 1000,
+        "method_calls": len(hub.method_latencies),
+        "method_rtt_avg_ms": sum(hub.method_latencies) / len(hub.method_latencies) * 1000 if hub.method_latencies else 0.0,
+        "method_rtt_p95_ms": percentile(hub.method_latencies, 0.95) * 1000,
+        "memory_per_device_kb": per_device / 1024
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run virtual devices against an in-process fake IoT Hub")
+    parser.add_argument("--devices", type=int, default=100, help="number of virtual devices")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run the load")
+    parser.add_argument("--rate", type=float, default=1, help="telemetry messages per second per device")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated network round trip in seconds")
+    parser.add_argument("--patch-interval", type=float, default=5, help="seconds between desired property patches and method calls")
+    args = parser.parse_args()
+
+    print("Starting %d virtual devices for %.0f s..." % (args.devices, args.duration))
+    results = asyncio.run(run_fleet(args.devices, args.duration, args.rate, args.latency, args.patch_interval))
+    for key, value in results.items():
+        print("%-22s %s" % (key, round(value, 2) if isinstance(value, float) else value))
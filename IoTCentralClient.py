@@ -4,45 +4,80 @@
 # license information.
 # --------------------------------------------------------------------------
 
+import time
+boot_started = time.monotonic()
+
 import os
 import asyncio
-import concurrent.futures
 import uuid
-import time
-import threading
-import functools
 import json
-import base64
-import hmac
-import hashlib
+import marshal
+import zlib
 import sys
 import random
+import socket
 
+from DeviceCommon import import_sdk, Boot_Timeline, logger, setup_logging, Connection_Supervisor, backoff_delay
+from DeviceCommon import Control_Server, Console_Reader, parse_bool, Method_Router, Twin_Reporter, printjson
+from DeviceCommon import Desired_State_Snapshot, restore_desired_state, reconcile_desired_state
+from DeviceCommon import compact_led_fields, pack_compact_leds, set_compact_leds, coerce_led_value
+from DeviceCommon import create_led_manager
 
-from azure.iot.device.aio import IoTHubDeviceClient
-from azure.iot.device.aio import ProvisioningDeviceClient
-from azure.iot.device import Message
-from azure.iot.device import MethodResponse
+# The Azure IoT SDK classes, set by load_sdk()
+IoTHubDeviceClient = None
+ProvisioningDeviceClient = None
+Message = None
 
-from blinkt import set_pixel, set_brightness, show, clear
+def load_sdk():
+    import_sdk(globals())
 
-def derive_device_key(device_id, group_symmetric_key):
+from DeviceKeys import derive_device_key
+
+def load_registration_cache(cache_path, ttl):
+    """
+    Returns the (assigned_hub, device_id) saved by a previous DPS registration of this registration ID
+    in this ID scope, or None when there is no cache, it is unreadable or older than ttl seconds.
+    """
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache["registration_id"] != registration_id or cache["id_scope"] != id_scope:
+            return None
+        if time.time() - cache["registered_at"] > ttl:
+            return None
+        return cache["assigned_hub"], cache["device_id"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_registration_cache(cache_path, assigned_hub, device_id):
+    cache = {
+        "registration_id": registration_id,
+        "id_scope": id_scope,
+        "assigned_hub": assigned_hub,
+        "device_id": device_id,
+        "registered_at": time.time()
+    }
+    try:
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as e:
+        logger.warning("Could not cache the DPS registration: %s", e)
+
+def registration_invalid(error):
     """
-    The unique device ID and the group master key should be encoded into "utf-8"
-    After this the encoded group master key must be used to compute an HMAC-SHA256 of the encoded registration ID.
-    Finally the result must be converted into Base64 format.
-    The device key is the "utf-8" decoding of the above result.
+    Returns True when a connection error means the cached registration is no longer valid: the hub
+    rejects the device credentials, or its host name doesn't resolve anymore. Other errors, like a
+    network outage, are retried on the cached hub instead of provisioning again.
     """
-    message = device_id.encode("utf-8")
-    signing_key = base64.b64decode(group_symmetric_key.encode("utf-8"))
-    signed_hmac = hmac.HMAC(signing_key, message, hashlib.sha256)
-    device_key_encoded = base64.b64encode(signed_hmac.digest())
-    return device_key_encoded.decode("utf-8")
+    from azure.iot.device.exceptions import CredentialError
+    while error is not None:
+        if isinstance(error, (CredentialError, socket.gaierror)):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
 
 #======================================
-# To switch from PC to RPi, switch commented/un-commented sections below 
-#======================================
-from blinkt import set_pixel, set_brightness, show, clear
 provisioning_host = os.getenv("PROVISIONING_HOST")
 id_scope = os.getenv("PROVISIONING_IDSCOPE")
 registration_id = os.getenv("PROVISIONING_DEVICE_ID")
@@ -60,298 +95,480 @@ symmetric_key = derive_device_key(
 #     device_id=registration_id,
 #     group_symmetric_key=group_symmetric_key,
 # )
-# def set_pixel(i, r, g, b):
-#     time.sleep(0.1)
-# def set_brightness(b):
-#     time.sleep(0.1)
-# def show():
-#     time.sleep(0.1)
-# def clear():
-#     time.sleep(0.1)
 #======================================
 
 
-class Led:
-    status=False
-    blink=False
-    r=255
-    g=255
-    b=255
-
-    def __init__(self, r=255, g=255, b=255):
-        self.status = False
-        self.blink = False
-        self.r = r
-        self.g = g
-        self.b = b
-
-    def set_color(self, r,g,b):
-        self.r = r
-        self.g = g
-        self.b = b
-
-    def set_status(self, status):
-        self.status = status
-
-    def set_blink(self, yesno):
-        self.blink = yesno
-
-# list of leds
-class Led_Manager:
-    leds = []
-    scroll_leds = False
-
-    def __init__(self):
-        for i in range(8):
-            self.leds.append(Led())
-        set_brightness(0.1)
-
-
-    def set_all_leds_color(self, r, g, b):
-        for i in range(8):
-            self.leds[i].set_color(r, g, b)
-
-    def set_led(self, i, status, r, g, b, blk=False):
-        self.leds[i].set_color(r, g, b)
-        self.leds[i].set_status(status)
-        self.leds[i].blink=blk
-
-    def set_all_leds_off(self):
-        self.scroll_leds = False
-        for i in range(8):
-            self.leds[i].set_status(False)
-
-    def start_scrolling(self):
-        self.scroll_leds = True
-
-    def stop_scrolling(self):
-        self.scroll_leds = False
-
-    async def scroll_leds_task(self):
-        while True:
-            if (self.scroll_leds):
-                print("Scrolling leds")
-                for i in range(8):
-                    clear()
-                    set_pixel(i, self.leds[i].r, self.leds[i].g, self.leds[i].b)
-                    show()
-                    await asyncio.sleep(0.05)
-                clear()
-                show()
+# Device model compiled from IoTCentralModel.json, or from the file set in MODEL_FILE.
+# The DTDL interface is turned once into generated Python functions: one setter per writable led
+# property that validates and coerces the desired value, a builder for the reported properties and
+# a serializer for the telemetry fields. The compiled code is cached on disk, keyed by the model @id
+# and a checksum of this script, so later starts don't parse the JSON model again.
+# Led properties of the other schema, per led (ledN_status...) or compact (leds_rgb...), are accepted
+# even when the model doesn't have them, so that switching models keeps the existing desired properties.
+class Device_Model:
+    led_fields = ("status", "blink", "r", "g", "b")
+    compact_properties = tuple(compact_led_fields)
+
+    def __init__(self, model_path=None, cache_dir=None):
+        if model_path is None:
+            model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.getenv("MODEL_FILE", "IoTCentralModel.json"))
+        if cache_dir is None:
+            cache_dir = os.getenv("MODEL_CACHE_DIR", os.path.join(os.path.dirname(model_path), ".model_cache"))
+        self.model_path = model_path
+        self.cache_path = os.path.join(
+            cache_dir, os.path.basename(model_path) + "." + sys.implementation.cache_tag + ".marshal"
+            )
+        self.model_id, code = self.load()
+        namespace = {"pack_compact_leds": pack_compact_leds, "set_compact_leds": set_compact_leds, "coerce_led_value": coerce_led_value}
+        exec(code, namespace)
+        self.setters = namespace["setters"]
+        self.reported_properties = namespace["reported_properties"]
+        self.serialize_telemetry = namespace["serialize_telemetry"]
+
+    def load(self):
+        model_stat = os.stat(self.model_path)
+        # Code generated by another version of this script (and of generate_source) is compiled again
+        with open(os.path.abspath(__file__), "rb") as f:
+            generator = zlib.crc32(f.read())
+        cached = None
+        try:
+            with open(self.cache_path, "rb") as f:
+                cached = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        if cached is not None and (len(cached) != 5 or cached[3] != generator):
+            cached = None
+        if cached is not None and cached[1:3] == (model_stat.st_size, model_stat.st_mtime_ns):
+            return cached[0], cached[4]
+        with open(self.model_path) as f:
+            model = json.load(f)
+        interface = model[0] if isinstance(model, list) else model
+        if cached is not None and cached[0] == interface["@id"]:
+            # Same model version, only the file was touched
+            code = cached[4]
+        else:
+            logger.info("Compiling device model %s", interface["@id"])
+            code = compile(self.generate_source(interface), self.model_path, "exec")
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path + ".tmp", "wb") as f:
+                marshal.dump((interface["@id"], model_stat.st_size, model_stat.st_mtime_ns, generator, code), f)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        except OSError as e:
+            logger.warning("Could not cache compiled device model: %s", e)
+        return interface["@id"], code
+
+    def generate_source(self, interface):
+        lines = []
+        setters = []
+        reported = []
+        telemetry = []
+        for content in interface.get("contents", []):
+            types = content.get("@type")
+            types = types if isinstance(types, list) else [types]
+            name = content.get("name")
+            if "Property" in types and content.get("writable", False) and name in self.compact_properties:
+                function = "set_" + str(len(setters))
+                lines.append("def " + function + "(leds, value):")
+                lines.append("    return set_compact_leds(leds, %r, value)" % name)
+                setters.append("%r: %s" % (name, function))
+                reported.append("%r: pack_compact_leds(leds, %r)" % (name, name))
+            elif "Property" in types and content.get("writable", False):
+                led, _, field = name.partition("_")
+                if not led.startswith("led") or not led[3:].isdigit() or field not in self.led_fields:
+                    continue
+                i = int(led[3:]) - 1
+                function = "set_" + str(len(setters))
+                lines.append("def " + function + "(leds, value):")
+                kind = "bool" if content.get("schema") == "boolean" else "int"
+                lines.append("    value = coerce_led_value(%r, value, %s)" % (field, kind))
+                lines.append("    if value is None:")
+                lines.append("        return False")
+                lines.append("    leds[%d].%s = value" % (i, field))
+                lines.append("    return True")
+                setters.append("%r: %s" % (name, function))
+                reported.append("%r: leds[%d].%s" % (name, i, field))
+            elif "Telemetry" in types:
+                key = json.dumps(name)
+                schema = content.get("schema")
+                if schema in ("double", "float"):
+                    telemetry.append((name, "'%s: ' + repr(float(%s))" % (key, name)))
+                elif schema in ("integer", "long"):
+                    telemetry.append((name, "'%s: ' + str(int(%s))" % (key, name)))
+                elif schema == "geopoint":
+                    telemetry.append((name, "'%s: {\"lat\": ' + repr(float(%s[0])) + ', \"lon\": ' + repr(float(%s[1])) + '}'" % (key, name, name)))
+                else:
+                    telemetry.append((name, "'%s: ' + json.dumps(%s)" % (key, name)))
+        lines.append("setters = {" + ", ".join(setters) + "}")
+        lines.append("def reported_properties(leds):")
+        lines.append("    return {" + ", ".join(reported) + "}")
+        lines.append("def serialize_telemetry(" + ", ".join(name for name, _ in telemetry) + "):")
+        lines.append("    import json")
+        lines.append("    return '{' + " + " + ', ' + ".join(expression for _, expression in telemetry) + " + '}'")
+        return "\n".join(lines) + "\n"
+
+    def apply_patch(self, leds, patch):
+        # Returns the patch $version, the unknown keys and the keys whose value was rejected
+        version = None
+        unknown = []
+        rejected = []
+        for key, value in patch.items():
+            setter = self.setters.get(key)
+            if setter is not None:
+                if not setter(leds, value):
+                    rejected.append(key)
+            elif key == "$version":
+                version = value
             else:
-                await asyncio.sleep(.5)
-
-    async def update_leds_task(self):
-        new_status = locals()
-        for i in range(8):
-            new_status[i] = self.leds[i].status
-        while True:
-            if (not self.scroll_leds):
-                clear()
-                for i in range(8):
-                    if (self.leds[i].blink and self.leds[i].status):
-                        new_status[i] = not new_status[i]
-                    else:
-                        new_status[i]=self.leds[i].status
-                    if (new_status[i]):
-                        set_pixel(i, self.leds[i].r, self.leds[i].g, self.leds[i].b)
-                show()
-            await asyncio.sleep(.5)
-
-
-def printjson(obj):
-    parsed = json.dumps(obj)
-    loaded = json.loads(parsed)
-    print(json.dumps(loaded, indent=2, sort_keys=True))
-
-led_manager = Led_Manager()
+                applied = self.apply_undeclared(leds, key, value)
+                if applied is None:
+                    unknown.append(key)
+                elif not applied:
+                    rejected.append(key)
+        return version, unknown, rejected
+
+    def apply_undeclared(self, leds, key, value):
+        # Led property missing from the model: returns None if key isn't one, False if the value is invalid
+        if key in self.compact_properties:
+            return set_compact_leds(leds, key, value)
+        led, _, field = key.partition("_")
+        if not led.startswith("led") or not led[3:].isdigit() or field not in self.led_fields:
+            return None
+        i = int(led[3:]) - 1
+        if not 0 <= i < len(leds):
+            return None
+        value = coerce_led_value(field, value)
+        if value is None:
+            return False
+        setattr(leds[i], field, value)
+        return True
+
+led_manager = create_led_manager()
 
 async def main():
+    boot_timeline = Boot_Timeline(boot_started)
+    log_listener = setup_logging()
+
+    # Validators and serializers compiled from the IoT Central device model
+    device_model = Device_Model()
+    try:
+        device_model.reported_properties(led_manager.leds)
+    except IndexError:
+        # Leds past LED_COUNT are accepted as desired properties, but every led of the model has to exist
+        logger.error("The device model has more leds than LED_COUNT=%d", len(led_manager.leds))
+        log_listener.stop()
+        sys.exit(1)
         
     # Function for sending message
     async def send_test_message():
-            print("Sending telemetry message from device " + device_id)
-            body_dict = {}
-            body_dict['Temperature'] = random.randrange(76, 80, 1)
-            body_dict['Humidity'] = random.randrange(40, 60, 1)
-            body_dict['Location']='28.424911, -81.468962'
-            body_json = json.dumps(body_dict)
-            print(body_json)
+            logger.debug("Sending telemetry message from device %s", device_id)
+            body_json = device_model.serialize_telemetry(
+                Temperature=random.randrange(76, 80, 1),
+                Humidity=random.randrange(40, 60, 1),
+                Location=(28.424911, -81.468962)
+                )
+            logger.debug("%s", body_json)
             msg = Message(body_json)
             msg.message_id = uuid.uuid4()
             msg.correlation_id = "correlation-1234"
-            msg.contentEncoding="utf-8",
-            msg.contentType="application/json",
+            msg.content_encoding = "utf-8"
+            msg.content_type = "application/json"
             await device_client.send_message(msg)
-            print("Done sending message")
-
-    # update the reported properties
-    async def update_device_twin(device_client, led_manager):
-        reported_properties = {}
-        for i in range (8):
-            key='led'+ str(i+1) +'_status' 
-            reported_properties[key] = led_manager.leds[i].status
-            key='led'+ str(i+1) +'_blink' 
-            reported_properties[key] = led_manager.leds[i].blink
-            key='led'+ str(i+1) +'_r' 
-            reported_properties[key] = led_manager.leds[i].r
-            key='led'+ str(i+1) +'_g' 
-            reported_properties[key] = led_manager.leds[i].g
-            key='led'+ str(i+1) +'_b' 
-            reported_properties[key] = led_manager.leds[i].b
-        await device_client.patch_twin_reported_properties(reported_properties)
-        print("Updated Device Twin's reported properties:")
-        printjson(reported_properties)
+            logger.info("Done sending message")
+
+    async def send_messages(count=1, rate=0.0):
+        # send count messages, started at rate messages per second or all at once when rate is 0
+        sending = []
+        start = time.monotonic()
+        for i in range(count):
+            sending.append(asyncio.ensure_future(send_test_message()))
+            if rate > 0:
+                await asyncio.sleep(max(0, start + (i + 1) / rate - time.monotonic()))
+        results = await asyncio.gather(*sending, return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        return {"sent": count - len(failed), "failed": len(failed), "elapsed_s": time.monotonic() - start}
+
+    async def set_leds(index, r=255, g=255, b=255, blink=False, status=True):
+        # index is 1 based like the twin properties, 0 sets all the leds
+        if index < 0 or index > len(led_manager.leds):
+            raise ValueError("led index must be between 0 and " + str(len(led_manager.leds)))
+        for field, value in (("r", r), ("g", g), ("b", b)):
+            if coerce_led_value(field, value) is None:
+                raise ValueError(field + " must be an integer from 0 to 255")
+        for i in range(len(led_manager.leds)) if index == 0 else [index - 1]:
+            led_manager.set_led(i, status, r, g, b, blink)
+        twin_reporter.report()
+        return twin_reporter.current_state()
+
+    async def turn_leds_off(payload=None):
+        led_manager.set_all_leds_off()
+        twin_reporter.report()
+        return {"result": True, "data": "Leds are all off"}
+
+    async def scroll_leds(payload=None):
+        led_manager.set_all_leds_off()
+        led_manager.set_all_leds_color(255, 255, 255)
+        led_manager.start_scrolling()
+        twin_reporter.report()
+        return {"result": True, "data": "Leds are now scrolling"}
 
     # define behavior for receiving a twin patch
     async def twin_patch_listener(device_client, led_manager):
         while True:
             patch = await device_client.receive_twin_desired_properties_patch()  # blocking call
-            print("Received new device twin's desired properties:")
+            logger.info("Received new device twin's desired properties")
             printjson(patch)
-            for i in range (8):
-                led_status = led_manager.leds[i].status
-                led_blink = led_manager.leds[i].blink
-                led_r = led_manager.leds[i].r
-                led_g = led_manager.leds[i].g
-                led_b = led_manager.leds[i].b
-                key='led'+ str(i+1) +'_status'
-                if key in patch:
-                    led_status = patch[key]
-                key='led'+ str(i+1) +'_blink'
-                if key in patch:
-                    led_blink = patch[key]
-                key='led'+ str(i+1) +'_r' 
-                if key in patch:
-                    led_r = patch[key]
-                key='led'+ str(i+1) +'_g' 
-                if key in patch:
-                    led_g = patch[key]
-                key='led'+ str(i+1) +'_b' 
-                if key in patch:
-                    led_b = patch[key]
-                led_manager.set_led(i, led_status, led_r, led_g, led_b, led_blink)
-            await update_device_twin(device_client, led_manager)
-
-    async def direct_methods_listener(device_client, led_manager):
-        while True:
-            method_request = (
-                await device_client.receive_method_request()
-            )  # Wait for unknown method calls
-            
-            # Check which method was involked
-            if (method_request.name == "TurnLedsOff"):
-                # Turn all leds off
-                led_manager.set_all_leds_off()
-                response_payload = {"result": True, "data": "Leds are all off"}  # set response payload
-                response_status = 200  # set return status code
-                print("Executed method " + method_request.name)
-
-            elif (method_request.name == "ScrollLeds"):
-                # Set leds colors and start scrolling
-                led_manager.set_all_leds_off()
-                led_manager.set_all_leds_color(255, 255, 255)
-                led_manager.start_scrolling()
-                response_payload = {"result": True, "data": "Leds are now scrolling"}  # set response payload
-                response_status = 200  # set return status code
-                print("Executed method " + method_request.name)
-
-            else:
-                # Respond
-                response_payload = {"result": True, "data": "unknown method"}  # set response payload
-                response_status = 200  # set return status code
-                print("Executed unknown method: " + method_request.name)
-
-            method_response = MethodResponse.create_from_method_request(
-                method_request, response_status, response_payload
+            version, unknown, rejected = device_model.apply_patch(led_manager.leds, patch)
+            if unknown:
+                logger.warning("Ignored unknown desired properties: %s", ", ".join(unknown))
+            if rejected:
+                logger.warning("Rejected invalid desired properties: %s", ", ".join(rejected))
+            if desired_snapshot is not None:
+                desired_snapshot.update(patch, version)
+            twin_reporter.report()
+
+    # Catch up with the desired properties changed while offline, then send the reported
+    # properties the hub doesn't already have
+    async def reconcile_desired_twin():
+        reported = await reconcile_desired_state(
+            device_client, desired_snapshot,
+            lambda changes: device_model.apply_patch(led_manager.leds, changes)
             )
-            await device_client.send_method_response(method_response)  # send response
-
-    # Schedule tasks for Methods and twins updates
+        if reported is not None:
+            twin_reporter.acknowledge(reported)
+        await twin_reporter.flush()
+
+    # Show the last desired state if there is one, or that the device is booting, then load the
+    # SDK in a thread while the leds scroll
+    desired_snapshot = None
+    snapshot_file = os.getenv("TWIN_SNAPSHOT_FILE", "desired_state.json")
+    if snapshot_file:
+        desired_snapshot = Desired_State_Snapshot(snapshot_file)
+    restored = restore_desired_state(led_manager, desired_snapshot, lambda desired: device_model.apply_patch(led_manager.leds, desired))
+    if restored:
+        logger.info("Restored desired properties version %s", desired_snapshot.version)
+    else:
+        led_manager.set_all_leds_color(255, 128, 0)
+        led_manager.start_scrolling()
     led_listeners = asyncio.gather(
         led_manager.scroll_leds_task(),
         led_manager.update_leds_task()
         )
+    boot_timeline.mark("leds on")
+    await asyncio.get_running_loop().run_in_executor(None, load_sdk)
+    boot_timeline.mark("sdk import")
 
     # Thread pool Executor to execute async functions in sync task
     # pool = concurrent.futures.ThreadPoolExecutor()
 
     device_id = registration_id
-    print("Connecting device " + device_id)
-
-    # Connect the client.
-    print("Provisioning device to Azure IoT...")
-    led_manager.set_all_leds_color(0, 255, 0)
-    led_manager.start_scrolling()
+    logger.info("Connecting device %s", device_id)
+    startup_time = time.monotonic()
 
     # registration using DPS
-    provisioning_device_client = ProvisioningDeviceClient.create_from_symmetric_key(
-        provisioning_host=provisioning_host,
-        registration_id=registration_id,
-        id_scope=id_scope,
-        symmetric_key=symmetric_key
-    )
-
-    registration_result = await provisioning_device_client.register()
-
-    led_manager.set_all_leds_off()
+    async def provision():
+        logger.info("Provisioning device to Azure IoT...")
+        if not restored:
+            led_manager.set_all_leds_color(0, 255, 0)
+            led_manager.start_scrolling()
+
+        # DPS can't be reached during an outage either: retry with backoff instead of giving up
+        attempt = 0
+        while True:
+            provisioning_device_client = ProvisioningDeviceClient.create_from_symmetric_key(
+                provisioning_host=provisioning_host,
+                registration_id=registration_id,
+                id_scope=id_scope,
+                symmetric_key=symmetric_key
+            )
+            try:
+                registration_result = await provisioning_device_client.register()
+                break
+            except Exception as e:
+                backoff = backoff_delay(attempt, max_backoff=float(os.getenv("RECONNECT_MAX_BACKOFF", "60")))
+                logger.warning("Provisioning failed (%s), retrying in %.1f s", e, backoff)
+                attempt = attempt + 1
+                await asyncio.sleep(backoff)
+
+        if not restored:
+            led_manager.set_all_leds_off()
+
+        if registration_result.status == "assigned":
+            logger.info("Device successfully registered. Creating device client")
+            save_registration_cache(
+                registration_cache,
+                registration_result.registration_state.assigned_hub,
+                registration_result.registration_state.device_id
+            )
+            return registration_result.registration_state.assigned_hub, registration_result.registration_state.device_id
+        else:
+            led_manager.set_led(0, True, 255, 0, 0, True)
+            logger.error("Provisioning of the device failed.")
+            log_listener.stop()
+            sys.exit()
+
+    # After a reconnect, listen again and catch up with the twin
+    iothub_listeners = None
+    async def resume():
+        nonlocal iothub_listeners
+        if iothub_listeners is not None:
+            iothub_listeners.cancel()
+            try:
+                await iothub_listeners
+            except asyncio.CancelledError:
+                pass
+        iothub_listeners = start_iothub_listeners()
+        await reconcile_desired_twin()
+
+    def start_iothub_listeners():
+        # Schedule tasks for Methods and twins updates
+        return asyncio.gather(
+            method_router.listen(),
+            twin_patch_listener(device_client, led_manager)
+            )
 
-    if registration_result.status == "assigned":
-        print("Device successfully registered. Creating device client")
-        # Create device client from the above result
+    async def connect(assigned_hub, device_id, retry_if=None):
+        # Create device client from the registration and connect it.
+        # Reconnecting is handled by the Connection_Supervisor.
+        logger.info("Connecting to Azure IoT...")
+        if not restored:
+            led_manager.set_all_leds_color(0, 0, 255)
+            led_manager.start_scrolling()
         device_client = IoTHubDeviceClient.create_from_symmetric_key(
             symmetric_key=symmetric_key,
-            hostname=registration_result.registration_state.assigned_hub,
-            device_id=registration_result.registration_state.device_id,
+            hostname=assigned_hub,
+            device_id=device_id,
+            connection_retry=False
         )
-    else:
-        led_manager.set_led(0, true, 255, 0, 0, true)
-        print("Provisioning of the device failed.")
-        sys.exit()
-
-    # Connect the client.
-    print("Connecting to Azure IoT...")
-    led_manager.set_all_leds_color(0, 0, 255)
-    led_manager.start_scrolling()
-
-    await device_client.connect()
-    print("Device is connected to Azure IoT")
-    led_manager.set_all_leds_off()
-
-    # Update Device Twin reported properties
-    await update_device_twin(device_client, led_manager)
-    
-    # Schedule tasks for Methods and twins updates
-    iothub_listeners = asyncio.gather(
-        direct_methods_listener(device_client, led_manager),
-        twin_patch_listener(device_client, led_manager)
+        connection_supervisor = Connection_Supervisor(
+            device_client, resume,
+            max_backoff=float(os.getenv("RECONNECT_MAX_BACKOFF", "60"))
+            )
+        try:
+            await connection_supervisor.connect(retry_if=retry_if)
+        except Exception:
+            # Release the client's connection and threads before giving up on it
+            try:
+                await device_client.shutdown()
+            except Exception as e:
+                logger.warning("Shutting down the device client failed: %s", e)
+            raise
+        return device_client, connection_supervisor
+
+    # Connect straight to the hub from a previous registration, and only provision again
+    # when there is no recent registration or the hub rejects it
+    registration_cache = os.getenv("DPS_CACHE_FILE", "dps_registration.json")
+    registration = load_registration_cache(registration_cache, float(os.getenv("DPS_CACHE_TTL", str(7*24*3600))))
+    device_client = None
+    cached = registration is not None
+    if cached:
+        logger.info("Using cached registration to %s", registration[0])
+        try:
+            device_client, connection_supervisor = await connect(
+                registration[0], registration[1], lambda e: not registration_invalid(e)
+                )
+            boot_timeline.mark("connect")
+        except Exception as e:
+            logger.warning("The cached registration is no longer valid (%s), provisioning again", e)
+            cached = False
+            boot_timeline.mark("cached connect")
+    if device_client is None:
+        registration = await provision()
+        boot_timeline.mark("provisioning")
+        device_client, connection_supervisor = await connect(registration[0], registration[1])
+        boot_timeline.mark("connect")
+
+    logger.info("Device is connected to Azure IoT")
+    # Direct methods, unknown methods get a 404
+    method_router = Method_Router(device_client)
+    method_router.register("TurnLedsOff", turn_leds_off, timeout=5)
+    method_router.register("ScrollLeds", scroll_leds, timeout=5)
+    # Device Twin reported properties, updates after the first one only send what changed
+    twin_reporter = Twin_Reporter(
+        device_client, lambda: device_model.reported_properties(led_manager.leds),
+        window=float(os.getenv("TWIN_REPORT_WINDOW", "0.5"))
         )
+    logger.info("Connected in %.2f s %s", time.monotonic() - startup_time, "using cached registration" if cached else "after provisioning")
+    if not restored:
+        led_manager.set_all_leds_off()
+
+    # Listen before reading the twin, so that no patch is missed while reconciling
+    iothub_listeners = start_iothub_listeners()
+    await reconcile_desired_twin()
+    boot_timeline.mark("first twin report")
+    boot_timeline.report()
+
+    supervisor_task = asyncio.ensure_future(connection_supervisor.run())
+
+    quit_requested = asyncio.Event()
+
+    # Local control socket, for scripts and test harnesses
+    control_server = None
+    control_socket = os.getenv("CONTROL_SOCKET", "iotcentralclient.sock")
+    if control_socket:
+        control_server = Control_Server(control_socket)
+        control_server.register("send", send_messages, (("count", int), ("rate", float)))
+        control_server.register("leds", set_leds, (
+            ("index", int), ("r", int), ("g", int), ("b", int), ("blink", parse_bool), ("status", parse_bool)
+            ))
+        control_server.register("off", turn_leds_off)
+        control_server.register("scroll", scroll_leds)
+        async def stats_command():
+            return {
+                "connection": connection_supervisor.stats(),
+                "direct_methods": method_router.stats(),
+                "reported_properties": twin_reporter.stats(),
+                "led_frames": led_manager.render_stats(),
+                "led_timing": led_manager.frame_clock.stats()
+                }
+        control_server.register("stats", stats_command)
+        async def quit_command():
+            quit_requested.set()
+        control_server.register("quit", quit_command)
+        await control_server.start()
+        logger.info("Listening for local commands on %s", control_socket)
 
     # define behavior for halting the application
-    def stdin_listener():
-        pool = concurrent.futures.ThreadPoolExecutor()
-        while True:
-            print("To control the leds from Azure IoT, you can send the following commands through Direct Methods: TurnLedsOff, ScrollLeds")
-            selection = input("Commands: \n   Q: quit\n   S: Send a telemetry message\n")
-            if selection == "Q" or selection == "q":
-                print("Quitting...")
-                break
-            elif selection == "S" or selection =="s":
-                # send 8 messages one after the other with a sleep
-                result = pool.submit(asyncio.run, send_test_message()).result()
+    async def console_command(selection):
+        if selection == "Q" or selection == "q":
+            quit_requested.set()
+            return True
+        elif selection == "S" or selection =="s":
+            try:
+                await send_test_message()
+            except Exception as e:
+                logger.warning("Sending the message failed: %s", e)
+
+    console = Console_Reader(
+        "To control the leds from Azure IoT, you can send the following commands through Direct Methods: TurnLedsOff, ScrollLeds\n"
+        "Commands: \n   Q: quit\n   S: Send a telemetry message\n",
+        console_command)
+    console.start()
 
-    loop = asyncio.get_running_loop()
-    user_finished = loop.run_in_executor(None, stdin_listener)
-  
     # Wait for user to indicate they are done listening for messages
-    await user_finished
+    await quit_requested.wait()
+    print("Quitting...")
+
+    await console.stop()
+    if control_server is not None:
+        await control_server.stop()
 
     # Cancel listening
+    supervisor_task.cancel()
     led_listeners.cancel()
     iothub_listeners.cancel()
 
+    # Send the pending reported properties before disconnecting
+    await twin_reporter.flush()
+    print("Connection: " + json.dumps(connection_supervisor.stats()))
+    print("Direct method latencies: " + json.dumps(method_router.stats()))
+    print("Reported properties updates: " + json.dumps(twin_reporter.stats()))
+    print("Led frames computed/pushed: " + json.dumps(led_manager.render_stats()))
+    print("Led animation timing: " + json.dumps(led_manager.frame_clock.stats()))
+
     # finally, disconnect
     await device_client.disconnect()
+    log_listener.stop()
 
 
 if __name__ == "__main__":
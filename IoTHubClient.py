@@ -4,328 +4,1418 @@
 # license information.
 # --------------------------------------------------------------------------
 
+import time
+boot_started = time.monotonic()
+
 import os
 import asyncio
-import concurrent.futures
 import uuid
-import time
-import threading
-import functools
 import json
-import base64
-import hmac
-import hashlib
+import gzip
+import struct
+import zlib
 import random
+import bisect
+import math
+import mmap
 
-from azure.iot.device.aio import IoTHubDeviceClient
-from azure.iot.device.aio import ProvisioningDeviceClient
-from azure.iot.device import Message
-from azure.iot.device import MethodResponse
+from DeviceCommon import import_sdk, Boot_Timeline, logger, setup_logging, Connection_Supervisor
+from DeviceCommon import Control_Server, Console_Reader, parse_bool, Method_Router, Twin_Reporter, printjson
+from DeviceCommon import Desired_State_Snapshot, restore_desired_state, reconcile_desired_state
+from DeviceCommon import compact_led_fields, pack_compact_leds, set_compact_leds, coerce_led_value
+from DeviceCommon import Frame_Clock, create_led_manager
+
+# The Azure IoT SDK classes, set by load_sdk()
+IoTHubDeviceClient = None
+Message = None
+
+def load_sdk():
+    import_sdk(globals())
 
 #======================================
-# To switch from PC to RPi, switch commented/un-commented sections below 
-#======================================
-from blinkt import set_pixel, set_brightness, show, clear
 conn_str = os.getenv("IOTHUB_DEVICE_CONNECTION_STRING")
 #======================================
 # conn_str = '<yourconnectionstring>'
-# def set_pixel(i, r, g, b):
-#     time.sleep(0.1)
-# def set_brightness(b):
-#     time.sleep(0.1)
-# def show():
-#     time.sleep(0.1)
-# def clear():
-#     time.sleep(0.1)
 #======================================
 
-class Led:
-    status=False
-    blink=False
-    r=255
-    g=255
-    b=255
+# Telemetry payload encodings. encode() returns the payload with its content type and content encoding.
+class Json_Codec:
+    name = "json"
 
-    def __init__(self, r=255, g=255, b=255):
-        self.status = False
-        self.blink = False
-        self.r = r
-        self.g = g
-        self.b = b
+    def encode(self, body):
+        return json.dumps(body), "application/json", "utf-8"
 
-    def set_color(self, r,g,b):
-        self.r = r
-        self.g = g
-        self.b = b
+# Compact binary encoding of Weather readings: Temperature and Humidity in hundredths as 16 bit
+# integers, and the location in millionths of a degree sent once per message, even for a batch.
+# Bodies that are not plain readings, like window summaries, are sent as JSON.
+class Binary_Codec:
+    name = "binary"
+    content_type = "application/x-rpizero-telemetry"
+    single = struct.Struct("<BhHii")
+    batch_header = struct.Struct("<BHii")
+    batch_reading = struct.Struct("<hH")
 
-    def set_status(self, status):
-        self.status = status
+    def __init__(self):
+        self.json_codec = Json_Codec()
 
-    def set_blink(self, yesno):
-        self.blink = yesno
+    def parse(self, body):
+        # Returns (temperature, humidity, latitude, longitude) or None when the body is not a plain reading
+        try:
+            if set(body) != {'Weather', 'Location'} or set(body['Weather']) != {'Temperature', 'Humidity'}:
+                return None
+            latitude, longitude = body['Location'].split(',')
+            return (
+                int(round(body['Weather']['Temperature'] * 100)),
+                int(round(body['Weather']['Humidity'] * 100)),
+                int(round(float(latitude) * 1000000)),
+                int(round(float(longitude) * 1000000))
+                )
+        except (TypeError, AttributeError, ValueError):
+            return None
 
-# list of leds
-class Led_Manager:
-    leds = []
-    scroll_leds = False
+    def fits(self, reading):
+        return -32768 <= reading[0] <= 32767 and 0 <= reading[1] <= 65535
 
-    def __init__(self):
-        for i in range(8):
-            self.leds.append(Led())
-        set_brightness(0.1)
+    def encode(self, body):
+        if isinstance(body, list):
+            readings = [self.parse(item) for item in body]
+            if (readings and None not in readings and all(self.fits(reading) for reading in readings)
+                    and len(set(reading[2:] for reading in readings)) == 1):
+                payload = bytearray(self.batch_header.pack(2, len(readings), readings[0][2], readings[0][3]))
+                for reading in readings:
+                    payload.extend(self.batch_reading.pack(reading[0], reading[1]))
+                return bytes(payload), self.content_type, None
+        else:
+            reading = self.parse(body)
+            if reading is not None and self.fits(reading):
+                return self.single.pack(1, reading[0], reading[1], reading[2], reading[3]), self.content_type, None
+        return self.json_codec.encode(body)
 
+    def decode(self, payload):
+        def reading(temperature, humidity, latitude, longitude):
+            return {
+                'Weather': {'Temperature': temperature / 100, 'Humidity': humidity / 100},
+                'Location': '%.6f, %.6f' % (latitude / 1000000, longitude / 1000000)
+                }
+        if payload[0] == 1:
+            return reading(*self.single.unpack(payload)[1:])
+        count, latitude, longitude = self.batch_header.unpack_from(payload)[1:]
+        return [
+            reading(*self.batch_reading.unpack_from(payload, self.batch_header.size + i * self.batch_reading.size), latitude, longitude)
+            for i in range(count)
+            ]
 
-    def set_all_leds_color(self, r, g, b):
-        for i in range(8):
-            self.leds[i].set_color(r, g, b)
+# JSON compressed with gzip or deflate. Single readings are too small to gain anything, so only
+# batches and bodies of at least min_size bytes are compressed.
+class Compressed_Codec:
+    def __init__(self, method="gzip", min_size=256):
+        self.name = method
+        self.method = method
+        self.min_size = min_size
 
-    def set_led(self, i, status, r, g, b, blk=False):
-        self.leds[i].set_color(r, g, b)
-        self.leds[i].set_status(status)
-        self.leds[i].blink=blk
+    def encode(self, body):
+        body_json = json.dumps(body)
+        if not isinstance(body, list) and len(body_json) < self.min_size:
+            return body_json, "application/json", "utf-8"
+        data = body_json.encode("utf-8")
+        if self.method == "gzip":
+            return gzip.compress(data, mtime=0), "application/json", "gzip"
+        return zlib.compress(data), "application/json", "deflate"
 
-    def set_all_leds_off(self):
-        self.scroll_leds = False
-        for i in range(8):
-            self.leds[i].set_status(False)
+def create_codec(name):
+    if name == "binary":
+        return Binary_Codec()
+    if name in ("gzip", "deflate"):
+        return Compressed_Codec(name)
+    if name != "json":
+        logger.warning("Unknown TELEMETRY_CODEC %r, sending JSON (json, binary, gzip or deflate)", name)
+    return Json_Codec()
 
-    def start_scrolling(self):
-        self.scroll_leds = True
+def create_message(body, alert=False, codec=None):
+    data, content_type, content_encoding = (codec or Json_Codec()).encode(body)
+    msg = Message(data)
+    msg.message_id = uuid.uuid4()
+    msg.correlation_id = "correlation-1234"
+    msg.custom_properties["Alert"] = "yes" if alert else "no"
+    msg.content_type = content_type
+    if content_encoding is not None:
+        msg.content_encoding = content_encoding
+    return msg
 
-    def stop_scrolling(self):
-        self.scroll_leds = False
+# Append only store-and-forward spool for readings that could not be sent.
+# Records are written to numbered segment files as <length><crc32><json payload>, a cursor file
+# remembers how far the spool has been drained, and the oldest segments are deleted when the
+# spool grows past max_bytes. Reading streams one record at a time from disk, and skips over a
+# corrupt record to the next valid one.
+# With sync set, appended records are flushed to disk with at most one fsync every sync_interval
+# seconds, run in a worker thread so that the event loop doesn't wait on the SD card.
+class Telemetry_Spool:
+    header = struct.Struct("<II")
 
-    async def scroll_leds_task(self):
-        while True:
-            if (self.scroll_leds):
-                print("Scrolling leds")
-                for i in range(8):
-                    clear()
-                    set_pixel(i, self.leds[i].r, self.leds[i].g, self.leds[i].b)
-                    show()
-                    await asyncio.sleep(0.05)
-                clear()
-                show()
+    def __init__(self, path, max_bytes=16*1024*1024, segment_bytes=1024*1024, sync=True, sync_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        # A segment larger than the whole spool could never be evicted
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.sync_pending = False
+        self.sync_task = None
+        self.syncs = 0
+        self.evicted_segments = 0
+        self.skipped_bytes = 0
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(
+            int(name[:-4]) for name in os.listdir(path) if name.endswith(".log") and name[:-4].isdigit()
+            )
+        if not self.segments:
+            self.segments = [1]
+        self.sizes = {}
+        for seq in self.segments:
+            self.sizes[seq] = os.path.getsize(self.segment_path(seq)) if os.path.exists(self.segment_path(seq)) else 0
+        self.cursor = self.read_cursor()
+        self.recover()
+        self.writer = open(self.segment_path(self.segments[-1]), "ab")
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, "%08d.log" % seq)
+
+    def read_cursor(self):
+        try:
+            with open(os.path.join(self.path, "cursor")) as f:
+                seq, offset = f.read().split()
+                seq, offset = int(seq), int(offset)
+        except (OSError, ValueError):
+            return (self.segments[0], 0)
+        if seq not in self.sizes:
+            return (self.segments[0], 0)
+        return (seq, offset)
+
+    def write_cursor(self):
+        cursor_path = os.path.join(self.path, "cursor")
+        with open(cursor_path + ".tmp", "w") as f:
+            f.write("%d %d" % self.cursor)
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(cursor_path + ".tmp", cursor_path)
+
+    def read_record(self, f, end):
+        # Returns the (body, alert) of the record at the position of f, or None when it is corrupt
+        header = f.read(self.header.size)
+        if len(header) < self.header.size:
+            return None
+        length, crc = self.header.unpack(header)
+        if length > end - f.tell():
+            return None
+        payload = f.read(length)
+        if zlib.crc32(payload) != crc:
+            return None
+        try:
+            body, alert = json.loads(payload)
+        except (ValueError, TypeError):
+            return None
+        return body, alert
+
+    def next_record(self, f, end):
+        # Returns the next valid record from the position of f, or None at the end of the segment.
+        # A corrupt record is skipped by looking for the next valid record one byte further on.
+        first = start = f.tell()
+        record = None
+        while record is None and start + self.header.size <= end:
+            f.seek(start)
+            record = self.read_record(f, end)
+            if record is None:
+                start = start + 1
+        skipped = (start if record is not None else end) - first
+        if skipped > 0:
+            self.skipped_bytes = self.skipped_bytes + skipped
+            logger.warning("Skipped %d corrupt bytes in the telemetry spool", skipped)
+        return record
+
+    def recover(self):
+        # Drop a record torn by a crash or power loss at the end of the last segment. Valid records
+        # after a corrupt one are kept, records() skips the corrupt bytes.
+        seq = self.segments[-1]
+        if self.sizes[seq] == 0:
+            return
+        with open(self.segment_path(seq), "r+b") as f:
+            end = 0
+            while self.next_record(f, self.sizes[seq]) is not None:
+                end = f.tell()
+            if end < self.sizes[seq]:
+                f.truncate(end)
+                self.sizes[seq] = end
+
+    def empty(self):
+        seq, offset = self.cursor
+        return seq == self.segments[-1] and offset >= self.sizes[seq]
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def append(self, body, alert=False):
+        payload = json.dumps([body, alert]).encode("utf-8")
+        seq = self.segments[-1]
+        if self.sizes[seq] >= self.segment_bytes:
+            if self.sync:
+                # Once per segment, so that records waiting for the batched fsync aren't left behind
+                os.fsync(self.writer.fileno())
+            self.writer.close()
+            seq = seq + 1
+            self.segments.append(seq)
+            self.sizes[seq] = 0
+            self.writer = open(self.segment_path(seq), "ab")
+        self.writer.write(self.header.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.writer.flush()
+        if self.sync:
+            self.request_sync()
+        self.sizes[seq] = self.sizes[seq] + self.header.size + len(payload)
+        # Evict the oldest segments so the spool never grows past max_bytes
+        while self.size() > self.max_bytes and len(self.segments) > 1:
+            oldest = self.segments.pop(0)
+            del self.sizes[oldest]
+            os.remove(self.segment_path(oldest))
+            self.evicted_segments = self.evicted_segments + 1
+            if self.cursor[0] == oldest:
+                self.cursor = (self.segments[0], 0)
+                self.write_cursor()
+
+    def request_sync(self):
+        self.sync_pending = True
+        if self.sync_task is not None and not self.sync_task.done():
+            # The running sync loop picks the record up
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop, e.g. in a script draining the spool: sync right away
+            self.sync_pending = False
+            os.fsync(self.writer.fileno())
+            return
+        self.sync_task = loop.create_task(self.sync_loop())
+
+    async def sync_loop(self):
+        loop = asyncio.get_running_loop()
+        while self.sync_pending:
+            self.sync_pending = False
+            # The thread syncs and closes its own descriptor, the writer can move to a new segment meanwhile
+            await loop.run_in_executor(None, fsync_and_close, os.dup(self.writer.fileno()))
+            self.syncs = self.syncs + 1
+            await asyncio.sleep(self.sync_interval)
+
+    def records(self):
+        # Yields (position, body, alert) starting at the cursor, one record in memory at a time
+        seq, offset = self.cursor
+        for segment in [s for s in self.segments if s >= seq]:
+            with open(self.segment_path(segment), "rb") as f:
+                f.seek(offset if segment == seq else 0)
+                while True:
+                    record = self.next_record(f, self.sizes[segment])
+                    if record is None:
+                        break
+                    body, alert = record
+                    yield (segment, f.tell()), body, alert
+
+    def commit(self, position):
+        # Mark every record up to position as delivered and delete fully drained segments
+        if position[0] not in self.sizes:
+            # The segment was evicted while its records were being sent
+            return
+        self.cursor = position
+        while self.segments[0] != self.segments[-1] and (
+                self.segments[0] < self.cursor[0] or self.cursor[1] >= self.sizes[self.cursor[0]]):
+            drained = self.segments.pop(0)
+            del self.sizes[drained]
+            os.remove(self.segment_path(drained))
+            if self.cursor[0] == drained:
+                self.cursor = (self.segments[0], 0)
+        self.write_cursor()
+
+    def close(self):
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+        if self.sync:
+            os.fsync(self.writer.fileno())
+        self.writer.close()
+
+def fsync_and_close(fd):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Ring of the most recent readings in a memory mapped file, so that memory and disk use stay the same
+# however long the device runs, and the history survives restarts. The file is a header
+# <magic><capacity><records written> followed by capacity fixed width <time><Temperature><Humidity>
+# records. Times never go backwards, so a time range is found by binary search, and long ranges are
+# downsampled by reading every step-th record: a query reads about limit records, never the whole ring.
+class Telemetry_History:
+    header = struct.Struct("<4sIQ")
+    record = struct.Struct("<dff")
+    magic = b"THR1"
+    # A record takes about 32 bytes of JSON, so a reply stays well under the 128 KB limit of a
+    # direct method payload
+    max_limit = 1000
+
+    def __init__(self, path, capacity=65536):
+        self.path = path
+        self.capacity = capacity
+        size = self.header.size + capacity * self.record.size
+        mode = "r+b" if os.path.exists(path) else "w+b"
+        with open(path, mode) as f:
+            if os.fstat(f.fileno()).st_size != size:
+                f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(), size)
+        magic, file_capacity, self.written = self.header.unpack_from(self.mm, 0)
+        if magic != self.magic or file_capacity != capacity:
+            # New file, or one written with another capacity: start over
+            self.written = 0
+            self.header.pack_into(self.mm, 0, self.magic, capacity, 0)
+        self.last_time = self.time_at(len(self) - 1) if len(self) else 0.0
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def offset(self, k):
+        # Offset of the k-th oldest record
+        return self.header.size + ((self.written - len(self) + k) % self.capacity) * self.record.size
+
+    def time_at(self, k):
+        return self.record.unpack_from(self.mm, self.offset(k))[0]
+
+    def add(self, temperature, humidity, timestamp=None):
+        # The clock of a Pi without a real time clock can be set back, times are kept in order anyway
+        timestamp = max(time.time() if timestamp is None else timestamp, self.last_time)
+        self.record.pack_into(self.mm, self.header.size + (self.written % self.capacity) * self.record.size, timestamp, temperature, humidity)
+        self.written = self.written + 1
+        self.header.pack_into(self.mm, 0, self.magic, self.capacity, self.written)
+        self.last_time = timestamp
+
+    def find(self, timestamp, after=False):
+        # Index of the first record at or, with after set, past timestamp
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self.time_at(mid)
+            if t < timestamp or (after and t == timestamp):
+                lo = mid + 1
             else:
-                await asyncio.sleep(.5)
+                hi = mid
+        return lo
 
-    async def update_leds_task(self):
-        new_status = locals()
-        for i in range(8):
-            new_status[i] = self.leds[i].status
-        while True:
-            if (not self.scroll_leds):
-                clear()
-                for i in range(8):
-                    if (self.leds[i].blink and self.leds[i].status):
-                        new_status[i] = not new_status[i]
+    def query(self, start=None, end=None, limit=100):
+        first = 0 if start is None else self.find(start)
+        last = len(self) if end is None else self.find(end, after=True)
+        count = max(last - first, 0)
+        limit = min(max(limit, 1), self.max_limit)
+        step = max(1, -(-count // limit))
+        records = []
+        for k in range(first, first + count, step):
+            timestamp, temperature, humidity = self.record.unpack_from(self.mm, self.offset(k))
+            records.append([round(timestamp, 3), round(temperature, 2), round(humidity, 2)])
+        return {"count": count, "step": step, "fields": ["time", "Temperature", "Humidity"], "records": records}
+
+    def stats(self):
+        return {"records": len(self), "capacity": self.capacity, "written": self.written}
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+
+# Maps each desired property name (ledN_status, ledN_blink, ledN_r, ledN_g, ledN_b) to the led it
+# controls, built once at startup from IoTCentralModel.json when it is next to this script, and from
+# the property naming for the leds the model doesn't have (all of them without a model, or leds past
+# the 8 of the model on longer strips), so that a patch is applied by looking up only the keys it contains.
+# The compact properties (leds_rgb, leds_on, leds_blink) are accepted too. With compact set, they are also the
+# reported properties, instead of the per led ones.
+class Twin_Property_Index:
+    led_fields = {"status": bool, "blink": bool, "r": int, "g": int, "b": int}
+    schema_types = {"boolean": bool, "integer": int}
+
+    def __init__(self, led_count=8, model_path=None, compact=False):
+        self.properties = {}
+        self.compact = compact
+        if model_path is None:
+            model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "IoTCentralModel.json")
+        if model_path and os.path.exists(model_path):
+            self.load_model(model_path, led_count)
+        modeled = {i for i, field, kind in self.properties.values()}
+        for i in range(led_count):
+            if i not in modeled:
+                for field, kind in self.led_fields.items():
+                    self.properties['led' + str(i+1) + '_' + field] = (i, field, kind)
+
+    def load_model(self, model_path, led_count):
+        with open(model_path) as f:
+            model = json.load(f)
+        if isinstance(model, dict):
+            model = [model]
+        for interface in model:
+            for content in interface.get("contents", []):
+                if content.get("@type") != "Property" or not content.get("writable", False):
+                    continue
+                name = content["name"]
+                led, _, field = name.partition("_")
+                if not led.startswith("led") or not led[3:].isdigit() or field not in self.led_fields:
+                    continue
+                i = int(led[3:]) - 1
+                if 0 <= i < led_count:
+                    self.properties[name] = (i, field, self.schema_types.get(content.get("schema"), self.led_fields[field]))
+
+    def apply(self, led_manager, patch):
+        # Returns the patch $version, the keys that don't match any led property, and the keys whose
+        # value was rejected. Led colors must be integers from 0 to 255 and flags True or False.
+        version = None
+        unknown = []
+        rejected = []
+        for key, value in patch.items():
+            entry = self.properties.get(key)
+            if entry is not None:
+                value = coerce_led_value(entry[1], value, entry[2])
+                if value is None:
+                    rejected.append(key)
+                else:
+                    setattr(led_manager.leds[entry[0]], entry[1], value)
+            elif key == "$version":
+                version = value
+            elif key not in compact_led_fields:
+                unknown.append(key)
+            elif not set_compact_leds(led_manager.leds, key, value, led_manager.effects):
+                rejected.append(key)
+        return version, unknown, rejected
+
+    def reported_properties(self, led_manager):
+        if self.compact:
+            return {name: pack_compact_leds(led_manager.leds, name, led_manager.effects) for name in compact_led_fields}
+        leds = led_manager.leds
+        return {key: getattr(leds[i], field) for key, (i, field, kind) in self.properties.items()}
+
+# One lane of the send queue, with its own queue bound, number of send_message calls in flight and
+# batching. When overflow is "shed", a full lane makes room by dropping its oldest reading, which
+# goes to the spool when there is one, instead of making the caller wait.
+class Send_Lane:
+    def __init__(self, name, alert, max_in_flight, max_queued, batch_size=1, batch_window=0.0, overflow="wait"):
+        self.name = name
+        self.alert = alert
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.overflow = overflow
+        self.queue = asyncio.Queue(max_queued)
+        self.shed_readings = 0
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        if self.batch_size > 1:
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
                     else:
-                        new_status[i]=self.leds[i].status
-                    if (new_status[i]):
-                        set_pixel(i, self.leds[i].r, self.leds[i].g, self.leds[i].b)
-                show()
-            await asyncio.sleep(.5)
+                        batch.append(self.queue.get_nowait())
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+        return batch
 
+# Long lived send queue running on the main event loop.
+# Alerts and routine readings go through separate lanes, so that an alert never waits behind
+# queued routine readings or their batching window. Up to max_in_flight routine send_message calls
+# run at the same time, plus up to alert_max_in_flight alerts, and when batch_size > 1 routine
+# readings queued within batch_window seconds are sent together as one JSON array message.
+# When a spool is given, readings that cannot be sent are stored in it and drained after reconnect.
+class Telemetry_Queue:
+    def __init__(self, device_client, max_in_flight=4, max_queued=64, batch_size=1, batch_window=0.0,
+                 spool=None, drain_rate=10.0, drain_batch=32, codec=None,
+                 alert_max_in_flight=2, alert_max_queued=16, overflow="wait"):
+        load_sdk()
+        self.device_client = device_client
+        self.codec = codec or Json_Codec()
+        self.spool = spool
+        self.drain_rate = drain_rate
+        self.drain_batch = drain_batch
+        self.alert_lane = Send_Lane("alert", True, alert_max_in_flight, alert_max_queued)
+        self.routine_lane = Send_Lane("routine", False, max_in_flight, max_queued, batch_size, batch_window, overflow)
+        self.lanes = (self.alert_lane, self.routine_lane)
+        self.workers = []
+        self.drain_wakeup = None
+        self.sent_messages = 0
+        self.sent_readings = 0
+        self.spooled_readings = 0
+        self.drained_readings = 0
 
-def printjson(obj):
-    parsed = json.dumps(obj)
-    loaded = json.loads(parsed)
-    print(json.dumps(loaded, indent=2, sort_keys=True))
+    def start(self):
+        self.drain_wakeup = asyncio.Event()
+        for lane in self.lanes:
+            for i in range(lane.max_in_flight):
+                self.workers.append(asyncio.ensure_future(self.send_worker(lane)))
+        if self.spool is not None:
+            self.workers.append(asyncio.ensure_future(self.drain_worker()))
 
-led_manager = Led_Manager()
-message_index = 1
+    def stats(self):
+        return {
+            "queued": self.routine_lane.queue.qsize(),
+            "queued_alerts": self.alert_lane.queue.qsize(),
+            "sent_messages": self.sent_messages,
+            "sent_readings": self.sent_readings,
+            "spooled_readings": self.spooled_readings,
+            "shed_readings": self.routine_lane.shed_readings,
+            "drained_readings": self.drained_readings
+            }
 
-async def main():
-    # Thread pool Executor to execute async functions in sync task
-#    pool = concurrent.futures.ThreadPoolExecutor()
+    def resume(self):
+        # Start draining the spool right away instead of at the next check
+        if self.drain_wakeup is not None:
+            self.drain_wakeup.set()
 
-    # Extract device id from connection string
-    conn_str_obj = dict(item.split('=', 1) for item in conn_str.split(';'))
-    device_id = conn_str_obj["DeviceId"]
+    async def wait_drain_wakeup(self):
+        try:
+            await asyncio.wait_for(self.drain_wakeup.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+        self.drain_wakeup.clear()
 
-    print("Connecting device " + device_id)
+    async def stop(self):
+        # Let queued readings go out before stopping the workers
+        for lane in self.lanes:
+            await lane.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.spool is not None:
+            self.spool.close()
 
-    # The client object is used to interact with your Azure IoT hub.
-    device_client = IoTHubDeviceClient.create_from_connection_string(conn_str)
-    
-    # Function for sending message
-    async def send_test_message(i):
-            global led_manager
-            global message_index
-            print("sending message #" + str(message_index))
-            body_dict = {}
-            body_dict['Weather'] = {}
-            body_dict['Weather']['Temperature'] = random.randrange(65, 75, 1)
-            body_dict['Weather']['Humidity'] = random.randrange(40, 60, 1)
-            body_dict['Location']='28.424911, -81.468962'
-            body_json = json.dumps(body_dict)
-            print(body_json)
-            msg = Message(body_json)
-            msg.message_id = uuid.uuid4()
-            msg.correlation_id = "correlation-1234"
-            msg.custom_properties["Alert"] = "no"
-            msg.contentEncoding="utf-8",
-            msg.contentType="application/json",
-            await device_client.send_message(msg)
-            print('Message #' + str(message_index) + ' sent' )
-            led_manager.set_led(i, 'On', 0, 255, 0, True)
-            message_index=message_index+1
-
-    async def send_alert_message():
-            print("Sending alert from device " + device_id)
+    async def put(self, body, alert=False):
+        # Waits while the lane is full unless it sheds, returns a future resolved once the reading is sent
+        lane = self.alert_lane if alert else self.routine_lane
+        if lane.overflow == "shed" and lane.queue.full():
+            self.shed(lane, lane.queue.get_nowait())
+            lane.queue.task_done()
+        sent = asyncio.get_running_loop().create_future()
+        await lane.queue.put((body, alert, sent))
+        return sent
+
+    def shed(self, lane, item):
+        body, alert, sent = item
+        lane.shed_readings = lane.shed_readings + 1
+        if self.spool is not None:
+            self.spool.append(body, alert)
+            self.spooled_readings = self.spooled_readings + 1
+        if not sent.done():
+            sent.set_result(False)
+
+    async def send(self, body, alert=False):
+        # Returns True once the reading is sent, False if it was stored in the spool or shed instead
+        sent = await self.put(body, alert)
+        return await sent
+
+    def connected(self):
+        return getattr(self.device_client, "connected", True)
+
+    async def send_batch(self, items, alert):
+        if len(items) == 1:
+            msg = create_message(items[0][0], alert, self.codec)
+        else:
+            msg = create_message([body for body, _, _ in items], alert, self.codec)
+        try:
+            if self.spool is not None and not self.connected():
+                raise ConnectionError("Device client is not connected")
+            await self.device_client.send_message(msg)
+        except Exception as e:
+            if self.spool is None:
+                for _, _, sent in items:
+                    if not sent.done():
+                        sent.set_exception(e)
+                return
+            for body, _, _ in items:
+                self.spool.append(body, alert)
+            self.spooled_readings = self.spooled_readings + len(items)
+            for _, _, sent in items:
+                if not sent.done():
+                    sent.set_result(False)
+            return
+        self.sent_messages = self.sent_messages + 1
+        self.sent_readings = self.sent_readings + len(items)
+        for _, _, sent in items:
+            if not sent.done():
+                sent.set_result(True)
+
+    async def send_worker(self, lane):
+        while True:
+            batch = await lane.next_batch()
+            try:
+                await self.send_batch(batch, lane.alert)
+            finally:
+                for i in range(len(batch)):
+                    lane.queue.task_done()
+
+    async def drain_worker(self):
+        # Sends spooled readings in batches of drain_batch, at most drain_rate messages per second
+        while True:
+            if self.spool.empty() or not self.connected():
+                await self.wait_drain_wakeup()
+                continue
+            bodies = []
+            position = None
+            alert = None
+            for record_position, body, record_alert in self.spool.records():
+                if alert is not None and record_alert != alert:
+                    break
+                alert = record_alert
+                bodies.append(body)
+                position = record_position
+                if len(bodies) >= self.drain_batch:
+                    break
+            if position is None:
+                await self.wait_drain_wakeup()
+                continue
+            try:
+                await self.device_client.send_message(create_message(bodies, alert, self.codec))
+            except Exception:
+                await self.wait_drain_wakeup()
+                continue
+            self.spool.commit(position)
+            self.drained_readings = self.drained_readings + len(bodies)
+            await asyncio.sleep(1 / self.drain_rate)
+
+def read_sensors():
+    # Simulated Temperature and Humidity sensors. About one reading in a hundred is a spike at or
+    # above the default ALERT_TEMPERATURE (76), so that alerts show up without a real sensor.
+    spike = random.random() < 0.01
+    return {
+        'Temperature': random.randrange(76, 80, 1) if spike else random.randrange(65, 75, 1),
+        'Humidity': random.randrange(40, 60, 1)
+        }
+
+# Running min/max/mean/last of one value over a window, without keeping the samples
+class Window_Stats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+        self.count = self.count + 1
+        self.total = self.total + value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+        self.last = value
+
+    def summary(self):
+        return {'min': self.min, 'max': self.max, 'mean': round(self.total / self.count, 2), 'last': self.last}
+
+# Samples the sensors at sample_rate per second and sends one summarized message per window.
+# Every sample is kept in the history when there is one.
+# A Temperature crossing above alert_temperature is sent right away as an alert, and is armed
+# again once the Temperature goes back under the threshold.
+class Sensor_Aggregator:
+    def __init__(self, telemetry_queue, sample_rate=10.0, window=60.0, alert_temperature=76, sensors=read_sensors, history=None):
+        self.telemetry_queue = telemetry_queue
+        self.history = history
+        self.sample_clock = Frame_Clock(sample_rate)
+        self.window = window
+        self.alert_temperature = alert_temperature
+        self.sensors = sensors
+        self.alert_armed = True
+        self.samples = 0
+        self.windows_sent = 0
+        self.alerts_sent = 0
+
+    async def run(self):
+        self.sample_clock.start()
+        while True:
+            window_end = time.monotonic() + self.window
+            stats = {}
+            while time.monotonic() < window_end:
+                reading = self.sensors()
+                self.samples = self.samples + 1
+                if self.history is not None:
+                    self.history.add(reading.get('Temperature', 0), reading.get('Humidity', 0))
+                for name, value in reading.items():
+                    if name not in stats:
+                        stats[name] = Window_Stats()
+                    stats[name].add(value)
+                await self.check_alert(reading)
+                await self.sample_clock.wait_next_frame()
+            if stats:
+                await self.send_window(stats)
+
+    async def check_alert(self, reading):
+        temperature = reading.get('Temperature')
+        if temperature is None:
+            return
+        if temperature < self.alert_temperature:
+            self.alert_armed = True
+        elif self.alert_armed:
+            self.alert_armed = False
+            logger.warning("Temperature crossed %s, sending alert", self.alert_temperature)
             body_dict = {}
-            body_dict['Weather'] = {}
-            body_dict['Weather']['Temperature'] = random.randrange(76, 80, 1)
-            body_dict['Weather']['Humidity'] = random.randrange(40, 60, 1)
+            body_dict['Weather'] = dict(reading)
             body_dict['Location']='28.424911, -81.468962'
-            body_json = json.dumps(body_dict)
-            print(body_json)
-            msg = Message(body_json)
-            msg.message_id = uuid.uuid4()
-            msg.correlation_id = "correlation-1234"
-            msg.custom_properties["Alert"] = "yes"
-            msg.contentEncoding="utf-8",
-            msg.contentType="application/json",
-            await device_client.send_message(msg)
-            print("Done sending alert message")
-
-
-    # update the reported properties
-    async def update_device_twin(device_client, led_manager):
-        reported_properties = {}
-        for i in range (8):
-            key='led'+ str(i+1) +'_status' 
-            reported_properties[key] = led_manager.leds[i].status
-            key='led'+ str(i+1) +'_blink' 
-            reported_properties[key] = led_manager.leds[i].blink
-            key='led'+ str(i+1) +'_r' 
-            reported_properties[key] = led_manager.leds[i].r
-            key='led'+ str(i+1) +'_g' 
-            reported_properties[key] = led_manager.leds[i].g
-            key='led'+ str(i+1) +'_b' 
-            reported_properties[key] = led_manager.leds[i].b
-        await device_client.patch_twin_reported_properties(reported_properties)
-        print("Updated Device Twin's reported properties:")
-        printjson(reported_properties)
+            # Don't wait for the alert to be sent, sampling goes on
+            await self.telemetry_queue.put(body_dict, alert=True)
+            self.alerts_sent = self.alerts_sent + 1
+
+    async def send_window(self, stats):
+        body_dict = {}
+        body_dict['Weather'] = {name: window_stats.summary() for name, window_stats in stats.items()}
+        body_dict['Samples'] = next(iter(stats.values())).count
+        body_dict['Window'] = self.window
+        body_dict['Location']='28.424911, -81.468962'
+        await self.telemetry_queue.put(body_dict)
+        self.windows_sent = self.windows_sent + 1
+
+    def stats(self):
+        return {"samples": self.samples, "windows_sent": self.windows_sent, "alerts_sent": self.alerts_sent}
+
+# Latency histogram with fixed buckets, cheap enough to record every call on a Pi Zero
+class Latency_Histogram:
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q quantile
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen = seen + count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p95_ms": self.quantile(0.95) * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000
+            }
+
+# Counters and latency histograms of the hot paths, plus gauges read from the stats() of the
+# other components when scraped. Rendered in the Prometheus text format.
+class Metrics:
+    def __init__(self, prefix="iothub"):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.sources = []
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Latency_Histogram()
+        return self.histograms[key]
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_source(self, name, stats, label="key"):
+        # stats is called at scrape time and returns a dict of numbers, or of dicts of numbers
+        # whose keys become the value of label
+        self.sources.append((name, stats, label))
+
+    async def monitor_loop_lag(self, interval=0.25):
+        # How late the event loop wakes up a sleeping task
+        histogram = self.histogram("event_loop_lag_seconds")
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            histogram.record(max(0.0, time.perf_counter() - start - interval))
+
+    def format_labels(self, labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('%s="%s"' % (key, value) for key, value in labels) + "}"
+
+    def render_text(self):
+        # Each metric family gets a # TYPE line followed by all of its samples. The values read
+        # from the stats() of the other components are exposed as gauges.
+        lines = []
+        family = None
+        for (name, labels), value in sorted(self.counters.items()):
+            if name != family:
+                family = name
+                lines.append("# TYPE %s_%s counter" % (self.prefix, name))
+            lines.append("%s_%s%s %s" % (self.prefix, name, self.format_labels(labels), value))
+        family = None
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name != family:
+                family = name
+                lines.append("# TYPE %s_%s histogram" % (self.prefix, name))
+            name = self.prefix + "_" + name
+            seen = 0
+            for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                seen = seen + count
+                lines.append("%s_bucket%s %d" % (name, self.format_labels(labels + (("le", bound),)), seen))
+            lines.append("%s_sum%s %f" % (name, self.format_labels(labels), histogram.total))
+            lines.append("%s_count%s %d" % (name, self.format_labels(labels), histogram.count))
+        for source, stats, label in self.sources:
+            # Samples of a labelled family come from several keys, group them before writing
+            gauges = {}
+            for key, value in stats().items():
+                if isinstance(value, dict):
+                    for sub_key, sub_value in value.items():
+                        if isinstance(sub_value, (int, float)) and not isinstance(sub_value, bool):
+                            gauges.setdefault("%s_%s_%s" % (self.prefix, source, sub_key), []).append(
+                                '{%s="%s"} %s' % (label, key, sub_value))
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges.setdefault("%s_%s_%s" % (self.prefix, source, key), []).append(" %s" % value)
+            for name, samples in gauges.items():
+                lines.append("# TYPE %s gauge" % name)
+                lines.extend(name + sample for sample in samples)
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # Compact form sent as telemetry
+        summary = {}
+        for (name, labels), histogram in self.histograms.items():
+            if histogram.count:
+                label = name if not labels else name + ":" + ",".join(str(value) for _, value in labels)
+                summary[label] = {key: round(value, 2) for key, value in histogram.summary().items()}
+        for (name, labels), value in self.counters.items():
+            label = name if not labels else name + ":" + ",".join(str(value) for _, value in labels)
+            summary[label] = value
+        return summary
+
+    async def handle_scrape(self, reader, writer):
+        # Minimal HTTP server: any request gets the metrics
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or line in (b"\r\n", b"\n"):
+                    break
+            body = self.render_text().encode("utf-8")
+            writer.write(
+                b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: "
+                + str(len(body)).encode("ascii") + b"\r\n\r\n" + body
+                )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        return await asyncio.start_server(self.handle_scrape, host, port)
+
+# Device client wrapper that times the SDK calls and counts their errors
+class Instrumented_Device_Client:
+    timed_calls = ("connect", "send_message", "patch_twin_reported_properties", "send_method_response", "get_twin")
+
+    def __init__(self, device_client, metrics):
+        object.__setattr__(self, "device_client", device_client)
+        object.__setattr__(self, "metrics", metrics)
+        object.__setattr__(self, "latencies", {name: metrics.histogram("sdk_call_seconds", call=name) for name in self.timed_calls})
+
+    async def timed_call(self, name, *args):
+        start = time.perf_counter()
+        try:
+            return await getattr(self.device_client, name)(*args)
+        except Exception:
+            self.metrics.count("sdk_call_errors_total", call=name)
+            raise
+        finally:
+            self.latencies[name].record(time.perf_counter() - start)
+
+    async def connect(self):
+        return await self.timed_call("connect")
+
+    async def send_message(self, msg):
+        return await self.timed_call("send_message", msg)
+
+    async def patch_twin_reported_properties(self, reported_properties):
+        return await self.timed_call("patch_twin_reported_properties", reported_properties)
+
+    async def send_method_response(self, method_response):
+        return await self.timed_call("send_method_response", method_response)
+
+    async def get_twin(self):
+        return await self.timed_call("get_twin")
+
+    # Everything else, including attributes such as connected or on_connection_state_change,
+    # goes straight to the wrapped client
+    def __getattr__(self, name):
+        return getattr(self.device_client, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.device_client, name, value)
+
+# Everything a connected device runs: telemetry queue, reported properties, direct methods and twin listener.
+# main() runs one Device_App for this device, FleetSimulator.py runs many of them in the same process.
+class Device_App:
+    def __init__(self, device_client, device_id, led_manager, telemetry_spool=None, boot_timeline=None, desired_snapshot=None, telemetry_history=None):
+        # SDK calls and led frames are timed, the rest is read from stats() when scraped
+        self.metrics = Metrics()
+        device_client = Instrumented_Device_Client(device_client, self.metrics)
+        led_manager.render_latency = self.metrics.histogram("led_render_seconds")
+        self.metrics_server = None
+        self.metrics_tasks = []
+
+        self.device_client = device_client
+        self.boot_timeline = boot_timeline
+        self.desired_snapshot = desired_snapshot
+        self.telemetry_history = telemetry_history
+        self.device_id = device_id
+        self.led_manager = led_manager
+        self.message_index = 1
+        self.led_listeners = None
+        self.iothub_listeners = None
+        self.supervisor_task = None
+
+        self.connection_supervisor = Connection_Supervisor(
+            device_client, self.resume,
+            max_backoff=float(os.getenv("RECONNECT_MAX_BACKOFF", "60"))
+            )
+
+        # Lookup table from desired property names to leds
+        self.twin_property_index = Twin_Property_Index(len(led_manager.leds), compact=os.getenv("TWIN_SCHEMA", "legacy") == "compact")
+
+        # Telemetry send queue on the main loop
+        self.telemetry_queue = Telemetry_Queue(
+            device_client,
+            max_in_flight=int(os.getenv("TELEMETRY_MAX_IN_FLIGHT", "4")),
+            max_queued=int(os.getenv("TELEMETRY_QUEUE_SIZE", "64")),
+            batch_size=int(os.getenv("TELEMETRY_BATCH_SIZE", "1")),
+            batch_window=float(os.getenv("TELEMETRY_BATCH_WINDOW", "0.2")),
+            spool=telemetry_spool,
+            drain_rate=float(os.getenv("TELEMETRY_SPOOL_DRAIN_RATE", "10")),
+            codec=create_codec(os.getenv("TELEMETRY_CODEC", "json")),
+            alert_max_in_flight=int(os.getenv("TELEMETRY_ALERT_MAX_IN_FLIGHT", "2")),
+            alert_max_queued=int(os.getenv("TELEMETRY_ALERT_QUEUE_SIZE", "16")),
+            overflow=os.getenv("TELEMETRY_OVERFLOW", "wait")
+            )
+
+        # Device Twin reported properties, updates after the first one only send what changed
+        self.twin_reporter = Twin_Reporter(
+            device_client, lambda: self.twin_property_index.reported_properties(self.led_manager),
+            window=float(os.getenv("TWIN_REPORT_WINDOW", "0.5"))
+            )
+
+        self.method_router = Method_Router(device_client)
+        self.method_router.register("TurnLedsOff", self.turn_leds_off, timeout=5)
+        self.method_router.register("ScrollLeds", self.scroll_leds, timeout=5)
+        if telemetry_history is not None:
+            self.method_router.register("GetHistory", self.get_history, timeout=5)
+
+        # Windowed sensor sampling, disabled unless SENSOR_SAMPLE_RATE is set
+        self.sensor_aggregator = None
+        self.sensor_task = None
+        sample_rate = float(os.getenv("SENSOR_SAMPLE_RATE", "0"))
+        if sample_rate > 0:
+            self.sensor_aggregator = Sensor_Aggregator(
+                self.telemetry_queue,
+                sample_rate=sample_rate,
+                window=float(os.getenv("SENSOR_WINDOW", "60")),
+                alert_temperature=float(os.getenv("ALERT_TEMPERATURE", "76")),
+                history=telemetry_history
+                )
+
+        self.metrics.add_source("connection", self.connection_supervisor.stats)
+        self.metrics.add_source("telemetry", self.telemetry_queue.stats)
+        self.metrics.add_source("reported_properties", self.twin_reporter.stats)
+        self.metrics.add_source("direct_methods", self.method_router.stats, label="method")
+        self.metrics.add_source("led_frames", led_manager.render_stats)
+        self.metrics.add_source("led_timing", led_manager.frame_clock.stats)
+        if self.sensor_aggregator is not None:
+            self.metrics.add_source("sensors", self.sensor_aggregator.stats)
+        if telemetry_history is not None:
+            self.metrics.add_source("history", telemetry_history.stats)
+
+    # Function for sending message
+    async def send_test_message(self, i):
+        index = self.message_index
+        self.message_index = self.message_index + 1
+        logger.debug("sending message #%d", index)
+        body_dict = {}
+        body_dict['Weather'] = {}
+        body_dict['Weather']['Temperature'] = random.randrange(65, 75, 1)
+        body_dict['Weather']['Humidity'] = random.randrange(40, 60, 1)
+        body_dict['Location']='28.424911, -81.468962'
+        printjson(body_dict)
+        if self.telemetry_history is not None:
+            self.telemetry_history.add(body_dict['Weather']['Temperature'], body_dict['Weather']['Humidity'])
+        sent = await self.telemetry_queue.send(body_dict)
+        if sent:
+            logger.info("Message #%d sent", index)
+        else:
+            logger.warning("Message #%d stored for sending after reconnect", index)
+        self.led_manager.set_led(i, 'On', 0, 255, 0, True)
+        return sent
+
+    async def send_alert_message(self):
+        logger.info("Sending alert from device %s", self.device_id)
+        body_dict = {}
+        body_dict['Weather'] = {}
+        body_dict['Weather']['Temperature'] = random.randrange(76, 80, 1)
+        body_dict['Weather']['Humidity'] = random.randrange(40, 60, 1)
+        body_dict['Location']='28.424911, -81.468962'
+        printjson(body_dict)
+        if self.telemetry_history is not None:
+            self.telemetry_history.add(body_dict['Weather']['Temperature'], body_dict['Weather']['Humidity'])
+        sent = await self.telemetry_queue.send(body_dict, alert=True)
+        if sent:
+            logger.info("Done sending alert message")
+        else:
+            logger.warning("Alert message stored for sending after reconnect")
+        return sent
+
+    async def send_batch_messages(self):
+        # send 8 messages through the queue, up to max_in_flight at a time
+        await asyncio.gather(*[self.send_test_message(i % len(self.led_manager.leds)) for i in range(8)])
+        self.twin_reporter.report() # Update reported properties
+
+    async def send_messages(self, count=8, rate=0.0):
+        # send count messages, started at rate messages per second or all at once when rate is 0
+        sending = []
+        start = time.monotonic()
+        for i in range(count):
+            sending.append(asyncio.ensure_future(self.send_test_message(i % len(self.led_manager.leds))))
+            if rate > 0:
+                await asyncio.sleep(max(0, start + (i + 1) / rate - time.monotonic()))
+        results = await asyncio.gather(*sending)
+        self.twin_reporter.report()
+        return {"sent": results.count(True), "stored": results.count(False), "elapsed_s": time.monotonic() - start}
 
     # define behavior for receiving a twin patch
-    async def twin_patch_listener(device_client, led_manager):
+    async def twin_patch_listener(self):
         while True:
-            patch = await device_client.receive_twin_desired_properties_patch()  # blocking call
-            print("Received new device twin's desired properties:")
+            patch = await self.device_client.receive_twin_desired_properties_patch()  # blocking call
+            logger.info("Received new device twin's desired properties")
             printjson(patch)
-            for i in range (8):
-                led_status = led_manager.leds[i].status
-                led_blink = led_manager.leds[i].blink
-                led_r = led_manager.leds[i].r
-                led_g = led_manager.leds[i].g
-                led_b = led_manager.leds[i].b
-                key='led'+ str(i+1) +'_status'
-                if key in patch:
-                    led_status = patch[key]
-                key='led'+ str(i+1) +'_blink'
-                if key in patch:
-                    led_blink = patch[key]
-                key='led'+ str(i+1) +'_r' 
-                if key in patch:
-                    led_r = patch[key]
-                key='led'+ str(i+1) +'_g' 
-                if key in patch:
-                    led_g = patch[key]
-                key='led'+ str(i+1) +'_b' 
-                if key in patch:
-                    led_b = patch[key]
-                led_manager.set_led(i, led_status, led_r, led_g, led_b, led_blink)
-            await update_device_twin(device_client, led_manager)
-
-    async def direct_methods_listener(device_client, led_manager):
+            version, unknown, rejected = self.twin_property_index.apply(self.led_manager, patch)
+            if unknown:
+                logger.warning("Ignored unknown desired properties: %s", ", ".join(unknown))
+            if rejected:
+                logger.warning("Rejected invalid desired properties: %s", ", ".join(rejected))
+            logger.info("Applied desired properties version %s", version)
+            if self.desired_snapshot is not None:
+                self.desired_snapshot.update(patch, version)
+            self.twin_reporter.report()
+
+    async def reconcile_desired_state(self):
+        reported = await reconcile_desired_state(
+            self.device_client, self.desired_snapshot,
+            lambda changes: self.twin_property_index.apply(self.led_manager, changes)
+            )
+        if reported is not None:
+            self.twin_reporter.acknowledge(reported)
+
+    # Direct method handlers
+    async def turn_leds_off(self, payload=None):
+        # Turn all leds off
+        self.led_manager.set_all_leds_off()
+        return {"result": True, "data": "Leds are all off"}
+
+    async def scroll_leds(self, payload=None):
+        # Set leds colors and start scrolling
+        self.led_manager.set_all_leds_off()
+        self.led_manager.set_all_leds_color(255, 255, 255)
+        self.led_manager.start_scrolling()
+        return {"result": True, "data": "Leds are now scrolling"}
+
+    async def get_history(self, payload=None):
+        # Readings between start and end (Unix times, or last seconds until now), downsampled to at most
+        # limit records. Values that aren't numbers raise a ValueError, which the router answers with a 400.
+        payload = payload if isinstance(payload, dict) else {}
+        values = {}
+        for key in ("start", "end", "last", "limit"):
+            value = payload.get(key)
+            if value is None:
+                continue
+            try:
+                values[key] = int(value) if key == "limit" else float(value)
+            except (TypeError, ValueError, OverflowError):
+                raise ValueError(key + " must be a number")
+            if not math.isfinite(values[key]):
+                raise ValueError(key + " must be a number")
+        start = values.get("start")
+        if "last" in values:
+            start = time.time() - values["last"]
+        history = self.telemetry_history.query(start, values.get("end"), values.get("limit", 100))
+        history["result"] = True
+        return history
+
+    def start_iothub_listeners(self):
+        # Schedule tasks for Methods and twins updates
+        self.iothub_listeners = asyncio.gather(
+            self.method_router.listen(),
+            self.twin_patch_listener()
+            )
+
+    async def resume(self):
+        # Called after a reconnect: listen again and send what changed while offline.
+        # Spooled telemetry is drained by the telemetry queue on its own.
+        if self.iothub_listeners is not None:
+            self.iothub_listeners.cancel()
+            try:
+                await self.iothub_listeners
+            except asyncio.CancelledError:
+                pass
+        self.start_iothub_listeners()
+        self.telemetry_queue.resume()
+        await self.reconcile_desired_state()
+        await self.twin_reporter.flush()
+
+    def start_leds(self):
+        self.led_listeners = asyncio.gather(
+            self.led_manager.scroll_leds_task(),
+            self.led_manager.update_leds_task()
+            )
+
+    async def start(self):
+        # Connect the client. Leds restored from the desired state snapshot are kept while connecting.
+        logger.info("Connecting to Azure IoT...")
+        restored = self.desired_snapshot is not None and bool(self.desired_snapshot.desired)
+        if not restored:
+            self.led_manager.set_all_leds_color(0, 0, 255)
+            self.led_manager.start_scrolling()
+        await self.connection_supervisor.connect()
+        logger.info("Device is connected to Azure IoT")
+        if not restored:
+            self.led_manager.set_all_leds_off()
+        if self.boot_timeline is not None:
+            self.boot_timeline.mark("connect")
+
+        # Listen before reading the twin, so that no patch is missed while reconciling
+        self.start_iothub_listeners()
+        await self.reconcile_desired_state()
+        if self.boot_timeline is not None:
+            self.boot_timeline.mark("twin reconcile")
+
+        self.telemetry_queue.start()
+
+        # Update Device Twin reported properties
+        await self.twin_reporter.flush()
+        if self.boot_timeline is not None:
+            self.boot_timeline.mark("first twin report")
+            self.boot_timeline.report()
+
+        self.supervisor_task = asyncio.ensure_future(self.connection_supervisor.run())
+
+        if self.sensor_aggregator is not None:
+            self.sensor_task = asyncio.ensure_future(self.sensor_aggregator.run())
+
+        await self.start_metrics()
+
+    async def start_metrics(self):
+        self.metrics_tasks.append(asyncio.ensure_future(self.metrics.monitor_loop_lag()))
+        metrics_port = os.getenv("METRICS_PORT", "")
+        if metrics_port:
+            self.metrics_server = await self.metrics.serve(os.getenv("METRICS_HOST", "127.0.0.1"), int(metrics_port))
+        interval = float(os.getenv("METRICS_TELEMETRY_INTERVAL", "0"))
+        if interval > 0:
+            self.metrics_tasks.append(asyncio.ensure_future(self.send_metrics_task(interval)))
+
+    async def send_metrics_task(self, interval):
+        # Periodic compact summary of the metrics, sent as telemetry
         while True:
-            method_request = (
-                await device_client.receive_method_request()
-            )  # Wait for unknown method calls
-            
-            # Check which method was involked
-            if (method_request.name == "TurnLedsOff"):
-                # Turn all leds off
-                led_manager.set_all_leds_off()
-                response_payload = {"result": True, "data": "Leds are all off"}  # set response payload
-                response_status = 200  # set return status code
-                print("Executed method " + method_request.name)
-
-            elif (method_request.name == "ScrollLeds"):
-                # Set leds colors and start scrolling
-                led_manager.set_all_leds_off()
-                led_manager.set_all_leds_color(255, 255, 255)
-                led_manager.start_scrolling()
-                response_payload = {"result": True, "data": "Leds are now scrolling"}  # set response payload
-                response_status = 200  # set return status code
-                print("Executed method " + method_request.name)
+            await asyncio.sleep(interval)
+            await self.telemetry_queue.send({"Metrics": self.metrics.summary()})
 
-            else:
-                # Respond
-                response_payload = {"result": True, "data": "unknown method"}  # set response payload
-                response_status = 200  # set return status code
-                print("Executed unknown method: " + method_request.name)
+    async def stop(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        # Cancel listening
+        for listeners in [self.supervisor_task, self.sensor_task, self.led_listeners, self.iothub_listeners] + self.metrics_tasks:
+            if listeners is not None:
+                listeners.cancel()
+                try:
+                    await listeners
+                except asyncio.CancelledError:
+                    pass
+        await self.telemetry_queue.stop()
+        await self.twin_reporter.flush()
+        if self.telemetry_history is not None:
+            self.telemetry_history.close()
+
+        # finally, disconnect
+        await self.device_client.disconnect()
+
+    async def set_leds(self, index, r=255, g=255, b=255, blink=False, status=True):
+        # index is 1 based like the twin properties, 0 sets all the leds
+        if index < 0 or index > len(self.led_manager.leds):
+            raise ValueError("led index must be between 0 and " + str(len(self.led_manager.leds)))
+        for field, value in (("r", r), ("g", g), ("b", b)):
+            if coerce_led_value(field, value) is None:
+                raise ValueError(field + " must be an integer from 0 to 255")
+        for i in range(len(self.led_manager.leds)) if index == 0 else [index - 1]:
+            self.led_manager.set_led(i, status, r, g, b, blink)
+        self.twin_reporter.report()
+        return self.twin_reporter.current_state()
+
+    def register_control_commands(self, control_server):
+        control_server.register("send", self.send_messages, (("count", int), ("rate", float)))
+        control_server.register("alert", self.send_alert_message)
+        control_server.register("leds", self.set_leds, (
+            ("index", int), ("r", int), ("g", int), ("b", int), ("blink", parse_bool), ("status", parse_bool)
+            ))
+        control_server.register("off", self.turn_leds_off)
+        control_server.register("scroll", self.scroll_leds)
+        control_server.register("stats", self.stats_command)
+        control_server.register("metrics", self.metrics_command)
+        if self.telemetry_history is not None:
+            control_server.register("history", self.history_command, (("last", float), ("limit", int)))
+
+    async def stats_command(self):
+        return self.stats()
+
+    async def metrics_command(self):
+        return self.metrics.summary()
+
+    async def history_command(self, last=None, limit=100):
+        return await self.get_history({"last": last, "limit": limit})
+
+    def stats(self):
+        stats = {
+            "connection": self.connection_supervisor.stats(),
+            "telemetry": self.telemetry_queue.stats(),
+            "direct_methods": self.method_router.stats(),
+            "reported_properties": self.twin_reporter.stats(),
+            "led_frames": self.led_manager.render_stats(),
+            "led_timing": self.led_manager.frame_clock.stats()
+            }
+        if self.sensor_aggregator is not None:
+            stats["sensors"] = self.sensor_aggregator.stats()
+        if self.telemetry_history is not None:
+            stats["history"] = self.telemetry_history.stats()
+        return stats
+
+    def print_stats(self):
+        if self.sensor_aggregator is not None:
+            print("Sensor sampling: " + json.dumps(self.sensor_aggregator.stats()))
+        print("Connection: " + json.dumps(self.connection_supervisor.stats()))
+        print("Direct method latencies: " + json.dumps(self.method_router.stats()))
+        print("Reported properties updates: " + json.dumps(self.twin_reporter.stats()))
+        print("Led frames computed/pushed: " + json.dumps(self.led_manager.render_stats()))
+        print("Led animation timing: " + json.dumps(self.led_manager.frame_clock.stats()))
 
-            method_response = MethodResponse.create_from_method_request(
-                method_request, response_status, response_payload
+async def main():
+    boot_timeline = Boot_Timeline(boot_started)
+    log_listener = setup_logging()
+
+    # Light up the leds first, with the last desired state if there is one, then load the SDK in
+    # a thread while they scroll
+    led_manager = create_led_manager()
+    desired_snapshot = None
+    snapshot_file = os.getenv("TWIN_SNAPSHOT_FILE", "desired_state.json")
+    if snapshot_file:
+        desired_snapshot = Desired_State_Snapshot(snapshot_file)
+    restore_index = Twin_Property_Index(len(led_manager.leds))
+    if restore_desired_state(led_manager, desired_snapshot, lambda desired: restore_index.apply(led_manager, desired)):
+        led_manager.render(led_manager.compute_frame(True))
+        logger.info("Restored desired properties version %s", desired_snapshot.version)
+    else:
+        led_manager.show_booting()
+    boot_timeline.mark("leds on")
+    scroll_task = asyncio.ensure_future(led_manager.scroll_leds_task())
+    await asyncio.get_running_loop().run_in_executor(None, load_sdk)
+    scroll_task.cancel()
+    boot_timeline.mark("sdk import")
+
+    # Extract device id from connection string
+    conn_str_obj = dict(item.split('=', 1) for item in conn_str.split(';'))
+    device_id = conn_str_obj["DeviceId"]
+
+    logger.info("Connecting device %s", device_id)
+
+    # The client object is used to interact with your Azure IoT hub.
+    # Reconnecting is handled by the Connection_Supervisor
+    device_client = IoTHubDeviceClient.create_from_connection_string(conn_str, connection_retry=False)
+
+    # Readings that can't be sent are kept on disk until the connection comes back
+    telemetry_spool = None
+    spool_dir = os.getenv("TELEMETRY_SPOOL_DIR", "telemetry_spool")
+    if spool_dir:
+        telemetry_spool = Telemetry_Spool(
+            spool_dir,
+            max_bytes=int(os.getenv("TELEMETRY_SPOOL_MAX_BYTES", str(16*1024*1024))),
+            sync_interval=float(os.getenv("TELEMETRY_SPOOL_SYNC_INTERVAL", "1"))
             )
-            await device_client.send_method_response(method_response)  # send response
-
-    # Schedule tasks for Methods and twins updates
-    led_listeners = asyncio.gather(
-        led_manager.scroll_leds_task(),
-        led_manager.update_leds_task()
-        )
-
-    # Connect the client.
-    print("Connecting to Azure IoT...")
-    led_manager.set_all_leds_color(0, 0, 255)
-    led_manager.start_scrolling()
-    await device_client.connect()
-    print("Device is connected to Azure IoT")
-    led_manager.set_all_leds_off()
-
-    # Update Device Twin reported properties
-    await update_device_twin(device_client, led_manager)
-    
-    # Schedule tasks for Methods and twins updates
-    iothub_listeners = asyncio.gather(
-        direct_methods_listener(device_client, led_manager),
-        twin_patch_listener(device_client, led_manager)
-        )
+
+    # Recent readings kept on the device, for the GetHistory direct method
+    telemetry_history = None
+    history_file = os.getenv("HISTORY_FILE", "telemetry_history.bin")
+    if history_file:
+        telemetry_history = Telemetry_History(history_file, capacity=int(os.getenv("HISTORY_SIZE", "65536")))
+
+    device_app = Device_App(device_client, device_id, led_manager, telemetry_spool, boot_timeline, desired_snapshot, telemetry_history)
+
+    # Optionally push leds from a separate process
+    if os.getenv("LED_RENDER_MODE", "inline") == "process":
+        led_manager.start_render_process()
+
+    # Schedule tasks for leds
+    device_app.start_leds()
+    await device_app.start()
+
+    quit_requested = asyncio.Event()
+
+    # Local control socket, for scripts and test harnesses
+    control_server = None
+    control_socket = os.getenv("CONTROL_SOCKET", "iothubclient.sock")
+    if control_socket:
+        control_server = Control_Server(control_socket)
+        device_app.register_control_commands(control_server)
+        async def quit_command():
+            quit_requested.set()
+        control_server.register("quit", quit_command)
+        await control_server.start()
+        logger.info("Listening for local commands on %s", control_socket)
 
     # define behavior for halting the application
-    def stdin_listener():
-        pool = concurrent.futures.ThreadPoolExecutor()
-        while True:
-            print("To control the leds from Azure IoT, you can send the following commands through Direct Methods: TurnLedsOff, ScrollLeds")
-            selection = input("Local Commands: \n   Q: quit\n   S: Send batch of messages in sequence\n   A: Send an alert message\n")
-            if selection == "Q" or selection == "q":
-                print("Quitting...")
-                break
-            elif selection == "S" or selection =="s":
-                # send 8 messages one after the other with a sleep
-                for i in range (8):
-                    result = pool.submit(asyncio.run, send_test_message(i)).result()
-                    time.sleep(1)
-                result = pool.submit(asyncio.run, update_device_twin(device_client, led_manager)).result() # Update reported properties
-            elif selection == "A" or selection =="a":
-                # send an alert message
-                result = pool.submit(asyncio.run, send_alert_message()).result()
-
-    loop = asyncio.get_running_loop()
-    user_finished = loop.run_in_executor(None, stdin_listener)
-  
-    # Wait for user to indicate they are done listening for messages
-    await user_finished
+    async def console_command(selection):
+        if selection == "Q" or selection == "q":
+            quit_requested.set()
+            return True
+        elif selection == "S" or selection =="s":
+            # send a batch of messages and wait for it to complete
+            try:
+                await device_app.send_batch_messages()
+            except Exception as e:
+                logger.warning("Sending the messages failed: %s", e)
+        elif selection == "A" or selection =="a":
+            # send an alert message
+            try:
+                await device_app.send_alert_message()
+            except Exception as e:
+                logger.warning("Sending the alert failed: %s", e)
 
-    # Cancel listening
-    led_listeners.cancel()
-    iothub_listeners.cancel()
+    console = Console_Reader(
+        "To control the leds from Azure IoT, you can send the following commands through Direct Methods: TurnLedsOff, ScrollLeds\n"
+        "Local Commands: \n   Q: quit\n   S: Send batch of messages\n   A: Send an alert message\n",
+        console_command)
+    console.start()
+
+    # Wait for user to indicate they are done listening for messages
+    await quit_requested.wait()
+    print("Quitting...")
 
-    # finally, disconnect
-    await device_client.disconnect()
+    await console.stop()
+    if control_server is not None:
+        await control_server.stop()
+    await device_app.stop()
+    log_listener.stop()
+    device_app.print_stats()
+    led_manager.stop_render_process()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Alert latency while the routine lane of Telemetry_Queue is saturated by a telemetry burst.
+# "shared" queues the alerts behind the routine readings like the single queue used to,
+# "alert lane" sends them through their own lane.
+
+import os
+import sys
+import asyncio
+import time
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import Telemetry_Queue
+from FleetSimulator import percentile
+
+ROUND_TRIP = 0.05
+BURST = 400
+ALERTS = 20
+ALERT_INTERVAL = 0.1
+
+class FakeDeviceClient:
+    async def send_message(self, msg):
+        await asyncio.sleep(ROUND_TRIP)
+
+async def send_alert(telemetry_queue, alert_lane, latencies):
+    start = time.perf_counter()
+    await telemetry_queue.send({"Weather": {"Temperature": 80, "Humidity": 50}}, alert=alert_lane)
+    latencies.append(time.perf_counter() - start)
+
+async def run(alert_lane, overflow):
+    telemetry_queue = Telemetry_Queue(FakeDeviceClient(), max_in_flight=4, max_queued=64, batch_size=1, overflow=overflow)
+    telemetry_queue.start()
+    body = {"Weather": {"Temperature": 70, "Humidity": 50}}
+    burst = asyncio.ensure_future(asyncio.gather(*[telemetry_queue.send(body) for i in range(BURST)]))
+    await asyncio.sleep(ALERT_INTERVAL)
+    latencies = []
+    alerts = []
+    for i in range(ALERTS):
+        alerts.append(asyncio.ensure_future(send_alert(telemetry_queue, alert_lane, latencies)))
+        await asyncio.sleep(ALERT_INTERVAL)
+    await asyncio.gather(*alerts)
+    results = await burst
+    await telemetry_queue.stop()
+    return latencies, results.count(False)
+
+async def main():
+    print("alerts      overflow  alert avg (ms)  alert p95 (ms)  alert max (ms)  routine shed")
+    for alert_lane, overflow in ((False, "wait"), (True, "wait"), (True, "shed")):
+        latencies, shed = await run(alert_lane, overflow)
+        print("%-10s  %-8s  %14.0f  %14.0f  %14.0f  %12d" % (
+            "alert lane" if alert_lane else "shared", overflow,
+            sum(latencies) / len(latencies) * 1000, percentile(latencies, 0.95) * 1000, max(latencies) * 1000, shed))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Bytes per reading and encode time of each telemetry codec, for single readings and batches,
+# to choose the encoding that best fits a site's metered connection.
+
+import os
+import sys
+import random
+import timeit
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import create_codec
+
+ITERATIONS = 2000
+
+def reading():
+    body_dict = {}
+    body_dict['Weather'] = {}
+    body_dict['Weather']['Temperature'] = random.randrange(65, 75, 1)
+    body_dict['Weather']['Humidity'] = random.randrange(40, 60, 1)
+    body_dict['Location']='28.424911, -81.468962'
+    return body_dict
+
+if __name__ == "__main__":
+    print("codec    readings  bytes/message  bytes/reading  encode (us)")
+    for name in ("json", "binary", "gzip", "deflate"):
+        codec = create_codec(name)
+        for count in (1, 8, 32):
+            body = reading() if count == 1 else [reading() for i in range(count)]
+            data = codec.encode(body)[0]
+            size = len(data.encode("utf-8") if isinstance(data, str) else data)
+            encode_time = timeit.timeit(lambda: codec.encode(body), number=ITERATIONS) / ITERATIONS
+            print("%-7s  %8d  %13d  %13.1f  %11.1f" % (name, count, size, size / count, encode_time * 1e6))
+    binary = create_codec("binary")
+    batch = [reading() for i in range(8)]
+    decoded = binary.decode(binary.encode(batch)[0])
+    print("binary round trip: " + ("ok" if decoded == [
+        {'Weather': {'Temperature': float(r['Weather']['Temperature']), 'Humidity': float(r['Weather']['Humidity'])}, 'Location': r['Location']}
+        for r in batch
+        ] else "MISMATCH"))
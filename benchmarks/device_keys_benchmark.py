@@ -0,0 +1,32 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Compares keys/second of a loop over derive_device_key with the bulk derivation
+# in DeviceKeys.py, and checks that both give exactly the same keys.
+
+import os
+import sys
+import base64
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceKeys import derive_device_key, derive_device_keys
+
+DEVICES = 100000
+GROUP_KEY = base64.b64encode(os.urandom(64)).decode("utf-8")
+
+if __name__ == "__main__":
+    registration_ids = ["device-%06d" % i for i in range(DEVICES)]
+
+    start = time.perf_counter()
+    expected = [(registration_id, derive_device_key(registration_id, GROUP_KEY)) for registration_id in registration_ids]
+    print("%-20s %10.0f keys/s" % ("derive_device_key", DEVICES / (time.perf_counter() - start)))
+
+    for workers in (1, 2, 4):
+        start = time.perf_counter()
+        results = list(derive_device_keys(registration_ids, GROUP_KEY, workers=workers))
+        rate = DEVICES / (time.perf_counter() - start)
+        print("%-20s %10.0f keys/s  %s" % ("bulk, %d worker(s)" % workers, rate, "identical" if results == expected else "MISMATCH"))
@@ -0,0 +1,65 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Stand-ins for the Azure IoT SDK device and provisioning clients, connected to the in-process
+# Fake_Hub of FleetSimulator.py, with configurable latency and failure rate.
+# install() makes the load_sdk() of IoTHubClient.py or IoTCentralClient.py hand out these clients,
+# so the scripts run unchanged without a hub or a Blinkt!.
+
+import os
+import sys
+import types
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from FleetSimulator import Fake_Hub, FakeIoTHubDeviceClient
+
+hub = Fake_Hub(
+    latency=float(os.getenv("FAKE_HUB_LATENCY", "0.05")),
+    failure_rate=float(os.getenv("FAKE_HUB_FAILURE_RATE", "0"))
+    )
+
+class FakeSdkDeviceClient(FakeIoTHubDeviceClient):
+    @classmethod
+    def create(cls, device_id):
+        client = cls(hub, device_id)
+        hub.clients[device_id] = client
+        return client
+
+    @classmethod
+    def create_from_connection_string(cls, connection_string, **kwargs):
+        return cls.create(dict(item.split("=", 1) for item in connection_string.split(";"))["DeviceId"])
+
+    @classmethod
+    def create_from_symmetric_key(cls, symmetric_key, hostname, device_id, **kwargs):
+        return cls.create(device_id)
+
+class FakeProvisioningDeviceClient:
+    def __init__(self, registration_id):
+        self.registration_id = registration_id
+
+    @classmethod
+    def create_from_symmetric_key(cls, provisioning_host, registration_id, id_scope, symmetric_key, **kwargs):
+        return cls(registration_id)
+
+    async def register(self):
+        await hub.network()
+        return types.SimpleNamespace(
+            status="assigned",
+            registration_state=types.SimpleNamespace(assigned_hub="fake-hub.azure-devices.net", device_id=self.registration_id)
+            )
+
+def install(module):
+    # The real SDK is still imported, so that startup measurements include its import time
+    load_sdk = module.load_sdk
+
+    def load_fake_sdk():
+        load_sdk()
+        module.IoTHubDeviceClient = FakeSdkDeviceClient
+        if hasattr(module, "ProvisioningDeviceClient"):
+            module.ProvisioningDeviceClient = FakeProvisioningDeviceClient
+
+    module.load_sdk = load_fake_sdk
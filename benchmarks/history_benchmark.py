@@ -0,0 +1,49 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Telemetry_History on a full ring of about 28 hours of readings at 10 per second: time to add a
+# reading, and time to answer GetHistory queries compared with scanning every record of the ring.
+
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import Telemetry_History
+
+CAPACITY = 1000000
+SAMPLE_PERIOD = 0.1
+ITERATIONS = 200
+
+def full_scan(history, start, end, limit):
+    # The query answered by reading every record, for comparison
+    records = [record for record in history.record.iter_unpack(history.mm[history.header.size:]) if start <= record[0] <= end]
+    step = max(1, -(-len(records) // limit))
+    return records[::step]
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.bin")
+        history = Telemetry_History(path, CAPACITY)
+        now = time.time()
+        first = now - (CAPACITY + 1000) * SAMPLE_PERIOD
+        start = time.perf_counter()
+        for i in range(CAPACITY + 1000):
+            history.add(70 + i % 10, 50, first + i * SAMPLE_PERIOD)
+        add_time = (time.perf_counter() - start) / (CAPACITY + 1000)
+
+        print("ring of %d records, %.1f MB file, add %.2f us per reading" % (len(history), os.path.getsize(path) / 1e6, add_time * 1e6))
+        print("query                      records  GetHistory (ms)  full scan (ms)")
+        for name, last, limit in (("last minute", 60, 1000), ("last hour, 100 points", 3600, 100), ("whole ring, 100 points", None, 100)):
+            range_start = None if last is None else now - last
+            result = history.query(range_start, None, limit)
+            query_time = timeit.timeit(lambda: history.query(range_start, None, limit), number=ITERATIONS) / ITERATIONS
+            scan_time = timeit.timeit(lambda: full_scan(history, range_start or 0, now, limit), number=3) / 3
+            print("%-25s  %7d  %15.3f  %14.1f" % (name, len(result["records"]), query_time * 1000, scan_time * 1000))
+        history.close()
@@ -0,0 +1,63 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Per frame compute time, and compute and push time, of Led_Manager for strips of increasing
+# length, with the per-Led loop ("loop") and with the NumPy Led_Effects engine ("numpy"). Half of
+# the leds blink, so every frame differs from the previous one and is pushed. Scrolling lights one
+# led per frame: the loop only writes the 2 pixels that changed, the engine pushes whole frames.
+# A 20 fps animation leaves 50 ms per frame, and a Pi Zero is roughly 20 times slower than a PC.
+# The engine also computes a fade and a gradient, which the loop has no equivalent for.
+
+import os
+import sys
+import timeit
+
+os.environ["LED_BACKEND"] = "sim"
+os.environ["LED_SIM_SHOW_DELAY"] = "0"
+os.environ.setdefault("LED_COUNT", "1024")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Led_Manager, Led_Effects
+
+FRAMES = 500
+LED_COUNTS = (8, 64, 256, 1024)
+
+def setup(led_count, engine):
+    effects = Led_Effects(led_count, gamma=2.2) if engine == "numpy" else None
+    led_manager = Led_Manager(led_count=led_count, effects=effects)
+    for i, led in enumerate(led_manager.leds):
+        led.set_color(i % 256, 255 - i % 256, 128)
+        led.set_status(True)
+        led.set_blink(i % 2 == 0)
+    return led_manager
+
+def compute_frames(led_manager):
+    for i in range(FRAMES):
+        led_manager.compute_frame(i % 2 == 0)
+
+def run_frames(led_manager):
+    for i in range(FRAMES):
+        led_manager.render(led_manager.compute_frame(i % 2 == 0))
+
+def scroll_frames(led_manager):
+    for i in range(FRAMES):
+        led_manager.render(led_manager.scroll_frame(i % len(led_manager.leds)))
+
+if __name__ == "__main__":
+    print("leds  engine  compute (ms)  frame (ms)  scroll (ms)  fade (ms)  gradient (ms)")
+    for led_count in LED_COUNTS:
+        for engine in ("loop", "numpy"):
+            led_manager = setup(led_count, engine)
+            compute = timeit.timeit(lambda: compute_frames(led_manager), number=1) / FRAMES
+            frame = timeit.timeit(lambda: run_frames(led_manager), number=1) / FRAMES
+            scroll = timeit.timeit(lambda: scroll_frames(led_manager), number=1) / FRAMES
+            if engine == "numpy":
+                effects = led_manager.effects
+                fade = timeit.timeit(lambda: effects.blend((0, 0, 0), 0.5), number=FRAMES) / FRAMES
+                gradient = timeit.timeit(lambda: effects.gradient((255, 0, 0), (0, 0, 255)), number=FRAMES) / FRAMES
+                effects_times = "%9.3f  %13.3f" % (fade * 1000, gradient * 1000)
+            else:
+                effects_times = "%9s  %13s" % ("-", "-")
+            print("%4d  %-6s  %12.3f  %10.3f  %11.3f  %s" % (led_count, engine, compute * 1000, frame * 1000, scroll * 1000, effects_times))
@@ -0,0 +1,52 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Measures event loop lag while the leds scroll, with frames pushed from the event loop
+# and with the renderer process. Uses the simulated led backend, so no Blinkt! is needed.
+
+import os
+import sys
+import asyncio
+import time
+
+os.environ["LED_BACKEND"] = "sim"
+os.environ.setdefault("LED_SIM_SHOW_DELAY", "0.01")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Led_Manager
+
+DURATION = 3.0
+
+led_manager = Led_Manager()
+TICK = 0.005
+
+async def measure_lag():
+    lags = []
+    end = time.monotonic() + DURATION
+    while time.monotonic() < end:
+        start = time.monotonic()
+        await asyncio.sleep(TICK)
+        lags.append(time.monotonic() - start - TICK)
+    return lags
+
+async def run(mode):
+    if mode == "process":
+        led_manager.start_render_process()
+    led_manager.set_all_leds_color(255, 255, 255)
+    led_manager.start_scrolling()
+    scroll = asyncio.ensure_future(led_manager.scroll_leds_task())
+    lags = await measure_lag()
+    led_manager.stop_scrolling()
+    scroll.cancel()
+    led_manager.stop_render_process()
+    lags.sort()
+    return sum(lags) / len(lags), lags[int(len(lags) * 0.99)], lags[-1]
+
+if __name__ == "__main__":
+    print("show() takes %s s, scrolling for %.0f s" % (os.environ["LED_SIM_SHOW_DELAY"], DURATION))
+    print("mode     avg lag (ms)  p99 lag (ms)  max lag (ms)")
+    for mode in ("inline", "process"):
+        avg, p99, worst = asyncio.run(run(mode))
+        print("%-7s  %12.2f  %12.2f  %12.2f" % (mode, avg * 1000, p99 * 1000, worst * 1000))
@@ -0,0 +1,79 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Event loop lag during a burst of telemetry, with the log written to a simulated 115200 baud
+# serial console. "blocking" writes every line, including the pretty printed JSON, from the
+# event loop like the former print() calls did. "queued" uses setup_logging(): rate limited,
+# JSON only at debug level, and written by a separate thread.
+
+import os
+import sys
+import asyncio
+import logging
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ["FAKE_HUB_LATENCY"] = "0.01"
+import fake_sdk
+import IoTHubClient
+from DeviceCommon import Led_Manager
+from IoTHubClient import Device_App, Metrics, logger, setup_logging
+
+fake_sdk.install(IoTHubClient)
+
+MESSAGES = 200
+BAUD_RATE = 115200
+
+class Serial_Console:
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        # 10 bits per byte on the line
+        self.bytes = self.bytes + len(text)
+        time.sleep(len(text) * 10 / BAUD_RATE)
+
+    def flush(self):
+        pass
+
+async def burst(mode):
+    console = Serial_Console()
+    listener = None
+    if mode == "blocking":
+        handler = logging.StreamHandler(console)
+        logger.handlers = [handler]
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+    else:
+        listener = setup_logging(console)
+
+    IoTHubClient.load_sdk()
+    device_client = IoTHubClient.IoTHubDeviceClient.create_from_connection_string("HostName=fake;DeviceId=bench-" + mode + ";SharedAccessKey=a2V5")
+    device_app = Device_App(device_client, "bench-" + mode, Led_Manager())
+    await device_app.start()
+
+    metrics = Metrics()
+    lag_monitor = asyncio.ensure_future(metrics.monitor_loop_lag(0.01))
+    start = time.perf_counter()
+    await device_app.send_messages(MESSAGES)
+    elapsed = time.perf_counter() - start
+    lag_monitor.cancel()
+    await asyncio.gather(lag_monitor, return_exceptions=True)
+
+    await device_app.stop()
+    if listener is not None:
+        listener.stop()
+    lag = metrics.histogram("event_loop_lag_seconds").summary()
+    return elapsed, lag, console.bytes
+
+async def main():
+    print("mode       burst (s)  lag avg (ms)  lag p95 (ms)  lag max (ms)  console bytes")
+    for mode in ("blocking", "queued"):
+        elapsed, lag, console_bytes = await burst(mode)
+        print("%-9s  %9.2f  %12.2f  %12.2f  %12.2f  %13d" % (mode, elapsed, lag["avg_ms"], lag["p95_ms"], lag["max_ms"], console_bytes))
+
+if __name__ == "__main__":
+    asyncio.run(main())
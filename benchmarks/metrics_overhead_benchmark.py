@@ -0,0 +1,55 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Cost of the always-on instrumentation: recording a latency, timing an SDK call through
+# Instrumented_Device_Client and timing a led frame, compared with the same work without it.
+
+import os
+import sys
+import asyncio
+import time
+import timeit
+
+os.environ.setdefault("LED_BACKEND", "sim")
+os.environ.setdefault("LED_SIM_SHOW_DELAY", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Led_Manager
+from IoTHubClient import Latency_Histogram, Metrics, Instrumented_Device_Client
+
+ITERATIONS = 20000
+
+class FakeDeviceClient:
+    async def send_message(self, msg):
+        pass
+
+async def time_sends(device_client):
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        await device_client.send_message(None)
+    return (time.perf_counter() - start) / ITERATIONS
+
+def render_frames(led_manager):
+    frames = [[(i, 0, 0)] * 8 for i in range(2)]
+    for i in range(ITERATIONS):
+        led_manager.render(frames[i % 2])
+
+if __name__ == "__main__":
+    histogram = Latency_Histogram()
+    record = timeit.timeit(lambda: histogram.record(0.012), number=ITERATIONS) / ITERATIONS
+
+    raw = asyncio.run(time_sends(FakeDeviceClient()))
+    instrumented = asyncio.run(time_sends(Instrumented_Device_Client(FakeDeviceClient(), Metrics())))
+
+    led_manager = Led_Manager()
+    plain_render = timeit.timeit(lambda: render_frames(led_manager), number=1) / ITERATIONS
+    led_manager.render_latency = Latency_Histogram()
+    timed_render = timeit.timeit(lambda: render_frames(led_manager), number=1) / ITERATIONS
+
+    print("histogram record          %8.2f us" % (record * 1e6))
+    print("send_message raw          %8.2f us" % (raw * 1e6))
+    print("send_message instrumented %8.2f us  (+%.2f us per call)" % (instrumented * 1e6, (instrumented - raw) * 1e6))
+    print("led frame                 %8.2f us" % (plain_render * 1e6))
+    print("led frame timed           %8.2f us  (+%.2f us per frame)" % (timed_render * 1e6, (timed_render - plain_render) * 1e6))
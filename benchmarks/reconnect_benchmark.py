@@ -0,0 +1,72 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Time to recover from network outages of increasing length, with a device connected to the
+# fake hub of FleetSimulator.py. Readings and twin changes made while offline must reach the
+# hub once the connection is back.
+
+import os
+import sys
+import asyncio
+import contextlib
+import tempfile
+import time
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Led_Manager
+from IoTHubClient import Device_App, Telemetry_Spool
+from FleetSimulator import Fake_Hub
+
+LATENCY = 0.02
+INITIAL_BACKOFF = 0.1
+OFFLINE_MESSAGES = 20
+
+async def wait_for(condition, timeout=30):
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            raise TimeoutError("condition not met after %d s" % timeout)
+        await asyncio.sleep(0.005)
+
+async def run(failing_connects, spool_dir):
+    hub = Fake_Hub(LATENCY)
+    device_client = hub.create_client("bench")
+    device_app = Device_App(device_client, "bench", Led_Manager(), Telemetry_Spool(spool_dir, sync=False))
+    device_app.connection_supervisor.initial_backoff = INITIAL_BACKOFF
+    await device_app.start()
+
+    device_client.drop(failing_connects)
+    dropped = time.monotonic()
+    for i in range(OFFLINE_MESSAGES):
+        await device_app.send_test_message(i % 8)
+    device_app.led_manager.set_led(0, True, 1, 2, 3, False)
+    device_app.twin_reporter.report()
+
+    await wait_for(lambda: device_app.connection_supervisor.reconnects == 1)
+    recovered = time.monotonic()
+    await wait_for(lambda: hub.reported_state["bench"].get("led1_r") == 1)
+    twin_synced = time.monotonic()
+    await wait_for(lambda: device_app.telemetry_queue.drained_readings == OFFLINE_MESSAGES)
+    drained = time.monotonic()
+
+    # Listeners are subscribed again after the reconnect
+    hub.invoke_method("bench", "TurnLedsOff")
+    await wait_for(lambda: len(hub.method_latencies) == 1)
+
+    await device_app.stop()
+    return recovered - dropped, twin_synced - dropped, drained - dropped, device_app.connection_supervisor.connect_attempts - 1
+
+async def main():
+    print("failed connects  recover (ms)  twin synced (ms)  spool drained (ms)  attempts")
+    for failing_connects in (0, 1, 3, 5):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                recover, twin_synced, drained, attempts = await run(failing_connects, spool_dir)
+            print("%15d  %12.0f  %16.0f  %18.0f  %8d" % (failing_connects, recover * 1000, twin_synced * 1000, drained * 1000, attempts))
+
+if __name__ == "__main__":
+    asyncio.run(main())
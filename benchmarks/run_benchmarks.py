@@ -0,0 +1,267 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Benchmark suite run against the fake SDK clients of fake_sdk.py and the simulated leds.
+# Measures telemetry throughput, twin patch apply and round trip times, direct method round trips,
+# led frame rate, and startup time and memory of both scripts. Results are written as JSON, and
+# can be compared with the results of a previous release to catch regressions:
+#   python benchmarks/run_benchmarks.py --output results.json
+#   python benchmarks/run_benchmarks.py --compare results.json
+
+import os
+import sys
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_sdk
+from fake_sdk import hub
+import IoTHubClient
+from DeviceCommon import Led_Manager
+from IoTHubClient import Device_App, Telemetry_Spool, Twin_Property_Index, Latency_Histogram
+from FleetSimulator import percentile
+
+fake_sdk.install(IoTHubClient)
+
+def quiet():
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+def latency_summary(values):
+    return (
+        sum(values) / len(values) * 1000 if values else 0.0,
+        percentile(values, 0.95) * 1000
+        )
+
+async def start_device_app(spool_dir):
+    IoTHubClient.load_sdk()
+    device_client = IoTHubClient.IoTHubDeviceClient.create_from_connection_string("HostName=fake;DeviceId=bench;SharedAccessKey=a2V5")
+    device_app = Device_App(device_client, "bench", Led_Manager(), Telemetry_Spool(spool_dir, sync=False))
+    device_app.connection_supervisor.initial_backoff = 0.05
+    with quiet():
+        await device_app.start()
+    return device_app
+
+async def telemetry_benchmark(messages):
+    with tempfile.TemporaryDirectory() as spool_dir:
+        device_app = await start_device_app(spool_dir)
+        sent_before = hub.messages
+        with quiet():
+            start = time.perf_counter()
+            result = await device_app.send_messages(messages)
+            elapsed = time.perf_counter() - start
+            await device_app.stop()
+    return {
+        "messages": messages,
+        "sent": result["sent"],
+        "spooled": result["stored"],
+        "messages_per_s": (hub.messages - sent_before) / elapsed
+        }
+
+async def twin_benchmark(patches):
+    # Patch apply time on the device, then desired to reported round trip through the hub
+    led_manager = Led_Manager()
+    index = Twin_Property_Index(len(led_manager.leds))
+    patch = {"$version": 2}
+    for i in range(8):
+        patch.update({"led%d_status" % (i + 1): True, "led%d_r" % (i + 1): i, "led%d_g" % (i + 1): 2 * i, "led%d_b" % (i + 1): 3 * i})
+    apply_time = timeit.timeit(lambda: index.apply(led_manager, patch), number=2000) / 2000
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+        device_app = await start_device_app(spool_dir)
+        hub.twin_latencies.clear()
+        with quiet():
+            for version in range(patches):
+                hub.update_desired("bench", {"led1_r": version % 256, "led1_status": True, "$version": version + 3})
+                await asyncio.sleep(device_app.twin_reporter.window + hub.latency * 3)
+            await device_app.stop()
+    avg, p95 = latency_summary(hub.twin_latencies)
+    return {"patch_keys": len(patch), "apply_us": apply_time * 1e6, "round_trips": len(hub.twin_latencies), "rtt_avg_ms": avg, "rtt_p95_ms": p95}
+
+async def method_benchmark(calls):
+    with tempfile.TemporaryDirectory() as spool_dir:
+        device_app = await start_device_app(spool_dir)
+        hub.method_latencies.clear()
+        with quiet():
+            for i in range(calls):
+                # Responses lost to injected failures are given up after a timeout
+                hub.pending_methods.clear()
+                hub.invoke_method("bench", random.choice(["TurnLedsOff", "ScrollLeds"]))
+                timeout = time.monotonic() + 1 + hub.latency * 10
+                while hub.pending_methods and time.monotonic() < timeout:
+                    await asyncio.sleep(0.001)
+            await device_app.stop()
+    avg, p95 = latency_summary(hub.method_latencies)
+    return {"calls": calls, "completed": len(hub.method_latencies), "rtt_avg_ms": avg, "rtt_p95_ms": p95}
+
+async def led_benchmark(duration):
+    led_manager = Led_Manager()
+    led_manager.render_latency = Latency_Histogram()
+    led_manager.set_all_leds_color(255, 255, 255)
+    led_manager.start_scrolling()
+    with quiet():
+        scroll_task = asyncio.ensure_future(led_manager.scroll_leds_task())
+        await asyncio.sleep(duration)
+        scroll_task.cancel()
+        await asyncio.gather(scroll_task, return_exceptions=True)
+    timing = led_manager.frame_clock.stats()
+    return {
+        "target_fps": timing["target_fps"],
+        "achieved_fps": timing["achieved_fps"],
+        "avg_jitter_ms": timing["avg_jitter_ms"],
+        "max_jitter_ms": timing["max_jitter_ms"],
+        "render_avg_ms": led_manager.render_latency.summary()["avg_ms"]
+        }
+
+# Startup is measured in a child process, so that the SDK import and the memory are not shared
+# with the other benchmarks
+async def startup_child(script, control_socket):
+    module = __import__(script)
+    fake_sdk.install(module)
+    main_task = asyncio.ensure_future(module.main())
+    # The control socket opens once the device is connected and has reported its twin
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(control_socket)
+            break
+        except OSError:
+            if main_task.done():
+                await main_task
+            await asyncio.sleep(0.01)
+    result = {"startup_s": time.monotonic() - module.boot_started, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    print("STARTUP_RESULT " + json.dumps(result), flush=True)
+    writer.write(b"quit\n")
+    await writer.drain()
+    await reader.readline()
+    writer.close()
+    await main_task
+
+def startup_benchmark(script, runs, workdir):
+    env = dict(os.environ)
+    env.update({
+        "LED_BACKEND": "sim",
+        "IOTHUB_DEVICE_CONNECTION_STRING": "HostName=fake;DeviceId=bench;SharedAccessKey=a2V5",
+        "PROVISIONING_HOST": "fake", "PROVISIONING_IDSCOPE": "fake", "PROVISIONING_DEVICE_ID": "bench",
+        "PROVISIONING_MASTER_SYMMETRIC_KEY": base64.b64encode(b"k" * 32).decode(),
+        "CONTROL_SOCKET": os.path.join(workdir, script + ".sock"),
+        "TELEMETRY_SPOOL_DIR": os.path.join(workdir, "spool"),
+        "DPS_CACHE_FILE": os.path.join(workdir, "dps_registration.json"),
+        "TWIN_SNAPSHOT_FILE": os.path.join(workdir, "desired_state.json"),
+        "HISTORY_FILE": os.path.join(workdir, "telemetry_history.bin"),
+        "MODEL_CACHE_DIR": os.path.join(workdir, "model_cache"),
+        "METRICS_PORT": ""
+        })
+    results = []
+    for run in range(runs):
+        # startup_s is counted from the import of the script, ready_s from the start of the process
+        start = time.perf_counter()
+        result = None
+        output = []
+        with subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--startup-child", script],
+                env=env, cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True) as child:
+            for line in child.stdout:
+                output.append(line)
+                if line.startswith("STARTUP_RESULT "):
+                    result = json.loads(line[len("STARTUP_RESULT "):])
+                    result["ready_s"] = time.perf_counter() - start
+        if result is None or child.returncode != 0:
+            raise RuntimeError(script + " startup failed:\n" + "".join(output[-40:]))
+        results.append(result)
+    # The first run is cold, later runs use the model and DPS caches of IoT Central
+    summary = {"cold_" + key: value for key, value in results[0].items()}
+    if runs > 1:
+        for key in results[1]:
+            summary["warm_" + key] = sum(result[key] for result in results[1:]) / (runs - 1)
+    return summary
+
+async def run_suite(args):
+    hub.latency = args.latency
+    hub.failure_rate = args.failure_rate
+    results = {}
+    results["telemetry"] = await telemetry_benchmark(args.messages)
+    results["twin"] = await twin_benchmark(args.patches)
+    results["methods"] = await method_benchmark(args.calls)
+    results["leds"] = await led_benchmark(args.led_seconds)
+    return results
+
+def compare(results, baseline, threshold):
+    # Only rates, times and sizes are compared: rates should not go down, the others not go up
+    regressions = []
+    for benchmark, values in results.items():
+        for key, value in values.items():
+            old = baseline.get(benchmark, {}).get(key)
+            if not old:
+                continue
+            if key.endswith("_per_s") or key.endswith("fps"):
+                change = (old - value) / old
+            elif key.endswith(("_ms", "_us", "_s", "_kb")):
+                change = (value - old) / old
+            else:
+                continue
+            if change > threshold:
+                regressions.append("%s.%s: %.4g -> %.4g (%+.0f%%)" % (benchmark, key, old, value, change * 100))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite against fake SDK clients")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as a regression")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated network round trip in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of SDK calls failing with a connection error")
+    parser.add_argument("--messages", type=int, default=200, help="telemetry messages to send")
+    parser.add_argument("--patches", type=int, default=10, help="desired property patches to apply")
+    parser.add_argument("--calls", type=int, default=50, help="direct methods to invoke")
+    parser.add_argument("--led-seconds", type=float, default=3, help="seconds of led animation")
+    parser.add_argument("--startup-runs", type=int, default=3, help="startups of each script, 0 to skip")
+    parser.add_argument("--startup-child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_child:
+        asyncio.run(startup_child(args.startup_child, os.environ["CONTROL_SOCKET"]))
+        sys.exit()
+
+    results = asyncio.run(run_suite(args))
+    if args.startup_runs > 0:
+        with tempfile.TemporaryDirectory() as workdir:
+            results["startup_iothub"] = startup_benchmark("IoTHubClient", args.startup_runs, workdir)
+            results["startup_central"] = startup_benchmark("IoTCentralClient", args.startup_runs, workdir)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "settings": {"latency": args.latency, "failure_rate": args.failure_rate},
+        "results": results
+        }
+    for benchmark, values in results.items():
+        print(benchmark)
+        for key, value in values.items():
+            print("   %-24s %s" % (key, round(value, 3) if isinstance(value, float) else value))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)["results"], args.threshold)
+        if regressions:
+            print("Regressions:")
+            for regression in regressions:
+                print("   " + regression)
+            sys.exit(1)
+        print("No regressions")
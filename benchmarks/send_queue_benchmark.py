@@ -0,0 +1,49 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Measures Telemetry_Queue throughput against a fake IoTHubDeviceClient
+# whose send_message only waits for a simulated network round trip.
+
+import os
+import sys
+import asyncio
+import time
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import Telemetry_Queue
+
+ROUND_TRIP = 0.05
+MESSAGES = 200
+
+class FakeDeviceClient:
+    def __init__(self, round_trip):
+        self.round_trip = round_trip
+        self.messages = 0
+
+    async def send_message(self, msg):
+        await asyncio.sleep(self.round_trip)
+        self.messages = self.messages + 1
+
+async def run(max_in_flight, batch_size):
+    device_client = FakeDeviceClient(ROUND_TRIP)
+    telemetry_queue = Telemetry_Queue(device_client, max_in_flight=max_in_flight, batch_size=batch_size, batch_window=0.01)
+    telemetry_queue.start()
+    body = {'Weather': {'Temperature': 70, 'Humidity': 50}, 'Location': '28.424911, -81.468962'}
+    start = time.perf_counter()
+    sent = [await telemetry_queue.put(body) for i in range(MESSAGES)]
+    await asyncio.gather(*sent)
+    elapsed = time.perf_counter() - start
+    await telemetry_queue.stop()
+    return MESSAGES / elapsed, device_client.messages
+
+if __name__ == "__main__":
+    print("Round trip %d ms, %d readings" % (ROUND_TRIP * 1000, MESSAGES))
+    print("in-flight  batch  readings/s  messages")
+    for batch_size in (1, 8):
+        for max_in_flight in (1, 2, 4, 8, 16):
+            rate, messages = asyncio.run(run(max_in_flight, batch_size))
+            print("%9d  %5d  %10.1f  %8d" % (max_in_flight, batch_size, rate, messages))
@@ -0,0 +1,60 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Compares the time to apply a desired properties patch with Twin_Property_Index
+# against the previous loop that built and probed all 40 keys for every patch.
+
+import os
+import sys
+import timeit
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Led_Manager
+from IoTHubClient import Twin_Property_Index
+
+ITERATIONS = 20000
+
+def apply_patch_loop(led_manager, patch):
+    for i in range (8):
+        led_status = led_manager.leds[i].status
+        led_blink = led_manager.leds[i].blink
+        led_r = led_manager.leds[i].r
+        led_g = led_manager.leds[i].g
+        led_b = led_manager.leds[i].b
+        key='led'+ str(i+1) +'_status'
+        if key in patch:
+            led_status = patch[key]
+        key='led'+ str(i+1) +'_blink'
+        if key in patch:
+            led_blink = patch[key]
+        key='led'+ str(i+1) +'_r'
+        if key in patch:
+            led_r = patch[key]
+        key='led'+ str(i+1) +'_g'
+        if key in patch:
+            led_g = patch[key]
+        key='led'+ str(i+1) +'_b'
+        if key in patch:
+            led_b = patch[key]
+        led_manager.set_led(i, led_status, led_r, led_g, led_b, led_blink)
+
+if __name__ == "__main__":
+    led_manager = Led_Manager()
+    index = Twin_Property_Index(len(led_manager.leds))
+    small_patch = {"led3_status": True, "$version": 2}
+    large_patch = {"$version": 3}
+    for i in range(8):
+        large_patch['led' + str(i+1) + '_status'] = True
+        large_patch['led' + str(i+1) + '_blink'] = False
+        large_patch['led' + str(i+1) + '_r'] = 10
+        large_patch['led' + str(i+1) + '_g'] = 20
+        large_patch['led' + str(i+1) + '_b'] = 30
+    print("patch   keys  loop (us)  index (us)")
+    for name, patch in (("small", small_patch), ("large", large_patch)):
+        loop = timeit.timeit(lambda: apply_patch_loop(led_manager, patch), number=ITERATIONS) / ITERATIONS
+        indexed = timeit.timeit(lambda: index.apply(led_manager, patch), number=ITERATIONS) / ITERATIONS
+        print("%-6s  %4d  %9.2f  %10.2f" % (name, len(patch), loop * 1e6, indexed * 1e6))
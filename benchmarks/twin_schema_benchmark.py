@@ -0,0 +1,53 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Size of the reported properties document and of a desired properties patch setting every led,
+# time to apply that patch and time to build the reported properties, for the per led ("legacy")
+# and the compact twin schema, on strips of 8, 64 and 256 leds. The compact schema is measured
+# with the per-Led loop and with the NumPy Led_Effects engine.
+
+import os
+import sys
+import json
+import timeit
+
+os.environ["LED_BACKEND"] = "sim"
+os.environ["LED_COUNT"] = "256"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Led_Manager, Led_Effects
+from IoTHubClient import Twin_Property_Index
+
+ITERATIONS = 500
+LED_COUNTS = (8, 64, 256)
+
+def setup(led_count, engine):
+    effects = Led_Effects(led_count) if engine == "numpy" else None
+    led_manager = Led_Manager(led_count=led_count, effects=effects)
+    for i, led in enumerate(led_manager.leds):
+        led.set_color(i % 256, 255 - i % 256, 128)
+        led.set_status(i % 3 == 0)
+        led.set_blink(i % 5 == 0)
+    return led_manager
+
+def measure(led_count, schema, engine):
+    # No model file, so that the per led properties cover the whole strip
+    index = Twin_Property_Index(led_count, model_path="", compact=schema == "compact")
+    led_manager = setup(led_count, engine)
+    reported = index.reported_properties(led_manager)
+    patch = dict(reported)
+    patch["$version"] = 2
+    target = setup(led_count, engine)
+    apply_time = timeit.timeit(lambda: index.apply(target, patch), number=ITERATIONS) / ITERATIONS
+    report_time = timeit.timeit(lambda: index.reported_properties(led_manager), number=ITERATIONS) / ITERATIONS
+    return len(reported), len(json.dumps(reported)), len(json.dumps(patch)), apply_time, report_time
+
+if __name__ == "__main__":
+    print("leds  schema   engine  properties  reported (bytes)  patch (bytes)  apply (us)  report (us)")
+    for led_count in LED_COUNTS:
+        for schema, engine in (("legacy", "loop"), ("compact", "loop"), ("compact", "numpy")):
+            properties, reported_bytes, patch_bytes, apply_time, report_time = measure(led_count, schema, engine)
+            print("%4d  %-7s  %-6s  %10d  %16d  %13d  %10.1f  %11.1f" % (
+                led_count, schema, engine, properties, reported_bytes, patch_bytes, apply_time * 1e6, report_time * 1e6))
@@ -0,0 +1,77 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Compact twin form of the leds, through the Led objects and through the NumPy Led_Effects engine,
+# and the unknown and rejected keys of a patch in the hub client.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import compact_led_fields, pack_compact_leds, set_compact_leds, Led_Manager, Led_Effects
+from IoTHubClient import Twin_Property_Index
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def leds(led_count, engine):
+    effects = Led_Effects(led_count) if engine == "numpy" else None
+    return Led_Manager(led_count=led_count, effects=effects)
+
+class Compact_Leds_Test(unittest.TestCase):
+    engines = ("loop", "numpy") if numpy is not None else ("loop",)
+
+    def test_round_trip(self):
+        patch = {"leds_rgb": "ff000000ff000000ff", "leds_on": "5", "leds_blink": "402"}
+        for engine in self.engines:
+            led_manager = leds(11, engine)
+            for name, value in patch.items():
+                self.assertTrue(set_compact_leds(led_manager.leds, name, value, led_manager.effects))
+            self.assertEqual([led.status for led in led_manager.leds[:4]], [True, False, True, False])
+            self.assertTrue(led_manager.leds[10].blink)
+            self.assertEqual((led_manager.leds[1].r, led_manager.leds[1].g, led_manager.leds[1].b), (0, 255, 0))
+            packed = {name: pack_compact_leds(led_manager.leds, name, led_manager.effects) for name in compact_led_fields}
+            self.assertEqual(packed["leds_on"], "5")
+            self.assertEqual(packed["leds_blink"], "402")
+            self.assertTrue(packed["leds_rgb"].startswith(patch["leds_rgb"]))
+
+    def test_engine_and_loop_agree(self):
+        if numpy is None:
+            self.skipTest("numpy is not installed")
+        loop, engine = leds(20, "loop"), leds(20, "numpy")
+        for led_manager in (loop, engine):
+            for i, led in enumerate(led_manager.leds):
+                led.set_color(i * 12, 255 - i, i)
+                led.set_status(i % 3 == 0)
+                led.set_blink(i % 7 == 0)
+        for name in compact_led_fields:
+            self.assertEqual(pack_compact_leds(loop.leds, name), pack_compact_leds(engine.leds, name, engine.effects))
+
+    def test_undecodable_values_are_rejected(self):
+        for engine in self.engines:
+            led_manager = leds(8, engine)
+            for name, value in (("leds_rgb", "zz"), ("leds_on", "-1"), ("leds_blink", 5), ("leds_on", None)):
+                self.assertFalse(set_compact_leds(led_manager.leds, name, value, led_manager.effects))
+
+    def test_hub_patch_splits_unknown_and_rejected(self):
+        index = Twin_Property_Index(8, model_path="")
+        led_manager = leds(8, "loop")
+        version, unknown, rejected = index.apply(led_manager, {
+            "$version": 3, "leds_on": "ff", "leds_rgb": "not hex", "led1_r": 300, "led2_g": 7, "color": 1
+            })
+        self.assertEqual(version, 3)
+        self.assertEqual(unknown, ["color"])
+        self.assertEqual(sorted(rejected), ["led1_r", "leds_rgb"])
+        self.assertTrue(all(led.status for led in led_manager.leds))
+        self.assertEqual(led_manager.leds[1].g, 7)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Connection_Supervisor against a fake client whose connection can be dropped.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import asyncio
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Connection_Supervisor
+
+# Device client that fails its next failing_connects connects, and loses its connection on drop()
+class Dropping_Client:
+    def __init__(self, failing_connects=0):
+        self.connected = False
+        self.failing_connects = failing_connects
+        self.connect_calls = 0
+        self.on_connection_state_change = None
+
+    async def connect(self):
+        self.connect_calls = self.connect_calls + 1
+        if self.failing_connects > 0:
+            self.failing_connects = self.failing_connects - 1
+            raise ConnectionError("simulated connection failure")
+        self.connected = True
+
+    def drop(self, failing_connects=0):
+        self.connected = False
+        self.failing_connects = failing_connects
+        if self.on_connection_state_change is not None:
+            self.on_connection_state_change()
+
+class Connection_Supervisor_Test(unittest.IsolatedAsyncioTestCase):
+    async def test_connect_retries_until_connected(self):
+        client = Dropping_Client(failing_connects=2)
+        supervisor = Connection_Supervisor(client, initial_backoff=0.01, max_backoff=0.02)
+        await supervisor.connect()
+        self.assertEqual(supervisor.state, "connected")
+        self.assertEqual(client.connect_calls, 3)
+        self.assertEqual(supervisor.stats()["connect_attempts"], 3)
+
+    async def test_connect_gives_up_after_max_attempts(self):
+        client = Dropping_Client(failing_connects=5)
+        supervisor = Connection_Supervisor(client, initial_backoff=0.01, max_backoff=0.02)
+        with self.assertRaises(ConnectionError):
+            await supervisor.connect(max_attempts=2)
+        self.assertEqual(supervisor.state, "disconnected")
+        self.assertEqual(client.connect_calls, 2)
+
+    async def test_connect_raises_errors_that_are_not_retried(self):
+        client = Dropping_Client(failing_connects=5)
+        supervisor = Connection_Supervisor(client, initial_backoff=0.01, max_backoff=0.02)
+        with self.assertRaises(ConnectionError):
+            await supervisor.connect(retry_if=lambda e: client.connect_calls < 3)
+        self.assertEqual(client.connect_calls, 3)
+
+    async def test_reconnects_and_resumes_after_drop(self):
+        client = Dropping_Client()
+        resumed = asyncio.Event()
+
+        async def on_resume():
+            resumed.set()
+
+        supervisor = Connection_Supervisor(client, on_resume, initial_backoff=0.01, max_backoff=0.02, check_interval=10)
+        await supervisor.connect()
+        task = asyncio.create_task(supervisor.run())
+        try:
+            # The state change callback wakes the supervisor up well before check_interval
+            client.drop(failing_connects=1)
+            await asyncio.wait_for(resumed.wait(), 2)
+        finally:
+            task.cancel()
+        self.assertTrue(client.connected)
+        stats = supervisor.stats()
+        self.assertEqual(stats["state"], "connected")
+        self.assertEqual(stats["disconnects"], 1)
+        self.assertEqual(stats["reconnects"], 1)
+        self.assertEqual(stats["connect_attempts"], 3)
+        self.assertGreater(stats["max_time_to_recover_s"], 0)
+
+    async def test_polls_clients_without_state_callback(self):
+        client = Dropping_Client()
+        supervisor = Connection_Supervisor(client, initial_backoff=0.01, max_backoff=0.02, check_interval=0.05)
+        await supervisor.connect()
+        task = asyncio.create_task(supervisor.run())
+        try:
+            client.on_connection_state_change = None
+            client.drop()
+            for _ in range(40):
+                if supervisor.reconnects:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            task.cancel()
+        self.assertEqual(supervisor.stats()["reconnects"], 1)
+        self.assertTrue(client.connected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Console_Reader: commands from a pipe read on the event loop, from a stream that can't be polled,
+# and stopping while the console is still open.
+# Run with: python -m pytest tests
+
+import io
+import os
+import sys
+import asyncio
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Console_Reader
+
+class Console_Reader_Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.selections = []
+
+    async def handle(self, selection):
+        self.selections.append(selection)
+        return selection == "Q"
+
+    async def test_pipe_lines_until_quit(self):
+        r, w = os.pipe()
+        with os.fdopen(r) as stream:
+            console = Console_Reader("", self.handle, stream)
+            console.start()
+            os.write(w, b"S\nA")
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.selections, ["S"])
+            os.write(w, b"\nQ\nS\n")
+            await asyncio.wait_for(console.task, 1)
+            os.close(w)
+        self.assertEqual(self.selections, ["S", "A", "Q"])
+
+    async def test_stream_that_cant_be_polled(self):
+        console = Console_Reader("", self.handle, io.StringIO("S\nS\n"))
+        console.start()
+        await asyncio.wait_for(console.task, 1)
+        self.assertEqual(self.selections, ["S", "S"])
+
+    async def test_stop_with_the_console_open(self):
+        r, w = os.pipe()
+        with os.fdopen(r) as stream:
+            console = Console_Reader("", self.handle, stream)
+            console.start()
+            await asyncio.sleep(0.01)
+            await console.stop()
+            self.assertTrue(console.task.done())
+            self.assertIsNone(console.fd)
+        os.close(w)
+
+if __name__ == "__main__":
+    unittest.main()
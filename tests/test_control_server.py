@@ -0,0 +1,94 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Control_Server commands over its Unix domain socket, and stopping it while a command runs.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Control_Server, parse_bool
+
+class Control_Server_Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "control.sock")
+        self.server = Control_Server(self.path)
+        self.sent = []
+
+        async def send(count=1, rate=0.0):
+            self.sent.append((count, rate))
+            return {"sent": count}
+
+        self.server.register("send", send, (("count", int), ("rate", float)))
+        await self.server.start()
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+        self.directory.cleanup()
+
+    async def command(self, reader, writer, line):
+        writer.write((line + "\n").encode("utf-8"))
+        await writer.drain()
+        return json.loads(await reader.readline())
+
+    async def test_word_and_json_commands(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            self.assertEqual(await self.command(reader, writer, "send 5 2.5"), {"ok": True, "result": {"sent": 5}})
+            self.assertEqual(await self.command(reader, writer, '{"command": "send", "count": 3}'), {"ok": True, "result": {"sent": 3}})
+            reply = await self.command(reader, writer, "launch")
+            self.assertFalse(reply["ok"])
+            self.assertIn("unknown command", reply["error"])
+            reply = await self.command(reader, writer, "send 1 2 3")
+            self.assertFalse(reply["ok"])
+        finally:
+            writer.close()
+        self.assertEqual(self.sent, [(5, 2.5), (3, 0.0)])
+        self.assertEqual(self.server.handled_commands, 4)
+
+    async def test_stop_does_not_wait_for_long_commands(self):
+        started = asyncio.Event()
+
+        async def long_command():
+            started.set()
+            await asyncio.sleep(60)
+
+        self.server.register("long", long_command)
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        writer.write(b"long\n")
+        await writer.drain()
+        await asyncio.wait_for(started.wait(), 2)
+        await asyncio.wait_for(self.server.stop(), 2)
+        self.assertEqual(self.server.clients, {})
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(await reader.read(), b"")
+        writer.close()
+
+    async def test_stop_with_idle_clients_logs_nothing(self):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        self.assertEqual(await self.command(reader, writer, "send"), {"ok": True, "result": {"sent": 1}})
+        await asyncio.wait_for(self.server.stop(), 2)
+        await asyncio.sleep(0.05)
+        self.assertEqual(errors, [])
+        writer.close()
+
+    def test_parse_bool(self):
+        for value in ("1", "true", "On", "YES", True, 1):
+            self.assertTrue(parse_bool(value))
+        for value in ("0", "false", "off", "", False, 0):
+            self.assertFalse(parse_bool(value))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Desired_State_Snapshot on disk, and reconcile_desired_state against the twin after connecting.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Desired_State_Snapshot, reconcile_desired_state
+
+# Device client returning a fixed twin, or failing when twin is None
+class Twin_Client:
+    def __init__(self, twin):
+        self.twin = twin
+
+    async def get_twin(self):
+        if self.twin is None:
+            raise ConnectionError("not connected")
+        return self.twin
+
+class Desired_State_Test(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "desired_state.json")
+        self.applied = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def apply(self, changes):
+        self.applied.append(dict(changes))
+        return None, [], []
+
+    def test_snapshot_survives_restart(self):
+        snapshot = Desired_State_Snapshot(self.path)
+        snapshot.update({"led1_r": 10, "led2_r": 20, "$version": 4}, 4)
+        snapshot.update({"led2_r": None}, 5)
+        snapshot = Desired_State_Snapshot(self.path)
+        self.assertEqual((snapshot.version, snapshot.desired), (5, {"led1_r": 10}))
+
+    async def test_applies_only_what_changed_offline(self):
+        snapshot = Desired_State_Snapshot(self.path)
+        snapshot.update({"led1_r": 10, "led2_r": 20}, 4)
+        twin = {"desired": {"led1_r": 10, "led2_r": 30, "$version": 6}, "reported": {"led1_r": 10}}
+        reported = await reconcile_desired_state(Twin_Client(twin), snapshot, self.apply)
+        self.assertEqual(reported, {"led1_r": 10})
+        self.assertEqual(self.applied, [{"led2_r": 30}])
+        self.assertEqual((snapshot.version, snapshot.desired), (6, {"led1_r": 10, "led2_r": 30}))
+
+    async def test_properties_removed_offline_leave_the_snapshot(self):
+        snapshot = Desired_State_Snapshot(self.path)
+        snapshot.update({"led1_r": 10, "led2_r": 20, "led3_r": 30}, 4)
+        twin = {"desired": {"led1_r": 10, "led3_r": None, "$version": 6}, "reported": {}}
+        await reconcile_desired_state(Twin_Client(twin), snapshot, self.apply)
+        snapshot = Desired_State_Snapshot(self.path)
+        self.assertEqual((snapshot.version, snapshot.desired), (6, {"led1_r": 10}))
+
+    async def test_twin_older_than_snapshot_is_not_applied(self):
+        # A patch received by the listener while get_twin ran is already in the snapshot
+        snapshot = Desired_State_Snapshot(self.path)
+        snapshot.update({"led1_r": 50}, 7)
+        twin = {"desired": {"led1_r": 10, "$version": 6}, "reported": {}}
+        await reconcile_desired_state(Twin_Client(twin), snapshot, self.apply)
+        self.assertEqual(self.applied, [])
+        self.assertEqual((snapshot.version, snapshot.desired), (7, {"led1_r": 50}))
+
+    async def test_without_snapshot_applies_whole_twin(self):
+        twin = {"desired": {"led1_r": 10, "led2_r": None, "$version": 2}, "reported": {}}
+        await reconcile_desired_state(Twin_Client(twin), None, self.apply)
+        self.assertEqual(self.applied, [{"led1_r": 10}])
+
+    async def test_get_twin_failure_keeps_local_state(self):
+        snapshot = Desired_State_Snapshot(self.path)
+        snapshot.update({"led1_r": 10}, 4)
+        self.assertIsNone(await reconcile_desired_state(Twin_Client(None), snapshot, self.apply))
+        self.assertEqual(self.applied, [])
+        self.assertEqual(snapshot.version, 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Method_Router responses for known, unknown, slow and failing direct methods.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import asyncio
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from azure.iot.device import MethodRequest
+from DeviceCommon import Method_Router
+
+# Device client that only keeps the method responses
+class Response_Client:
+    def __init__(self):
+        self.responses = []
+
+    async def send_method_response(self, method_response):
+        self.responses.append(method_response)
+
+class Method_Router_Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = Response_Client()
+        self.router = Method_Router(self.client)
+
+        async def echo(payload):
+            return {"result": True, "data": payload}
+
+        async def slow(payload):
+            await asyncio.sleep(10)
+
+        async def broken(payload):
+            raise RuntimeError("broken led")
+
+        async def strict(payload):
+            if not isinstance(payload, int):
+                raise ValueError("payload must be a number")
+            return {"result": True}
+
+        self.router.register("Echo", echo)
+        self.router.register("Slow", slow, timeout=0.05)
+        self.router.register("Broken", broken)
+        self.router.register("Strict", strict)
+
+    async def call(self, name, payload=None):
+        await self.router.dispatch(MethodRequest(str(len(self.client.responses)), name, payload))
+        response = self.client.responses[-1]
+        return response.status, response.payload
+
+    async def test_known_method(self):
+        self.assertEqual(await self.call("Echo", {"n": 1}), (200, {"result": True, "data": {"n": 1}}))
+
+    async def test_unknown_method_gets_404(self):
+        status, payload = await self.call("Launch")
+        self.assertEqual(status, 404)
+        self.assertFalse(payload["result"])
+        self.assertEqual(self.router.stats()["unknown"]["count"], 1)
+
+    async def test_slow_method_gets_504(self):
+        status, _ = await self.call("Slow")
+        self.assertEqual(status, 504)
+
+    async def test_invalid_payload_gets_400(self):
+        self.assertEqual(await self.call("Strict", "ten"), (400, {"result": False, "data": "payload must be a number"}))
+        self.assertEqual(await self.call("Strict", 10), (200, {"result": True}))
+
+    async def test_failing_method_gets_500(self):
+        self.assertEqual(await self.call("Broken"), (500, {"result": False, "data": "broken led"}))
+
+if __name__ == "__main__":
+    unittest.main()
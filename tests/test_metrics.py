@@ -0,0 +1,49 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Prometheus text output of Metrics: one # TYPE line per metric family, followed by all its samples.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import Metrics
+
+class Metrics_Test(unittest.TestCase):
+    def test_each_family_has_one_type_line(self):
+        metrics = Metrics()
+        metrics.count("sdk_call_errors_total", call="connect")
+        metrics.count("sdk_call_errors_total", call="send_message")
+        metrics.histogram("sdk_call_seconds", call="connect").record(0.01)
+        metrics.histogram("sdk_call_seconds", call="send_message").record(0.2)
+        metrics.add_source("direct_methods", lambda: {"A": {"count": 1, "avg_ms": 2.0}, "B": {"count": 3, "avg_ms": 1.0}}, label="method")
+        metrics.add_source("telemetry", lambda: {"sent": 5, "connected": True})
+        types = {}
+        family = None
+        for line in metrics.render_text().splitlines():
+            if line.startswith("# TYPE "):
+                _, _, family, kind = line.split()
+                self.assertNotIn(family, types)
+                types[family] = kind
+                continue
+            name = line.split("{")[0].split()[0]
+            if types[family] == "histogram":
+                self.assertIn(name, (family + "_bucket", family + "_sum", family + "_count"))
+            else:
+                self.assertEqual(name, family)
+        self.assertEqual(types, {
+            "iothub_sdk_call_errors_total": "counter",
+            "iothub_sdk_call_seconds": "histogram",
+            "iothub_direct_methods_count": "gauge",
+            "iothub_direct_methods_avg_ms": "gauge",
+            "iothub_telemetry_sent": "gauge"
+            })
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Telemetry_History ring: wrapping, time range queries and the limit on returned records.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import Telemetry_History
+
+class Telemetry_History_Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = Telemetry_History(os.path.join(self.directory.name, "history.bin"), 5000)
+        for i in range(6000):
+            self.history.add(60 + i % 20, 50, 1000.0 + i)
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def test_ring_keeps_the_newest_records(self):
+        self.assertEqual(len(self.history), 5000)
+        result = self.history.query(limit=1000)
+        self.assertEqual(result["records"][0][0], 2000.0)
+
+    def test_time_range(self):
+        result = self.history.query(5990.0, 5994.0)
+        self.assertEqual(result["count"], 5)
+        self.assertEqual([record[0] for record in result["records"]], [5990.0, 5991.0, 5992.0, 5993.0, 5994.0])
+
+    def test_limit_is_clamped(self):
+        result = self.history.query(limit=100000)
+        self.assertEqual(result["count"], 5000)
+        self.assertLessEqual(len(result["records"]), Telemetry_History.max_limit)
+        self.assertEqual(len(self.history.query(limit=0)["records"]), 1)
+
+if __name__ == "__main__":
+    unittest.main()
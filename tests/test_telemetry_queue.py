@@ -0,0 +1,91 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Telemetry_Queue lanes: alert latency while the routine lane is full, shedding the oldest routine
+# reading to the spool, and alerts that are never shed.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import Telemetry_Queue, Telemetry_Spool
+
+ROUND_TRIP = 0.05
+
+# Device client where every send_message takes one round trip, or waits until released
+class Slow_Client:
+    def __init__(self):
+        self.sent = []
+        self.released = asyncio.Event()
+        self.released.set()
+
+    async def send_message(self, msg):
+        await self.released.wait()
+        await asyncio.sleep(ROUND_TRIP)
+        self.sent.append(msg.custom_properties["Alert"])
+
+class Telemetry_Queue_Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.client = Slow_Client()
+
+    async def asyncTearDown(self):
+        self.directory.cleanup()
+
+    async def test_alert_latency_while_routine_lane_is_full(self):
+        telemetry_queue = Telemetry_Queue(self.client, max_in_flight=2, max_queued=16)
+        telemetry_queue.start()
+        burst = asyncio.ensure_future(asyncio.gather(*[telemetry_queue.send({"i": i}) for i in range(40)]))
+        await asyncio.sleep(ROUND_TRIP)
+        self.assertTrue(telemetry_queue.routine_lane.queue.full())
+        start = time.perf_counter()
+        self.assertTrue(await telemetry_queue.send({"alert": 1}, alert=True))
+        # The burst takes a second to go out, the alert only its own round trip
+        self.assertLess(time.perf_counter() - start, ROUND_TRIP * 4)
+        self.assertFalse(burst.done())
+        await burst
+        await telemetry_queue.stop()
+
+    async def test_shed_sends_oldest_routine_reading_to_spool(self):
+        spool = Telemetry_Spool(os.path.join(self.directory.name, "spool"), sync=False)
+        telemetry_queue = Telemetry_Queue(self.client, max_in_flight=1, max_queued=2, spool=spool, overflow="shed")
+        self.client.released.clear()
+        telemetry_queue.start()
+        first = await telemetry_queue.put({"i": 0})
+        await asyncio.sleep(0)
+        # {"i": 0} is in flight, {"i": 1} and {"i": 2} fill the lane and {"i": 3} sheds {"i": 1}
+        pending = [await telemetry_queue.put({"i": i}) for i in (1, 2, 3)]
+        self.assertEqual(telemetry_queue.routine_lane.shed_readings, 1)
+        self.assertFalse(await pending[0])
+        self.assertEqual([body for _, body, _ in spool.records()], [{"i": 1}])
+        self.client.released.set()
+        self.assertEqual(await asyncio.gather(first, *pending[1:]), [True, True, True])
+        self.assertEqual(telemetry_queue.stats()["spooled_readings"], 1)
+        await telemetry_queue.stop()
+
+    async def test_alerts_are_never_shed(self):
+        telemetry_queue = Telemetry_Queue(self.client, max_in_flight=1, max_queued=1,
+                                          alert_max_in_flight=1, alert_max_queued=1, overflow="shed")
+        self.client.released.clear()
+        telemetry_queue.start()
+        alerts = asyncio.ensure_future(asyncio.gather(*[telemetry_queue.send({"alert": i}, alert=True) for i in range(5)]))
+        routine = asyncio.ensure_future(asyncio.gather(*[telemetry_queue.send({"i": i}) for i in range(5)]))
+        await asyncio.sleep(ROUND_TRIP)
+        self.client.released.set()
+        self.assertEqual(await alerts, [True] * 5)
+        self.assertIn(False, await routine)
+        self.assertEqual(telemetry_queue.alert_lane.shed_readings, 0)
+        self.assertEqual(self.client.sent.count("yes"), 5)
+        await telemetry_queue.stop()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Telemetry_Spool: size cap, draining, torn records and batched fsyncs.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from IoTHubClient import Telemetry_Spool
+
+class Telemetry_Spool_Test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "spool")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_oldest_segments_are_evicted(self):
+        spool = Telemetry_Spool(self.path, max_bytes=5000, segment_bytes=1000)
+        for i in range(200):
+            spool.append({"i": i})
+        self.assertLessEqual(spool.size(), 5000 + 1000)
+        self.assertGreater(spool.evicted_segments, 0)
+        records = list(spool.records())
+        self.assertEqual(records[-1][1], {"i": 199})
+        spool.commit(records[-1][0])
+        self.assertTrue(spool.empty())
+        spool.close()
+
+    def test_segment_larger_than_spool_is_clamped(self):
+        spool = Telemetry_Spool(self.path, max_bytes=500, segment_bytes=100000, sync=False)
+        self.assertEqual(spool.segment_bytes, 500)
+        for i in range(200):
+            spool.append({"i": i})
+        self.assertLessEqual(spool.size(), 500 + 100)
+        spool.close()
+
+    def test_torn_record_is_dropped(self):
+        spool = Telemetry_Spool(self.path, sync=False)
+        spool.append({"i": 1})
+        spool.close()
+        with open(spool.segment_path(spool.segments[-1]), "ab") as f:
+            f.write(b"\x10\x00\x00\x00abc")
+        spool = Telemetry_Spool(self.path, sync=False)
+        self.assertEqual([body for _, body, _ in spool.records()], [{"i": 1}])
+        spool.close()
+
+    def test_records_after_a_corrupt_record_are_kept(self):
+        spool = Telemetry_Spool(self.path, sync=False)
+        for i in range(3):
+            spool.append({"i": i})
+        spool.close()
+        path = spool.segment_path(spool.segments[-1])
+        with open(path, "r+b") as f:
+            data = f.read()
+            # Flip a byte in the payload of the second record
+            f.seek(data.index(b'{"i": 1}') + 2)
+            f.write(b"X")
+        size = os.path.getsize(path)
+        spool = Telemetry_Spool(self.path, sync=False)
+        self.assertEqual(os.path.getsize(path), size)
+        records = list(spool.records())
+        self.assertEqual([body for _, body, _ in records], [{"i": 0}, {"i": 2}])
+        self.assertGreater(spool.skipped_bytes, 0)
+        spool.commit(records[-1][0])
+        self.assertTrue(spool.empty())
+        spool.close()
+
+    def test_fsyncs_are_batched_on_the_event_loop(self):
+        spool = Telemetry_Spool(self.path, sync_interval=0.05)
+
+        async def burst():
+            for i in range(100):
+                spool.append({"i": i})
+            await asyncio.sleep(0.02)
+            spool.append({"i": 100})
+            await asyncio.sleep(0.15)
+
+        asyncio.run(burst())
+        self.assertEqual(spool.syncs, 2)
+        spool.close()
+
+if __name__ == "__main__":
+    unittest.main()
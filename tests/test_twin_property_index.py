@@ -0,0 +1,37 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Twin_Property_Index built from IoTCentralModel.json on strips shorter and longer than the model.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Led_Manager
+from IoTHubClient import Twin_Property_Index
+
+class Twin_Property_Index_Test(unittest.TestCase):
+    def test_leds_past_the_model_are_generated(self):
+        index = Twin_Property_Index(16)
+        led_manager = Led_Manager(led_count=16)
+        version, unknown, rejected = index.apply(led_manager, {"led3_r": 10, "led12_r": 20, "led16_status": True, "led17_r": 1})
+        self.assertEqual((unknown, rejected), (["led17_r"], []))
+        self.assertEqual((led_manager.leds[2].r, led_manager.leds[11].r), (10, 20))
+        self.assertTrue(led_manager.leds[15].status)
+        reported = index.reported_properties(led_manager)
+        self.assertEqual(len(reported), 16 * 5)
+        self.assertEqual(reported["led12_r"], 20)
+
+    def test_model_leds_past_the_strip_are_unknown(self):
+        index = Twin_Property_Index(4)
+        _, unknown, _ = index.apply(Led_Manager(led_count=4), {"led4_g": 1, "led5_g": 1})
+        self.assertEqual(unknown, ["led5_g"])
+
+if __name__ == "__main__":
+    unittest.main()
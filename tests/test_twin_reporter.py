@@ -0,0 +1,62 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+
+# Twin_Reporter deltas, merged reports and retries after a failed update.
+# Run with: python -m pytest tests
+
+import os
+import sys
+import asyncio
+import unittest
+
+os.environ.setdefault("LED_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DeviceCommon import Twin_Reporter
+
+# Device client keeping the reported properties patches, failing while offline is set
+class Patch_Client:
+    def __init__(self):
+        self.patches = []
+        self.offline = False
+
+    async def patch_twin_reported_properties(self, reported_properties):
+        if self.offline:
+            raise ConnectionError("not connected")
+        self.patches.append(dict(reported_properties))
+
+class Twin_Reporter_Test(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = Patch_Client()
+        self.state = {"led1_status": False, "led1_r": 255}
+        self.reporter = Twin_Reporter(self.client, lambda: dict(self.state), window=0.02)
+
+    async def test_only_changes_are_sent(self):
+        self.reporter.acknowledge({"led1_status": False, "led1_r": 0, "$version": 3})
+        await self.reporter.flush()
+        self.assertEqual(self.client.patches, [{"led1_r": 255}])
+        await self.reporter.flush()
+        self.assertEqual(len(self.client.patches), 1)
+
+    async def test_reports_within_window_are_merged(self):
+        for value in (1, 2, 3):
+            self.state["led1_r"] = value
+            self.reporter.report()
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.client.patches, [{"led1_status": False, "led1_r": 3}])
+        stats = self.reporter.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["round_trips_saved"], 2)
+
+    async def test_failed_update_stays_pending(self):
+        self.client.offline = True
+        await self.reporter.flush()
+        self.assertEqual(self.client.patches, [])
+        self.client.offline = False
+        await self.reporter.flush()
+        self.assertEqual(self.client.patches, [{"led1_status": False, "led1_r": 255}])
+
+if __name__ == "__main__":
+    unittest.main()